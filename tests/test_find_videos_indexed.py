@@ -0,0 +1,123 @@
+import os
+import shutil
+
+import pytest
+
+from trackma import utils
+
+OLD = 1_500_000_000
+
+
+def _touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'w').close()
+
+
+def _age(root):
+    # Directories modified just now are always listed again,
+    # so make them look older than that
+    for dirpath, _, _ in os.walk(root):
+        os.utime(dirpath, (OLD, OLD))
+
+
+def _find(root, index, refresh=False):
+    return sorted(utils.find_videos_indexed(str(root), index, refresh))
+
+
+@pytest.fixture
+def library(tmp_path):
+    _touch(str(tmp_path / 'Show A - 01.mkv'))
+    _touch(str(tmp_path / 'notes.txt'))
+    _touch(str(tmp_path / 'B' / 'Show B - 01.mp4'))
+    _touch(str(tmp_path / 'B' / 'C' / 'Show C - 01.avi'))
+    _age(str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def scandir_calls(monkeypatch):
+    calls = []
+    scandir = os.scandir
+
+    def counting_scandir(path):
+        calls.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', counting_scandir)
+    return calls
+
+
+def test_finds_media_recursively(library):
+    assert _find(library, {}) == [
+        (str(library / 'B' / 'C' / 'Show C - 01.avi'), 'Show C - 01.avi'),
+        (str(library / 'B' / 'Show B - 01.mp4'), 'Show B - 01.mp4'),
+        (str(library / 'Show A - 01.mkv'), 'Show A - 01.mkv'),
+    ]
+
+
+def test_unchanged_directories_are_not_listed(library, scandir_calls):
+    index = {}
+    first = _find(library, index)
+    assert len(scandir_calls) == 3
+
+    del scandir_calls[:]
+    assert _find(library, index) == first
+    assert scandir_calls == []
+
+
+def test_modified_directory_is_listed_again(library, scandir_calls):
+    index = {}
+    _find(library, index)
+    _touch(str(library / 'B' / 'Show B - 02.mp4'))
+    os.utime(str(library / 'B'), (OLD + 10, OLD + 10))
+
+    del scandir_calls[:]
+    found = [name for (_, name) in _find(library, index)]
+    assert 'Show B - 02.mp4' in found
+    assert scandir_calls == [str(library / 'B')]
+
+
+def test_recently_modified_directory_is_always_listed(library, scandir_calls):
+    index = {}
+    _find(library, index)
+    os.utime(str(library / 'B'))
+
+    del scandir_calls[:]
+    _find(library, index)
+    _find(library, index)
+    assert scandir_calls == [str(library / 'B')] * 2
+
+
+def test_refresh_lists_everything(library, scandir_calls):
+    index = {}
+    _find(library, index)
+
+    del scandir_calls[:]
+    _find(library, index, refresh=True)
+    assert len(scandir_calls) == 3
+
+
+def test_removed_directories_leave_the_index(library):
+    index = {}
+    _find(library, index)
+    assert str(library / 'B' / 'C') in index
+
+    shutil.rmtree(str(library / 'B'))
+    os.utime(str(library), (OLD + 10, OLD + 10))
+    assert [name for (_, name) in _find(library, index)] == ['Show A - 01.mkv']
+    assert sorted(index) == [str(library)]
+
+
+def test_other_roots_are_kept(library, tmp_path_factory):
+    other = tmp_path_factory.mktemp('other')
+    _touch(str(other / 'Show D - 01.mkv'))
+
+    index = {}
+    _find(library, index)
+    _find(other, index)
+    _find(library, index)
+    assert str(other) in index
+
+
+def test_missing_directory(tmp_path):
+    assert _find(tmp_path / 'missing', {}) == []
@@ -0,0 +1,159 @@
+import gzip
+import http.server
+import threading
+import zlib
+
+import pytest
+
+from trackma.lib import lib
+from trackma.lib.lib import HTTPConnectionError, HTTPError, HTTPTransport
+
+PROXY_VARIABLES = ['http_proxy', 'https_proxy', 'all_proxy', 'no_proxy']
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.server.requests.append((self.client_address[1], self.path, dict(self.headers)))
+        (status, headers, body) = self.server.responses.pop(0) if self.server.responses else (200, {}, b'ok')
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        if headers.pop('X-Close', None):
+            # Drop the connection without telling the client
+            self.close_connection = True
+
+    do_POST = do_GET
+
+
+@pytest.fixture(autouse=True)
+def environment(monkeypatch):
+    for name in PROXY_VARIABLES:
+        monkeypatch.delenv(name, raising=False)
+        monkeypatch.delenv(name.upper(), raising=False)
+    # Every test starts without idle connections
+    monkeypatch.setattr(lib, '_pool', lib.ConnectionPool())
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    server.requests = []
+    server.responses = []
+    server.url = 'http://127.0.0.1:%d' % server.server_address[1]
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _connections(server):
+    return len({port for (port, _, _) in server.requests})
+
+
+@pytest.mark.parametrize('encoding, compress', [
+    ('gzip', gzip.compress),
+    ('deflate', zlib.compress),
+    # Raw deflate data without the zlib header
+    ('deflate', lambda data: zlib.compress(data)[2:-4]),
+    ('identity', lambda data: data),
+])
+def test_decoding(server, encoding, compress):
+    body = b'{"data": [1, 2, 3], "text": "%s"}' % (b'long ' * 100)
+    server.responses.append((200, {'Content-Encoding': encoding}, compress(body)))
+
+    response = HTTPTransport().request('GET', server.url + '/list')
+    assert response.read() == body
+    assert response.json()['data'] == [1, 2, 3]
+    assert server.requests[0][2]['Accept-Encoding'] == 'gzip, deflate'
+
+
+def test_invalid_compressed_body(server):
+    server.responses.append((200, {'Content-Encoding': 'gzip'}, b'not gzip'))
+    with pytest.raises(HTTPConnectionError):
+        HTTPTransport().request('GET', server.url)
+
+
+def test_connections_are_reused(server):
+    transport = HTTPTransport(headers={'User-Agent': 'Test'})
+    for i in range(3):
+        transport.request('GET', server.url + '/%d' % i)
+    HTTPTransport().request('POST', server.url, b'data')
+
+    assert [path for (_, path, _) in server.requests] == ['/0', '/1', '/2', '/']
+    assert server.requests[0][2]['User-Agent'] == 'Test'
+    assert _connections(server) == 1
+
+
+def test_reconnects_after_server_close(server):
+    transport = HTTPTransport()
+    server.responses.append((200, {'X-Close': '1'}, b'first'))
+    assert transport.request('GET', server.url + '/first').read() == b'first'
+
+    # The idle connection was closed by the server, so a new one is opened
+    assert transport.request('GET', server.url + '/second').read() == b'ok'
+    assert [path for (_, path, _) in server.requests] == ['/first', '/second']
+    assert _connections(server) == 2
+
+
+def test_connection_error():
+    with pytest.raises(HTTPConnectionError):
+        HTTPTransport().request('GET', 'http://127.0.0.1:1/')
+
+
+def test_error_status(server):
+    server.responses.append((404, {}, b'{"error": "not_found"}'))
+    with pytest.raises(HTTPError) as e:
+        HTTPTransport().request('GET', server.url)
+    assert e.value.code == 404
+    assert e.value.read() == b'{"error": "not_found"}'
+
+
+def test_redirections(server):
+    server.responses += [(302, {'Location': '/moved'}, b''), (200, {}, b'here')]
+    assert HTTPTransport().request('POST', server.url + '/old', b'data').read() == b'here'
+    assert [path for (_, path, _) in server.requests] == ['/old', '/moved']
+
+
+def test_retries_when_asked(server):
+    server.responses += [(429, {'Retry-After': '0'}, b''), (503, {'Retry-After': '0'}, b'')]
+    assert HTTPTransport().request('GET', server.url).read() == b'ok'
+    assert len(server.requests) == 3
+
+    # Requests that can't be repeated safely aren't sent again on a 503
+    server.responses.append((503, {'Retry-After': '0'}, b''))
+    with pytest.raises(HTTPError):
+        HTTPTransport().request('POST', server.url, b'data')
+    assert len(server.requests) == 4
+
+
+def test_proxy_goes_through_urllib(server, monkeypatch):
+    monkeypatch.setenv('http_proxy', server.url)
+    transport = HTTPTransport()
+
+    server.responses.append((200, {'Content-Encoding': 'gzip'}, gzip.compress(b'proxied')))
+    assert transport.request('GET', 'http://trackma.invalid/list?page=2').read() == b'proxied'
+    # Proxies are asked for the whole URL
+    assert server.requests[0][1] == 'http://trackma.invalid/list?page=2'
+
+    server.responses.append((404, {}, b'missing'))
+    with pytest.raises(HTTPError) as e:
+        transport.request('GET', 'http://trackma.invalid/missing')
+    assert e.value.read() == b'missing'
+
+    # Hosts excluded from the proxy are reached directly
+    monkeypatch.setenv('no_proxy', '127.0.0.1')
+    transport = HTTPTransport()
+    transport.request('GET', server.url + '/direct')
+    assert server.requests[-1][1] == '/direct'
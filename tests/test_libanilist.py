@@ -0,0 +1,51 @@
+import pytest
+
+from trackma import messenger
+from trackma import utils
+from trackma.lib.libanilist import libanilist
+
+
+@pytest.fixture
+def api(monkeypatch):
+    api = libanilist.__new__(libanilist)
+    api.msg = messenger.Messenger(lambda *args: None, 'Test')
+    api.mediatype = 'anime'
+    api.requests = []
+    api.missing = set()
+
+    def request(query, variables=None):
+        api.requests.append(variables['ids'])
+        # Pages don't follow the order of the IDs
+        media = [{'id': showid} for showid in reversed(variables['ids']) if showid not in api.missing]
+        return {'data': {'Page': {'media': media}}}
+
+    monkeypatch.setattr(api, 'check_credentials', lambda: None)
+    monkeypatch.setattr(api, '_request', request)
+    monkeypatch.setattr(api, '_parse_info', lambda item: {'id': item['id']})
+    return api
+
+
+def _shows(*showids):
+    return [{'id': showid} for showid in showids]
+
+
+def test_request_info_in_pages(api):
+    infos = api.request_info(_shows(*range(1, 121)))
+
+    assert api.requests == [list(range(1, 51)), list(range(51, 101)), list(range(101, 121))]
+    assert [info['id'] for info in infos] == list(range(1, 121))
+
+
+def test_request_info_single_page(api):
+    assert [info['id'] for info in api.request_info(_shows(7, 3))] == [7, 3]
+    assert api.requests == [[7, 3]]
+
+
+def test_request_info_missing_shows(api):
+    api.missing = {2, 60}
+    infos = api.request_info(_shows(*range(1, 61)))
+    assert [info['id'] for info in infos] == [showid for showid in range(1, 61) if showid not in (2, 60)]
+
+    api.missing = {1, 2}
+    with pytest.raises(utils.APIError):
+        api.request_info(_shows(1, 2))
@@ -0,0 +1,59 @@
+import json
+import threading
+import urllib.parse
+
+import pytest
+
+from trackma import messenger
+from trackma.lib.libkitsu import libkitsu
+
+URL = 'https://kitsu.io/api/edge/library-entries?page%5Blimit%5D=10'
+
+
+@pytest.fixture
+def api(monkeypatch):
+    api = libkitsu.__new__(libkitsu)
+    api.msg = messenger.Messenger(lambda *args: None, 'Test')
+    api.requests = []
+    monkeypatch.setattr(api, 'library_page_limit', 10)
+    monkeypatch.setattr(api, 'page_workers', 4)
+    return api
+
+
+def _stub_list(monkeypatch, api, entries, count=True):
+    lock = threading.Lock()
+
+    def request(method, url, get=None, post=None, body=None, auth=False):
+        with lock:
+            api.requests.append(url)
+        offset = int(urllib.parse.parse_qs(urllib.parse.urlsplit(url).query).get('page[offset]', ['0'])[0])
+        data = [{'id': showid} for showid in range(offset, min(offset + 10, entries))]
+        links = {}
+        if offset + 10 < entries:
+            links['next'] = '%s&%s' % (URL, urllib.parse.urlencode({'page[offset]': offset + 10}))
+        page = {'data': data, 'links': links}
+        if count:
+            page['meta'] = {'count': entries}
+        return json.dumps(page)
+
+    monkeypatch.setattr(api, '_request', request)
+
+
+def _ids(pages):
+    return [item['id'] for page in pages for item in page['data']]
+
+
+@pytest.mark.parametrize('entries, pages', [(0, 1), (10, 1), (25, 3), (95, 10)])
+def test_list_pages_with_count(api, monkeypatch, entries, pages):
+    _stub_list(monkeypatch, api, entries)
+
+    assert _ids(api._fetch_list_pages(URL)) == list(range(entries))
+    # The count tells where the list ends, so no page past it is requested
+    assert len(api.requests) == pages
+
+
+def test_list_pages_without_count(api, monkeypatch):
+    _stub_list(monkeypatch, api, 25, count=False)
+
+    assert _ids(api._fetch_list_pages(URL)) == list(range(25))
+    assert len(api.requests) == 3
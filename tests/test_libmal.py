@@ -0,0 +1,92 @@
+import threading
+import urllib.parse
+
+import pytest
+
+from trackma import messenger
+from trackma import utils
+from trackma.lib.libmal import libmal
+
+
+@pytest.fixture
+def api(monkeypatch):
+    api = libmal.__new__(libmal)
+    api.msg = messenger.Messenger(lambda *args: None, 'Test')
+    api.mediatype = 'anime'
+    api.query_url = 'https://api.myanimelist.net/v2'
+    api.total_str = 'num_episodes'
+    api.watched_str = 'num_episodes_watched'
+    api.requests = []
+    api.lock = threading.Lock()
+    monkeypatch.setattr(api, 'check_credentials', lambda: None)
+    return api
+
+
+def _stub_request(monkeypatch, api, respond):
+    def request(method, url, get=None, post=None, auth=False):
+        with api.lock:
+            api.requests.append(url)
+        return respond(url)
+
+    monkeypatch.setattr(api, '_request', request)
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_fetch_concurrently(api, workers):
+    def fetch(item):
+        if item % 3 == 0:
+            raise utils.APIError('failed %d' % item)
+        return item * 10
+
+    results = list(api._fetch_concurrently(fetch, list(range(1, 8)), workers))
+    assert [r if isinstance(r, int) else str(r) for r in results] == \
+        [10, 20, 'failed 3', 40, 50, 'failed 6', 70]
+
+    # Other errors aren't caught
+    with pytest.raises(KeyError):
+        list(api._fetch_concurrently(lambda item: {}[item], [1, 2], workers))
+
+
+def test_request_info_partial_failure(api, monkeypatch):
+    def respond(url):
+        showid = int(url.rsplit('/', 1)[1])
+        if showid == 2:
+            raise utils.APIError('Not found')
+        return {'id': showid}
+
+    _stub_request(monkeypatch, api, respond)
+    monkeypatch.setattr(api, '_parse_info', lambda item: {'id': item['id']})
+
+    infos = api.request_info([{'id': showid} for showid in range(1, 6)])
+    assert [info['id'] for info in infos] == [1, 3, 4, 5]
+    assert len(api.requests) == 5
+
+    # It only fails when no show could be fetched
+    with pytest.raises(utils.APIError):
+        api.request_info([{'id': 2}])
+
+
+def _list_pages(entries, limit):
+    def respond(url):
+        offset = int(urllib.parse.parse_qs(urllib.parse.urlsplit(url).query).get('offset', ['0'])[0])
+        data = [{'id': showid} for showid in range(offset, min(offset + limit, entries))]
+        paging = {'next': url + '&next'} if offset + limit < entries else {}
+        return {'data': data, 'paging': paging}
+
+    return respond
+
+
+@pytest.mark.parametrize('entries, pages', [(5, 1), (10, 1), (25, 3), (30, 3), (95, 10)])
+def test_list_prefetch_stops_at_the_last_page(api, monkeypatch, entries, pages):
+    monkeypatch.setattr(api, 'library_page_limit', 10)
+    monkeypatch.setattr(api, 'page_workers', 4)
+    _stub_request(monkeypatch, api, _list_pages(entries, 10))
+
+    data = list(api._fetch_list_pages())
+    assert [item['id'] for page in data for item in page['data']] == list(range(entries))
+    assert len(data) == pages
+
+    # Prefetching goes at most page_workers - 1 pages past the last one
+    assert pages <= len(api.requests) <= pages + 3
+    if pages == 1:
+        assert len(api.requests) == 1
@@ -0,0 +1,141 @@
+import os
+
+import pytest
+
+from trackma import messenger
+from trackma.tracker import library
+from trackma.tracker.library import LibraryWatcher
+
+
+class Thread:
+    """Keeps the watcher from starting; tests call observe() themselves."""
+
+    def __init__(self, target):
+        self.target = target
+
+    def start(self):
+        pass
+
+
+@pytest.fixture
+def make_watcher(monkeypatch, tmp_path):
+    monkeypatch.setattr(library.threading, 'Thread', Thread)
+
+    def make_watcher(*dirs):
+        watcher = LibraryWatcher(messenger.Messenger(lambda *args: None, 'Test'),
+                                 [str(tmp_path / d) for d in dirs or ['library']], 5)
+        watcher.events = []
+        watcher.connect_signal('detected', lambda path, name: watcher.events.append(('+', path, name)))
+        watcher.connect_signal('removed', lambda path, name: watcher.events.append(('-', path, name)))
+        return watcher
+
+    return make_watcher
+
+
+@pytest.fixture
+def lib(tmp_path):
+    (tmp_path / 'library' / 'Show').mkdir(parents=True)
+    (tmp_path / 'library' / 'Show' / 'Show - 01.mkv').write_text('')
+    (tmp_path / 'library' / 'notes.txt').write_text('')
+    return tmp_path / 'library'
+
+
+def _fallbacks(monkeypatch, pyinotify, inotify):
+    used = []
+
+    def watch(name, error):
+        def watch(self):
+            used.append(name)
+            if error:
+                raise error
+        return watch
+
+    monkeypatch.setattr(LibraryWatcher, '_watch_pyinotify', watch('pyinotify', pyinotify))
+    monkeypatch.setattr(LibraryWatcher, '_watch_inotify', watch('inotify', inotify))
+    monkeypatch.setattr(LibraryWatcher, '_watch_polling', watch('polling', None))
+    return used
+
+
+@pytest.mark.parametrize('pyinotify, inotify, expected', [
+    (None, None, ['pyinotify']),
+    (ImportError(), None, ['pyinotify', 'inotify']),
+    (ImportError(), ImportError(), ['pyinotify', 'inotify', 'polling']),
+    # Running out of inotify watches fails every inotify module alike
+    (OSError('No space left on device'), None, ['pyinotify', 'polling']),
+    (ImportError(), OSError('No space left on device'), ['pyinotify', 'inotify', 'polling']),
+])
+def test_fallbacks(make_watcher, monkeypatch, pyinotify, inotify, expected):
+    used = _fallbacks(monkeypatch, pyinotify, inotify)
+    make_watcher().observe()
+    assert used == expected
+
+
+def _poll(monkeypatch, watcher, *steps):
+    # Runs the polling loop, doing each step between two polls
+    steps = list(steps)
+
+    def sleep(interval):
+        if steps:
+            steps.pop(0)()
+        else:
+            watcher.disable()
+
+    monkeypatch.setattr(library.time, 'sleep', sleep)
+    watcher._watch_polling()
+
+
+def test_polling(make_watcher, lib, monkeypatch):
+    watcher = make_watcher()
+    show = str(lib / 'Show')
+
+    def add():
+        (lib / 'Show' / 'Show - 02.mkv').write_text('')
+        (lib / 'New').mkdir()
+        (lib / 'New' / 'New - 01.mp4').write_text('')
+        (lib / 'New' / 'cover.jpg').write_text('')
+
+    def remove():
+        os.unlink(str(lib / 'Show' / 'Show - 01.mkv'))
+        os.rename(str(lib / 'New'), str(lib / 'Old'))
+
+    _poll(monkeypatch, watcher, add, remove)
+
+    # Files already in the library aren't reported
+    assert watcher.events == [
+        ('+', str(lib / 'New'), 'New - 01.mp4'),
+        ('+', show, 'Show - 02.mkv'),
+        ('-', str(lib / 'New'), 'New - 01.mp4'),
+        ('-', show, 'Show - 01.mkv'),
+        ('+', str(lib / 'Old'), 'New - 01.mp4'),
+    ]
+    assert watcher.files == {(show, 'Show - 02.mkv'), (str(lib / 'Old'), 'New - 01.mp4')}
+
+
+def test_polling_after_failed_watch(make_watcher, lib, monkeypatch):
+    # Changes done while inotify was failing are found by the first poll
+    watcher = make_watcher()
+    watcher._scan()
+    (lib / 'Show' / 'Show - 02.mkv').write_text('')
+    os.unlink(str(lib / 'Show' / 'Show - 01.mkv'))
+
+    _poll(monkeypatch, watcher)
+    assert watcher.events == [('-', str(lib / 'Show'), 'Show - 01.mkv'),
+                              ('+', str(lib / 'Show'), 'Show - 02.mkv')]
+
+
+def test_directory_events(make_watcher, lib):
+    watcher = make_watcher()
+    watcher._scan()
+    show = str(lib / 'Show')
+
+    (lib / 'New' / 'Sub').mkdir(parents=True)
+    (lib / 'New' / 'Sub' / 'New - 01.mkv').write_text('')
+    watcher._process_event(str(lib), 'New', True, True)
+    watcher._process_event(str(lib / 'New' / 'Sub'), 'New - 01.mkv', False, True)
+    watcher._process_event(show, 'notes.txt', False, True)
+    assert watcher.events == [('+', str(lib / 'New' / 'Sub'), 'New - 01.mkv')]
+
+    del watcher.events[:]
+    watcher._process_event(str(lib), 'Show', True, False)
+    assert watcher.events == [('-', show, 'Show - 01.mkv')]
+    assert watcher.files == {(str(lib / 'New' / 'Sub'), 'New - 01.mkv')}
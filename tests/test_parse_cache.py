@@ -0,0 +1,114 @@
+import pytest
+
+from trackma import messenger
+from trackma.parser import ParseResult
+from trackma.parser.cache import ParseCache
+
+
+class Parser:
+    parser_name = 'test'
+    parser_version = 1
+
+
+class NewParser(Parser):
+    parser_version = 2
+
+
+class OtherParser:
+    parser_name = 'other'
+    parser_version = 1
+
+
+def _result(title, episode=1):
+    return ParseResult(title, episode, episode, None, None)
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'parser.db')
+
+
+@pytest.fixture
+def msg():
+    return messenger.Messenger(lambda *args: None, 'Test')
+
+
+def test_results_persist(path, msg):
+    cache = ParseCache(msg, path)
+    cache.put(Parser, 'Show - 01.mkv', _result('Show'))
+    # Pending results are found before they're written
+    assert cache.get(Parser, 'Show - 01.mkv') == _result('Show')
+    assert cache.get(Parser, 'Show - 02.mkv') is None
+    cache.close()
+
+    cache = ParseCache(msg, path)
+    result = cache.get(Parser, 'Show - 01.mkv')
+    assert result == _result('Show')
+    assert isinstance(result, ParseResult)
+    assert cache.get(OtherParser, 'Show - 01.mkv') is None
+    cache.close()
+
+
+def test_written_in_batches(path, msg, monkeypatch):
+    monkeypatch.setattr(ParseCache, 'flush_size', 3)
+    cache = ParseCache(msg, path)
+    reader = ParseCache(msg, path)
+
+    cache.put(Parser, 'a.mkv', _result('A'))
+    cache.put(Parser, 'b.mkv', _result('B'))
+    assert reader.get(Parser, 'a.mkv') is None
+
+    cache.put(Parser, 'c.mkv', _result('C'))
+    assert not cache.pending
+    assert reader.get(Parser, 'a.mkv') == _result('A')
+
+    cache.close()
+    reader.close()
+
+
+def test_new_parser_version_invalidates_results(path, msg):
+    cache = ParseCache(msg, path)
+    cache.put(Parser, 'Show - 01.mkv', _result('Old'))
+    cache.put(OtherParser, 'Show - 01.mkv', _result('Other'))
+    cache.close()
+
+    cache = ParseCache(msg, path)
+    assert cache.get(NewParser, 'Show - 01.mkv') is None
+    cache.put(NewParser, 'Show - 01.mkv', _result('New'))
+    cache.close()
+
+    cache = ParseCache(msg, path)
+    assert cache.get(NewParser, 'Show - 01.mkv') == _result('New')
+    # Older versions are discarded, other parsers are kept
+    assert cache.get(Parser, 'Show - 01.mkv') is None
+    assert cache.get(OtherParser, 'Show - 01.mkv') == _result('Other')
+    cache.close()
+
+
+def test_prune(path, msg):
+    cache = ParseCache(msg, path)
+    for name in ('a.mkv', 'b.mkv', 'c.mkv'):
+        cache.put(Parser, name, _result(name))
+    cache.put(OtherParser, 'a.mkv', _result('Other'))
+    cache.close()
+
+    cache = ParseCache(msg, path)
+    cache.put(Parser, 'd.mkv', _result('d.mkv'))
+    cache.prune(Parser, iter(['b.mkv', 'd.mkv', 'e.mkv']))
+    cache.close()
+
+    cache = ParseCache(msg, path)
+    assert [name for name in ('a.mkv', 'b.mkv', 'c.mkv', 'd.mkv')
+            if cache.get(Parser, name)] == ['b.mkv', 'd.mkv']
+    assert cache.get(OtherParser, 'a.mkv') == _result('Other')
+    cache.close()
+
+
+def test_unusable_database_is_ignored(tmp_path, msg):
+    cache = ParseCache(msg, str(tmp_path / 'missing' / 'parser.db'))
+    assert cache.db is None
+
+    cache.put(Parser, 'a.mkv', _result('A'))
+    assert cache.get(Parser, 'a.mkv') is None
+    cache.prune(Parser, [])
+    cache.close()
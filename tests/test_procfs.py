@@ -0,0 +1,128 @@
+import os
+
+import pytest
+
+from trackma.tracker import polling
+from trackma.tracker import procfs
+from trackma.tracker.procfs import PlayerProcesses
+
+PLAYERS = 'mpv|vlc'
+
+
+class Proc:
+    """A fake /proc tree with a directory per process."""
+
+    def __init__(self, root):
+        self.root = root
+        (root / 'self').mkdir()
+        (root / 'uptime').write_text('')
+
+    def start(self, pid, cmdline, files=()):
+        d = self.root / str(pid)
+        (d / 'fd').mkdir(parents=True)
+        self.run(pid, cmdline)
+        for fd, path in enumerate(files, 3):
+            os.symlink(path, str(d / 'fd' / str(fd)))
+
+    def run(self, pid, cmdline):
+        (self.root / str(pid) / 'cmdline').write_bytes(b'\x00'.join(cmdline) + b'\x00')
+
+    def stop(self, pid):
+        d = self.root / str(pid)
+        for fd in (d / 'fd').iterdir():
+            fd.unlink()
+        (d / 'fd').rmdir()
+        (d / 'cmdline').unlink()
+        d.rmdir()
+
+
+@pytest.fixture
+def proc(tmp_path):
+    root = tmp_path / 'proc'
+    root.mkdir()
+    return Proc(root)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(procfs.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_finds_players(proc):
+    proc.start(100, [b'/usr/bin/mpv', b'Show - 01.mkv'], ['/lib/Show - 01.mkv', '/dev/null'])
+    proc.start(200, [b'bash'], ['/lib/Show - 02.mkv'])
+    proc.start(300, [b'vlc'])
+
+    players = PlayerProcesses(PLAYERS, str(proc.root))
+    players.refresh()
+    assert sorted(players.players()) == ['100', '300']
+    assert players.name('100') == b'/usr/bin/mpv'
+    assert players.name('200') is None
+    assert sorted(players.open_files('100')) == [('3', '/lib/Show - 01.mkv'), ('4', '/dev/null')]
+    assert list(players.open_files('999')) == []
+
+
+def test_command_lines_are_read_once(proc, monkeypatch):
+    proc.start(100, [b'mpv'])
+    proc.start(200, [b'bash'])
+    players = PlayerProcesses(PLAYERS, str(proc.root))
+
+    read = []
+    player_name = players._player_name
+    monkeypatch.setattr(players, '_player_name', lambda pid: read.append(pid) or player_name(pid))
+
+    players.refresh()
+    proc.start(300, [b'vlc'])
+    proc.stop(100)
+    players.refresh()
+
+    assert sorted(read) == ['100', '200', '300']
+    assert players.players() == ['300']
+
+    players.refresh(full=True)
+    assert sorted(read) == ['100', '200', '200', '300', '300']
+
+
+def test_find(proc, clock):
+    proc.start(100, [b'mpv'], ['/dev/null', '/lib/Show - 01.mkv'])
+    players = PlayerProcesses(PLAYERS, str(proc.root))
+
+    assert players.find(lambda path: path.endswith('.mkv')) == ('100', '4', '/lib/Show - 01.mkv')
+    assert players.find(lambda path: path.endswith('.mp4')) is None
+
+
+def test_process_running_a_player_later(proc, clock):
+    # A process that's seen before it runs a player, like a forking launcher
+    proc.start(100, [b'launcher'], ['/lib/Show - 01.mkv'])
+    players = PlayerProcesses(PLAYERS, str(proc.root))
+
+    def match(path):
+        return path.endswith('.mkv')
+
+    assert players.find(match) is None
+    proc.run(100, [b'mpv'])
+
+    # Command lines are only read again once in a while
+    clock[0] += PlayerProcesses.full_refresh_interval / 2
+    assert players.find(match) is None
+    clock[0] += PlayerProcesses.full_refresh_interval
+    assert players.find(match) == ('100', '3', '/lib/Show - 01.mkv')
+
+
+def test_polling_tracker_matches_watched_dirs(proc, clock, tmp_path):
+    library = tmp_path / 'library'
+    (library / 'Show').mkdir(parents=True)
+    link = tmp_path / 'link'
+    link.symlink_to(library)
+
+    tracker = polling.PollingTracker.__new__(polling.PollingTracker)
+    tracker.players = PlayerProcesses(PLAYERS, str(proc.root))
+
+    proc.start(100, [b'mpv'], ['/other/Show - 01.mkv', str(library / 'notes.txt')])
+    assert tracker.get_playing_file([str(library)], PLAYERS) is None
+
+    # Files are matched by their real path, even if the directory is set through a link
+    proc.start(200, [b'vlc'], [str(library / 'Show' / 'Show - 02.mkv')])
+    assert tracker.get_playing_file([str(link)], PLAYERS) == 'Show - 02.mkv'
@@ -0,0 +1,109 @@
+import pytest
+
+from trackma.data import Queue
+
+
+def _item(showid, action, **kwargs):
+    return dict(id=showid, action=action, **kwargs)
+
+
+def test_keeps_insertion_order():
+    items = [_item(1, 'update'), _item(2, 'add'), _item(1, 'delete')]
+    queue = Queue(items)
+
+    assert len(queue) == 3
+    assert list(queue) == items
+    assert [queue.popleft() for _ in range(3)] == items
+    assert not queue
+
+
+def test_popleft_empty():
+    with pytest.raises(IndexError):
+        Queue().popleft()
+
+
+def test_get_by_show_and_action():
+    update = _item(1, 'update', my_progress=3)
+    queue = Queue([update, _item(2, 'add')])
+
+    assert queue.get(1, 'update') is update
+    assert queue.get(1, 'delete') is None
+    assert queue.get(3, 'update') is None
+
+
+def test_popped_items_are_unindexed():
+    queue = Queue([_item(1, 'update'), _item(2, 'update')])
+    queue.popleft()
+
+    assert queue.get(1, 'update') is None
+    assert queue.get(2, 'update') is not None
+    assert not queue.has_show(1)
+    assert queue.has_show(2)
+
+
+def test_popping_older_item_keeps_newer_one_indexed():
+    old = _item(1, 'update', my_progress=1)
+    new = _item(1, 'update', my_progress=2)
+    queue = Queue([old, new])
+
+    assert queue.popleft() is old
+    assert queue.get(1, 'update') is new
+
+
+def test_iterating_allows_changes():
+    queue = Queue([_item(1, 'update'), _item(2, 'update')])
+    for item in queue:
+        queue.popleft()
+        queue.append(_item(item['id'] + 10, 'add'))
+
+    assert [item['id'] for item in queue] == [11, 12]
+
+
+def test_stored_as_list():
+    items = [_item(1, 'add'), _item(2, 'delete')]
+    assert Queue(list(Queue(items))).get(2, 'delete') == items[1]
+
+
+def test_held_items_stay_queued_but_unindexed():
+    item = _item(1, 'update', my_progress=1)
+    queue = Queue([item, _item(2, 'update')])
+    queue.hold(item)
+
+    assert len(queue) == 2
+    assert queue.get(1, 'update') is None
+    assert queue.has_show(1)
+
+    # A change made while it's sent becomes a new item
+    newer = _item(1, 'update', my_progress=2)
+    queue.append(newer)
+    queue.done(item)
+    assert [i['id'] for i in queue] == [2, 1]
+    assert queue.get(1, 'update') is newer
+    assert queue.has_show(1)
+
+
+def test_done_removes_only_that_item():
+    items = [_item(1, 'update'), _item(2, 'update'), _item(3, 'update')]
+    queue = Queue(items)
+    for item in items:
+        queue.hold(item)
+
+    queue.done(items[1])
+    assert list(queue) == [items[0], items[2]]
+    assert not queue.has_show(2)
+    assert queue.has_show(1)
+
+
+def test_release_indexes_held_items_again():
+    old = _item(1, 'update', my_progress=1)
+    other = _item(2, 'delete')
+    queue = Queue([old, other])
+    queue.hold(old)
+    queue.hold(other)
+    newer = _item(1, 'update', my_progress=2)
+    queue.append(newer)
+
+    queue.release()
+    assert queue.get(2, 'delete') is other
+    assert queue.get(1, 'update') is newer
+    assert list(queue) == [old, other, newer]
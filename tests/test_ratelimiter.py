@@ -0,0 +1,162 @@
+import threading
+import time
+
+import pytest
+
+from trackma import utils
+from trackma.lib import lib
+from trackma.lib.lib import RateLimiter
+
+
+class FakeClock:
+    """Stands in for the time module; sleep() moves the clock forward unless frozen."""
+
+    def __init__(self, frozen=False):
+        self.now = 1000.0
+        self.frozen = frozen
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return 1_700_000_000 + self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        if not self.frozen:
+            self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(lib.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(lib.time, 'time', clock.time)
+    monkeypatch.setattr(lib.time, 'sleep', clock.sleep)
+    return clock
+
+
+def test_burst_then_rate(clock):
+    limiter = RateLimiter(2, burst=3)
+    for _ in range(3):
+        limiter.wait()
+    assert clock.sleeps == []
+
+    limiter.wait()
+    limiter.wait()
+    assert clock.sleeps == [pytest.approx(0.5), pytest.approx(0.5)]
+
+
+def test_tokens_refill(clock):
+    limiter = RateLimiter(1)
+    limiter.wait()
+    clock.now += 5
+    limiter.wait()
+    assert clock.sleeps == []
+
+
+def test_no_rate_never_waits(clock):
+    limiter = RateLimiter()
+    for _ in range(20):
+        limiter.wait()
+    assert clock.sleeps == []
+
+
+def test_backoff_doubles_and_resets(clock):
+    limiter = RateLimiter(1)
+    assert limiter.update(429, {}) == 1
+    assert limiter.update(429, {}) == 2
+    assert limiter.update(503, {}) == 4
+    assert limiter.update(200, {}) == 0
+    assert limiter.update(429, {}) == 1
+
+
+def test_backoff_is_capped(clock):
+    limiter = RateLimiter(1)
+    for _ in range(10):
+        paused = limiter.update(429, {})
+    assert paused == RateLimiter.max_backoff
+
+
+def test_retry_after_seconds(clock):
+    limiter = RateLimiter(10)
+    assert limiter.update(429, {'Retry-After': '7'}) == 7
+    limiter.wait()
+    assert clock.sleeps == [pytest.approx(7)]
+
+
+def test_retry_after_date(clock):
+    limiter = RateLimiter(10)
+    date = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(clock.time() + 30))
+    assert limiter.update(503, {'Retry-After': date}) == pytest.approx(30, abs=1)
+
+
+def test_remaining_exhausted_pauses_until_reset(clock):
+    limiter = RateLimiter()
+    assert limiter.update(200, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '12'}) == 12
+
+
+def test_reset_timestamp(clock):
+    limiter = RateLimiter()
+    reset = str(int(clock.time() + 20))
+    assert limiter.update(200, {'X-RateLimit-Remaining': '0',
+                                'X-RateLimit-Reset': reset}) == pytest.approx(20, abs=1)
+
+
+def test_remaining_spread_until_reset(clock):
+    limiter = RateLimiter()
+    limiter.update(200, {'X-RateLimit-Remaining': '10', 'X-RateLimit-Reset': '5'})
+    assert limiter.current_rate == 2
+
+    # The configured rate is kept when it's the slower one
+    limiter = RateLimiter(1)
+    limiter.update(200, {'X-RateLimit-Remaining': '10', 'X-RateLimit-Reset': '5'})
+    assert limiter.current_rate == 1
+
+
+def test_paused_waiters_without_rate(monkeypatch):
+    # Every concurrent waiter sees the pause, as the clock doesn't move for them
+    clock = FakeClock(frozen=True)
+    monkeypatch.setattr(lib.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(lib.time, 'time', clock.time)
+    monkeypatch.setattr(lib.time, 'sleep', clock.sleep)
+
+    limiter = RateLimiter(None)
+    limiter.update(429, {})
+
+    errors = []
+
+    def waiter():
+        try:
+            limiter.wait()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=waiter) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    assert clock.sleeps == [pytest.approx(1)] * 3
+
+
+def test_shared_limiter_per_host():
+    assert lib.get_rate_limiter('a.test', 2) is lib.get_rate_limiter('a.test', 2)
+    assert lib.get_rate_limiter('a.test', 2) is not lib.get_rate_limiter('b.test', 2)
+
+
+def test_long_pause_fails_instead_of_blocking(clock):
+    limiter = RateLimiter(1.5)
+    assert limiter.update(429, {'Retry-After': '3600'}) == 3600
+
+    with pytest.raises(utils.APIError):
+        limiter.wait()
+    assert clock.sleeps == []
+
+    # Once what's left of the pause is short enough, requests wait for it
+    clock.now += 3600 - RateLimiter.max_wait
+    limiter.wait()
+    assert clock.sleeps == [pytest.approx(RateLimiter.max_wait)]
@@ -0,0 +1,122 @@
+import random
+
+from trackma import utils
+from trackma.engine import Engine
+from trackma.extras.redirections import RedirectionRules
+from trackma.messenger import Messenger
+
+
+def _random_rules(rng, count):
+    rules = []
+    for _ in range(count):
+        start = rng.randint(1, 30)
+        end = -1 if rng.random() < 0.2 else rng.randint(start, 40)
+        dst_start = rng.randint(1, 20)
+        dst_end = -1 if end == -1 else dst_start + end - start
+        rules.append(((start, end), rng.randint(1, 5), (dst_start, dst_end)))
+    return rules
+
+
+def _overlaps(src_eps, ep_start, ep_end):
+    return src_eps[0] <= ep_end and (src_eps[1] == -1 or src_eps[1] >= ep_start)
+
+
+def test_find():
+    rules = RedirectionRules([((13, 24), 2, (1, 12)), ((1, 12), 3, (1, 12)), ((25, -1), 4, (1, -1))])
+    assert rules.find(1) == [((1, 12), 3, (1, 12))]
+    assert rules.find(24) == [((13, 24), 2, (1, 12))]
+    assert rules.find(1000) == [((25, -1), 4, (1, -1))]
+    assert rules.find(0) == []
+
+
+def test_overlapping_keeps_file_order():
+    rules = RedirectionRules([((10, 20), 2, (1, 11)), ((1, 15), 3, (1, 15)), ((5, 5), 4, (1, 1))])
+    assert rules.overlapping(4, 12) == list(rules)
+    assert rules.overlapping(16, 30) == [((10, 20), 2, (1, 11))]
+    assert rules.overlapping(21, 30) == []
+
+
+def test_overlapping_matches_full_scan():
+    rng = random.Random(1)
+    for _ in range(500):
+        rules = _random_rules(rng, rng.randint(0, 8))
+        compiled = RedirectionRules(rules)
+        for _ in range(10):
+            ep_start = rng.randint(1, 45)
+            ep_end = rng.randint(ep_start, 50)
+            expected = [rule for rule in rules if _overlaps(rule[0], ep_start, ep_end)]
+            assert compiled.overlapping(ep_start, ep_end) == expected
+
+
+def test_iteration_and_equality():
+    rules = [((1, 12), 3, (1, 12)), ((13, -1), 2, (1, -1))]
+    compiled = RedirectionRules(rules)
+    assert list(compiled) == rules
+    assert len(compiled) == 2
+    assert compiled == RedirectionRules(list(rules))
+
+
+def _random_redirections(rng):
+    # Show 6 isn't in the list, so its rules must be skipped
+    return {showid: RedirectionRules([(src, rng.choice([1, 2, 3, 4, 6]), dst)
+                                      for (src, _, dst) in _random_rules(rng, rng.randint(0, 5))])
+            for showid in range(1, 5)}
+
+
+def _episodes(parts):
+    return [(show['id'], ep) for (show, (ep_start, ep_end)) in parts
+            for ep in range(ep_start, ep_end + 1)]
+
+
+def test_redirect_show_range_matches_each_episode():
+    rng = random.Random(2)
+    for _ in range(1000):
+        showlist = {showid: {'id': showid, 'total': rng.choice([0, 0, 5, 12, 24])}
+                    for showid in range(1, 6)}
+        tracker_list = (showlist, {}, None)
+        redirections = _random_redirections(rng)
+
+        show = showlist[rng.randint(1, 5)]
+        ep_start = rng.randint(1, 40)
+        ep_end = rng.randint(ep_start, ep_start + 15)
+
+        parts = utils.redirect_show_range((show, (ep_start, ep_end)), redirections, tracker_list)
+        expected = [(new_show['id'], new_ep) for (new_show, new_ep) in
+                    (utils.redirect_show((show, ep), redirections, tracker_list)
+                     for ep in range(ep_start, ep_end + 1))]
+        assert _episodes(parts) == expected
+
+        # Consecutive parts are always merged
+        for (prev, part) in zip(parts, parts[1:]):
+            assert not (prev[0] is part[0] and prev[1][1] + 1 == part[1][0])
+
+
+def test_redirect_show_range_splits():
+    showlist = {1: {'id': 1, 'total': 12}, 2: {'id': 2, 'total': 12}}
+    redirections = {1: RedirectionRules([((13, 24), 2, (1, 12))])}
+    parts = utils.redirect_show_range((showlist[1], (11, 14)), redirections, (showlist, {}, None))
+    assert parts == [(showlist[1], (11, 12)), (showlist[2], (1, 2))]
+
+
+def test_library_entry_episodes():
+    assert list(Engine._library_entry_episodes((1, 3))) == [(1, 3, 3)]
+    assert list(Engine._library_entry_episodes((1, (3, 5)))) == [(1, 3, 5)]
+    assert list(Engine._library_entry_episodes([(1, (11, 12)), (2, (1, 2))])) == \
+        [(1, 11, 12), (2, 1, 2)]
+
+
+def test_library_split_entry():
+    engine = Engine.__new__(Engine)
+    engine.msg = Messenger(lambda *args: None, 'Test')
+    library = {}
+    library_cache = {'ep11-14.mkv': [(1, (11, 12)), (2, (1, 2))],
+                     'ep13.mkv': (1, 13)}
+
+    engine._add_library_entry(library, library_cache['ep11-14.mkv'], '/lib/ep11-14.mkv')
+    engine._add_library_entry(library, library_cache['ep13.mkv'], '/lib/ep13.mkv')
+    assert library == {1: {11: '/lib/ep11-14.mkv', 12: '/lib/ep11-14.mkv', 13: '/lib/ep13.mkv'},
+                       2: {1: '/lib/ep11-14.mkv', 2: '/lib/ep11-14.mkv'}}
+
+    engine._remove_show_from_library(library, library_cache, '/lib/ep11-14.mkv', 'ep11-14.mkv')
+    assert library == {1: {13: '/lib/ep13.mkv'}, 2: {}}
+    assert 'ep11-14.mkv' not in library_cache
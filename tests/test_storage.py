@@ -0,0 +1,256 @@
+import pytest
+
+from trackma import messenger
+from trackma import storage
+from trackma import utils
+
+USERFOLDER = 'user.test'
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'HOME', str(tmp_path))
+    path = tmp_path / '.trackma' / USERFOLDER
+    path.mkdir(parents=True)
+    return path
+
+
+@pytest.fixture
+def msg():
+    return messenger.Messenger(lambda *args: None, 'Test')
+
+
+def _open(msg, backend):
+    return storage.available_storages[backend](msg, USERFOLDER, 'anime')
+
+
+def _show(showid, **kwargs):
+    show = utils.show()
+    show.update(id=showid, title='Show %d' % showid, **kwargs)
+    return show
+
+
+BACKENDS = ['pickle', 'sqlite']
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_list_round_trip(data_dir, msg, backend):
+    showlist = {showid: _show(showid) for showid in (5, 1, 3, 2)}
+
+    store = _open(msg, backend)
+    store.save_list(showlist)
+
+    # Changed shows keep their place, new ones go at the end
+    showlist[1] = _show(1, my_progress=4)
+    store.save_list_item(showlist, showlist[1])
+    showlist[9] = _show(9)
+    store.save_list_item(showlist, showlist[9])
+    del showlist[3]
+    store.delete_list_item(showlist, 3)
+    store.close()
+
+    store = _open(msg, backend)
+    assert store.list_exists()
+    loaded = store.load_list()
+    store.close()
+
+    assert loaded == showlist
+    assert list(loaded) == [5, 1, 2, 9]
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_other_stores_round_trip(data_dir, msg, backend):
+    infos = [{'id': 1, 'title': 'Show 1', 'extra': []}, {'id': 'a1', 'title': 'Show A'}]
+    queue = [{'id': 1, 'action': 'update', 'my_progress': 2}, {'id': 2, 'action': 'delete'},
+             {'id': 1, 'action': 'add'}]
+    meta = {'lastget': 10, 'altnames': {1: 'Uno'}, 'library': {}}
+
+    store = _open(msg, backend)
+    assert not (store.info_exists() or store.queue_exists() or store.meta_exists())
+    store.save_info(infos)
+    store.save_queue(queue)
+    store.save_meta(meta)
+    store.close()
+
+    store = _open(msg, backend)
+    assert store.info_exists() and store.queue_exists() and store.meta_exists()
+    assert store.get_info(1) == infos[0]
+    assert store.get_info('a1') == infos[1]
+    with pytest.raises(KeyError):
+        store.get_info(2)
+    assert sorted(store.iter_info(), key=repr) == sorted(infos, key=repr)
+    assert store.load_queue() == queue
+    assert store.load_meta() == meta
+
+    store.clear_info()
+    with pytest.raises(KeyError):
+        store.get_info(1)
+    store.close()
+
+
+def test_queue_is_written_before_the_journal(data_dir, msg):
+    store = _open(msg, 'pickle')
+    showlist = {1: _show(1)}
+    store.save_list(showlist)
+
+    # Simulate a crash right after an edit: the writer is never flushed
+    # or closed, so only what reached the disk is read back
+    queue = [{'id': 1, 'action': 'update', 'my_progress': 3}]
+    store.save_queue(queue)
+    showlist[1] = _show(1, my_progress=3, queued=True)
+    store.save_list_item(showlist, showlist[1])
+
+    after_crash = _open(msg, 'pickle')
+    assert after_crash.load_list()[1]['queued']
+    assert after_crash.load_queue() == queue
+    store.writer.close()
+
+
+def test_journal_replay_after_crash(data_dir, msg):
+    store = _open(msg, 'pickle')
+    showlist = {1: _show(1), 2: _show(2)}
+    store.save_list(showlist)
+    store.save_list_item(showlist, _show(1, my_progress=5))
+    store.delete_list_item(showlist, 2)
+    store.save_list_item(showlist, _show(3))
+
+    # Crash in the middle of the last append
+    with open(store.journal_file, 'r+b') as journal:
+        journal.truncate(journal.seek(0, 2) - 3)
+
+    store = _open(msg, 'pickle')
+    assert store.load_list() == {1: _show(1, my_progress=5)}
+
+    # The replayed changes are snapshotted, so the list can be journaled again
+    assert not (data_dir / 'anime.journal').exists()
+    store.save_list_item({}, _show(4))
+    assert sorted(_open(msg, 'pickle').load_list()) == [1, 4]
+    store.close()
+
+
+def test_journal_is_compacted(data_dir, msg, monkeypatch):
+    monkeypatch.setattr(storage.PickleStorage, 'journal_limit', 3)
+    store = _open(msg, 'pickle')
+    showlist = {}
+    store.save_list(showlist)
+
+    for showid in range(1, 5):
+        showlist[showid] = _show(showid)
+        store.save_list_item(showlist, showlist[showid])
+    # The 4th change went into a new snapshot instead
+    assert not (data_dir / 'anime.journal').exists()
+    assert utils.load_data(store.cache_file) == showlist
+
+    showlist[5] = _show(5)
+    store.save_list_item(showlist, showlist[5])
+    assert (data_dir / 'anime.journal').exists()
+    store.compact(showlist)
+    assert not (data_dir / 'anime.journal').exists()
+    assert utils.load_data(store.cache_file) == showlist
+    store.close()
+
+
+def test_migrate_pickle_to_sqlite(data_dir, msg):
+    showlist = {showid: _show(showid) for showid in (3, 1, 2)}
+    infos = [{'id': 1, 'title': 'Show 1'}, {'id': 2, 'title': 'Show 2'}]
+    queue = [{'id': 1, 'action': 'update', 'my_progress': 2}]
+    meta = {'lastget': 10}
+
+    store = _open(msg, 'pickle')
+    store.save_list(showlist)
+    showlist[4] = _show(4)
+    store.save_list_item(showlist, showlist[4])
+    store.save_info(infos)
+    store.save_queue(queue)
+    store.save_meta(meta)
+    store.close()
+
+    storage.migrate(msg, USERFOLDER, 'anime', 'pickle', 'sqlite')
+
+    store = _open(msg, 'sqlite')
+    loaded = store.load_list()
+    assert loaded == showlist
+    assert list(loaded) == [3, 1, 2, 4]
+    assert sorted(store.iter_info(), key=lambda info: info['id']) == infos
+    assert store.load_queue() == queue
+    assert store.load_meta() == meta
+    store.close()
+
+
+def test_info_is_loaded_lazily(data_dir, msg):
+    info = {'id': 1, 'title': 'Show 1'}
+    # Info caches from older versions were a single pickled dict
+    utils.save_data({1: info}, str(data_dir / 'anime.info'))
+
+    store = _open(msg, 'pickle')
+    assert store.info_exists()
+    assert store.infodb is None
+
+    assert store.get_info(1) == info
+    assert not (data_dir / 'anime.info').exists()
+    store.close()
+
+    store = _open(msg, 'pickle')
+    assert store.info_exists()
+    assert store.get_info(1) == info
+    store.close()
+
+
+def test_pending_writes_are_done_on_unload(data_dir, msg):
+    from trackma.data import Data
+
+    store = _open(msg, 'pickle')
+    store.writer.delay = 3600
+    data = Data.__new__(Data)
+    data.msg = msg
+    data.config = {'autosend_at_exit': False, 'debug_disable_lock': True}
+    data.autosend_timer = None
+    data.storage = store
+    data.showlist = {1: _show(1)}
+    data.meta = {'lastget': 10}
+
+    store.save_list(data.showlist)
+    store.save_queue([{'id': 1, 'action': 'update'}])
+    data._save_meta()
+    assert not store.queue_exists() and not store.meta_exists()
+
+    data.unload()
+    assert _open(msg, 'pickle').load_queue() == [{'id': 1, 'action': 'update'}]
+    assert _open(msg, 'pickle').load_meta() == data.meta
+
+
+def test_writer_coalesces_saves(tmp_path, monkeypatch):
+    writes = []
+    write_file = utils.write_file
+    monkeypatch.setattr(utils, 'write_file',
+                        lambda contents, filename: writes.append(filename) or write_file(contents, filename))
+
+    filename = str(tmp_path / 'queue')
+    writer = utils.DataWriter(delay=3600)
+    for i in range(5):
+        writer.save_data([i], filename)
+        writer.save_data({'i': i}, str(tmp_path / 'meta'))
+    assert writes == []
+
+    writer.close()
+    assert sorted(writes) == [str(tmp_path / 'meta'), filename]
+    assert utils.load_data(filename) == [4]
+
+    writer.close()
+    assert len(writes) == 2
+
+
+def test_write_file_is_atomic(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'data')
+    utils.write_file(b'old', filename)
+
+    def failing_replace(src, dst):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(utils.os, 'replace', failing_replace)
+    with pytest.raises(OSError):
+        utils.write_file(b'new', filename)
+
+    # The old contents are kept and the temporary file is removed
+    assert open(filename, 'rb').read() == b'old'
+    assert [path.name for path in tmp_path.iterdir()] == ['data']
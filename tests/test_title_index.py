@@ -0,0 +1,127 @@
+import difflib
+import pickle
+import random
+import string
+
+from trackma.utils import TitleIndex
+
+
+def _item(showid, *titles):
+    return {'id': showid, 'title': titles[0], 'titles': list(titles)}
+
+
+SHOWS = {
+    1: _item(1, 'Naruto', 'NARUTO'),
+    2: _item(2, 'One Piece'),
+    3: _item(3, 'Shingeki no Kyojin', 'Attack on Titan'),
+    4: _item(4, 'Sword Art Online', 'SAO'),
+    5: _item(5, 'Mob Psycho 100'),
+}
+
+QUERIES = ['naruto', 'one piece', 'attack on titan', 'sword art online',
+           'mob psycho', 'shingeki', 'spy x family', 'sword art online ii']
+
+
+def _results(index):
+    return [(index.search(query) or {}).get('id') for query in QUERIES]
+
+
+def test_search():
+    index = TitleIndex(dict(SHOWS))
+    assert _results(index) == [1, 2, 3, 4, 5, None, None, 4]
+
+
+def test_update_matches_fresh_index():
+    showlist = dict(SHOWS)
+    index = TitleIndex(showlist)
+
+    showlist = dict(showlist)
+    showlist[6] = _item(6, 'Spy x Family')
+    showlist[3] = _item(3, 'Shingeki no Kyojin')
+    del showlist[2]
+    index.update(showlist, [6, 3, 2])
+
+    assert _results(index) == _results(TitleIndex(showlist))
+    assert index.search('attack on titan') is None
+    assert index.search('spy x family')['id'] == 6
+
+
+def test_update_compacts_removed_titles():
+    showlist = dict(SHOWS)
+    index = TitleIndex(showlist)
+    showlist = {1: SHOWS[1]}
+    index.update(showlist, [2, 3, 4, 5])
+
+    assert index.removed == 0
+    assert len(index.titles) == 2
+    assert _results(index) == _results(TitleIndex(showlist))
+
+
+def test_copy_leaves_original_untouched():
+    index = TitleIndex(dict(SHOWS))
+    before = _results(index)
+
+    showlist = dict(SHOWS)
+    showlist[6] = _item(6, 'Spy x Family', 'Sword Art Family')
+    del showlist[1]
+    new = index.copy()
+    new.update(showlist, [6, 1])
+
+    assert _results(index) == before
+    assert index.search('spy x family') is None
+    assert new.search('spy x family')['id'] == 6
+    assert new.search('naruto') is None
+    assert _results(new) == _results(TitleIndex(showlist))
+
+
+def test_pickle():
+    index = pickle.loads(pickle.dumps(TitleIndex(dict(SHOWS))))
+    assert _results(index) == _results(TitleIndex(dict(SHOWS)))
+
+
+def _linear_search(showlist, query):
+    # How titles were matched before the index: compare against every title
+    highest_ratio = (None, 0)
+    matcher = difflib.SequenceMatcher()
+    matcher.set_seq1(query.lower())
+    for item in showlist.values():
+        for title in item['titles']:
+            matcher.set_seq2(title.lower())
+            ratio = matcher.ratio()
+            if ratio > highest_ratio[1]:
+                highest_ratio = (item, ratio)
+
+    if highest_ratio[1] > TitleIndex.threshold:
+        return highest_ratio[0]
+
+
+def _mangle(rng, title):
+    chars = list(title)
+    for _ in range(rng.randint(0, 4)):
+        i = rng.randrange(len(chars))
+        op = rng.random()
+        if op < 0.4 and len(chars) > 1:
+            del chars[i]
+        elif op < 0.8:
+            chars.insert(i, rng.choice(string.ascii_lowercase + ' '))
+        else:
+            chars[i] = rng.choice(string.ascii_lowercase)
+    return ''.join(chars)
+
+
+def test_search_matches_linear_scan():
+    # Titles made of a few common words share many trigrams,
+    # so the best match is often not among the candidates
+    rng = random.Random(3)
+    words = [''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 8)))
+             for _ in range(30)]
+    showlist = {}
+    for showid in range(100):
+        titles = [' '.join(rng.choice(words) for _ in range(rng.randint(1, 5)))
+                  for _ in range(rng.randint(1, 3))]
+        showlist[showid] = _item(showid, *titles)
+    index = TitleIndex(showlist)
+
+    for _ in range(200):
+        query = _mangle(rng, rng.choice(rng.choice(list(showlist.values()))['titles']))
+        assert index.search(query) is _linear_search(showlist, query), query
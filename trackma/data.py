@@ -14,14 +14,117 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import collections
+import concurrent.futures
+import functools
 import os.path
 import sys
 import threading
 import time
 
+from trackma import storage
 from trackma import utils
 
 
+class Queue:
+    """
+    Update queue of the Data Handler
+
+    Keeps the queued items in insertion order while indexing them by
+    (show ID, action), so finding the pending item of a show doesn't
+    need a scan and draining the whole queue is linear.
+
+    Items being sent are held: they stay in the queue until they're
+    done, but they're no longer indexed, so changes made meanwhile are
+    queued as new items instead of being merged into them.
+
+    It's stored as a plain list of items, the same as older versions.
+
+    items: Iterable of queue items to start with
+
+    """
+
+    def __init__(self, items=()):
+        self._items = collections.deque()
+        self._index = {}
+        # Held items by their id(), and how many each show has
+        self._held = {}
+        self._held_shows = collections.Counter()
+        self.extend(items)
+
+    @staticmethod
+    def _key(item):
+        return (item['id'], item.get('action'))
+
+    def get(self, showid, action):
+        """Returns the queued item for a show and action, or None."""
+        return self._index.get((showid, action))
+
+    def has_show(self, showid):
+        """Returns True if any item of the show is queued, held ones included."""
+        return self._held_shows[showid] > 0 or \
+            any((showid, action) in self._index for action in ('add', 'update', 'delete'))
+
+    def hold(self, item):
+        """Marks a queued item as being sent."""
+        key = self._key(item)
+        if self._index.get(key) is item:
+            del self._index[key]
+        self._held[id(item)] = item
+        self._held_shows[item['id']] += 1
+
+    def _unhold(self, item):
+        if self._held.pop(id(item), None) is not None:
+            self._held_shows[item['id']] -= 1
+
+    def release(self):
+        """Makes the items still held regular queued items again."""
+        for item in self._held.values():
+            # A newer item of the same show and action keeps the place
+            self._index.setdefault(self._key(item), item)
+        self._held = {}
+        self._held_shows = collections.Counter()
+
+    def done(self, item):
+        """Removes an item once it has been sent."""
+        self._unhold(item)
+        if self._items and self._items[0] is item:
+            self._items.popleft()
+        else:
+            for position, queued in enumerate(self._items):
+                if queued is item:
+                    del self._items[position]
+                    break
+
+        key = self._key(item)
+        if self._index.get(key) is item:
+            del self._index[key]
+
+    def append(self, item):
+        self._items.append(item)
+        self._index[self._key(item)] = item
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def popleft(self):
+        """Removes and returns the oldest item, raises IndexError if empty."""
+        item = self._items.popleft()
+        self._unhold(item)
+        key = self._key(item)
+        if self._index.get(key) is item:
+            del self._index[key]
+        return item
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        # Iterate over a copy so the queue can be processed meanwhile
+        return iter(list(self._items))
+
+
 class Data:
     """
     Data Handler Class
@@ -43,10 +146,19 @@ class Data:
     api = None
     showlist = None
     infocache = dict()
-    queue = list()
+    queue = Queue()
     config = dict()
-    meta = {'lastget': 0, 'lastsend': 0, 'version': '', 'apiversion': '',
-            'altnames': {}, 'library': {}, 'library_cache': {}, }
+    meta = {'lastget': 0, 'lastfullget': 0, 'lastsend': 0, 'version': '', 'apiversion': '',
+            'altnames': {}, 'library': {}, 'library_cache': {}, 'library_index': {}, }
+
+    # Incremental retrievals can't see entries removed remotely,
+    # so we still download the full list every once in a while.
+    full_retrieve_interval = 7 * 86400
+    # Ask for changes a bit before the last retrieval in case
+    # the server clock differs from ours.
+    retrieve_margin = 300
+    # Shows whose details are refreshed on every incremental retrieval
+    refresh_statuses = (utils.Status.AIRING, utils.Status.NOTYET)
 
     autosend_timer = None
 
@@ -61,6 +173,8 @@ class Data:
         self.msg = messenger.with_classname(self.name)
         self.config = config
         self.msg.info("Initializing...")
+        self.infocache = dict()
+        self.queue = Queue()
 
         # Get filenames
         userfolder = "%s.%s" % (account['username'], account['api'])
@@ -94,13 +208,12 @@ class Data:
         self.msg.info("Using %s (%s)" % (libname, mediatype))
 
         # Get filenames
-        self.queue_file = utils.to_data_path(
-            userfolder, '%s.queue' % mediatype)
-        self.info_file = utils.to_data_path(userfolder,  '%s.info' % mediatype)
-        self.cache_file = utils.to_data_path(userfolder, '%s.list' % mediatype)
-        self.meta_file = utils.to_data_path(userfolder, '%s.meta' % mediatype)
         self.lock_file = utils.to_data_path(userfolder,  'lock')
 
+        # Open the storage backend
+        storageclass = storage.get_storage_class(self.msg, self.config['data_backend'])
+        self.storage = storageclass(self.msg, userfolder, mediatype)
+
         # Connect signals
         self.api.connect_signal('show_info_changed', self.info_update)
         self.api.connect_signal('userconfig_changed', self.userconfig_update)
@@ -126,6 +239,7 @@ class Data:
     def set_message_handler(self, message_handler):
         self.msg = message_handler.with_classname(self.name)
         self.api.set_message_handler(self.msg)
+        self.storage.set_message_handler(self.msg)
 
     def start(self):
         """
@@ -147,9 +261,10 @@ class Data:
             self._load_queue()
             self._emit_signal('queue_changed', self.queue)
 
-        if self._info_exists() and self.meta.get('version') == self.version and self.meta.get('apiversion') == self.api_version:
-            # Load info cache only if we're on the same database version
-            self._load_info()
+        if self._info_exists() and (self.meta.get('version') != self.version or self.meta.get('apiversion') != self.api_version):
+            # Keep the info cache only if we're on the same database version;
+            # otherwise its records are read on demand by _info_lookup
+            self._clear_info()
 
         # If there is a list cache, load from it
         # otherwise query the API for a remote list
@@ -167,7 +282,7 @@ class Data:
                     # Make sure we process the queue first before overwriting the list
                     # We don't want users losing their changes
                     self.process_queue()
-                    self.download_data()
+                    self.download_data(incremental=True)
                 except utils.APIError as e:
                     self.msg.warn("Couldn't download list! Using cache.")
                     self._load_cache()
@@ -206,8 +321,12 @@ class Data:
             if self.config['autosend_at_exit']:
                 self.process_queue()
 
+            if self.showlist is not None:
+                self.storage.compact(self.showlist)
+
             self._save_meta()
 
+        self.storage.close()
         self._unlock()
 
     def get(self):
@@ -242,22 +361,19 @@ class Data:
         self.showlist[showid] = show
 
         # Check if the show add is already in queue
-        exists = False
-        for q in self.queue:
-            if q['id'] == showid and q['action'] == 'add':
-                # This shouldn't happen
-                raise utils.DataError("Show already in the queue.")
-
-        if not exists:
-            # Use the whole show as a queue item
-            item = show
-            item['action'] = 'add'
-            self.queue.append(item)
+        if self.queue.get(showid, 'add'):
+            # This shouldn't happen
+            raise utils.DataError("Show already in the queue.")
+
+        # Use the whole show as a queue item
+        item = show
+        item['action'] = 'add'
+        self.queue.append(item)
 
         show['queued'] = True
 
         self._save_queue()
-        self._save_cache()
+        self._save_cache_item(show)
         self._emit_signal('queue_changed', self.queue)
         self.msg.info("Queued add for %s" % show['title'])
 
@@ -279,15 +395,11 @@ class Data:
         show[key] = value
 
         # Check if the show update is already in queue
-        exists = False
-        for q in self.queue:
-            if q['id'] == show['id'] and q['action'] in ['add', 'update']:
-                # Add the changed value to the already existing queue item
-                q[key] = value
-                exists = True
-                break
-
-        if not exists:
+        q = self.queue.get(show['id'], 'add') or self.queue.get(show['id'], 'update')
+        if q:
+            # Add the changed value to the already existing queue item
+            q[key] = value
+        else:
             # Create queue item and append it
             item = {'id': show['id'],
                     'my_id': show['my_id'],
@@ -300,7 +412,7 @@ class Data:
         show['queued'] = True
 
         self._save_queue()
-        self._save_cache()
+        self._save_cache_item(show)
         self._emit_signal('queue_changed', self.queue)
         self.msg.info("Queued update for %s" % show['title'])
         self.msg.debug("Queued: {} -> {}".format(key, value))
@@ -327,29 +439,26 @@ class Data:
 
         item = self.showlist.pop(showid)
 
-        # Check if the show add is already in queue
-        exists = False
-        for q in self.queue:
-            if q['id'] == showid and q['action'] == 'delete':
-                # This shouldn't happen
-                raise utils.DataError("Show delete already in the queue.")
-
-        if not exists:
-            # Use the whole show as a queue item
-            item['action'] = 'delete'
-            self.queue.append(item)
+        # Check if the show delete is already in queue
+        if self.queue.get(showid, 'delete'):
+            # This shouldn't happen
+            raise utils.DataError("Show delete already in the queue.")
+
+        # Use the whole show as a queue item
+        item['action'] = 'delete'
+        self.queue.append(item)
 
         show['queued'] = True
 
         self._save_queue()
-        self._save_cache()
+        self._delete_cache_item(showid)
         self._emit_signal('queue_changed', self.queue)
         self.msg.info("Queued delete for %s" % item['title'])
 
     def queue_clear(self):
         """Clears the queue completely."""
         if self.queue:
-            self.queue = []
+            self.queue = Queue()
             self._save_queue()
             self._emit_signal('queue_changed', self.queue)
             self.msg.info("Cleared queue.")
@@ -370,76 +479,155 @@ class Data:
             if not self.showlist:
                 self._load_cache()
 
-            # Check log-in TODO
-            # try:
-            #    self.api.check_credentials()
-            # except utils.APIError as e:
-            #    raise utils.DataError("Can't process queue, will leave unsynced. Reason: %s" % e)
-
             # Run through queue
             items_processed = []
             items_failed = []
-            while True:
-                try:
-                    item = self.queue.pop(0)
-                except IndexError:
-                    break
-
-                showid = item['id']
-
-                try:
-                    show = self.showlist[showid]
-                except KeyError:
-                    show = None
-
-                try:
-                    # Call the API to do the requested operation
-                    operation = item.get('action')
-                    if operation == 'add':
-                        my_id = self.api.add_show(item)
-
-                        if my_id:
-                            show['my_id'] = my_id
-                    elif operation == 'update':
-                        my_last_update = self.api.update_show(item)
-                        
-                        if my_last_update:
-                            show['my_last_update'] = my_last_update
-                    elif operation == 'delete':
-                        self.api.delete_show(item)
-                    else:
-                        self.msg.warn("Unknown operation in queue (%s), skipping..." % repr(operation))
-
-                    if self.showlist.get(showid):
-                        self.showlist[showid]['queued'] = False
-                        self._emit_signal('show_synced', show, item)
-
-                    items_processed.append((show, item))
-                    self._emit_signal('queue_changed', self.queue)
-                except utils.APIError as e:
-                    self.msg.warn("Can't process %s, will leave unsynced." % item['title'])
-                    self.msg.debug("Info: %s" % e)
-                    items_failed.append(item)
-                except NotImplementedError:
-                    self.msg.warn("Operation not implemented in API. Skipping...")
-                    items_failed.append(item)
-                # except TypeError:
-                #    self.msg.warn("%s not in list, unexpected. Not changing queued status." % showid)
-
-            if items_failed:
-                self.queue += items_failed
+            try:
+                for item, send in self._dispatch_queue():
+                    showid = item['id']
+
+                    try:
+                        show = self.showlist[showid]
+                    except KeyError:
+                        show = None
+
+                    try:
+                        # Wait for the API to do the requested operation
+                        operation = item.get('action')
+                        result = send()
+
+                        if result and operation == 'add':
+                            show['my_id'] = result
+                        elif result and operation == 'update':
+                            show['my_last_update'] = result
+
+                        if self.showlist.get(showid) and not self.queue.has_show(showid):
+                            self.showlist[showid]['queued'] = False
+                            self._emit_signal('show_synced', show, item)
+
+                        items_processed.append((show, item))
+                        self._emit_signal('queue_changed', self.queue)
+                    except utils.APIError as e:
+                        self.msg.warn("Can't process %s, will leave unsynced." % item['title'])
+                        self.msg.debug("Info: %s" % e)
+                        items_failed.append(item)
+                    except NotImplementedError:
+                        self.msg.warn("Operation not implemented in API. Skipping...")
+                        items_failed.append(item)
+                    # except TypeError:
+                    #    self.msg.warn("%s not in list, unexpected. Not changing queued status." % showid)
+            finally:
+                # Failed items go back to the queue even if something else stops us
+                if items_failed:
+                    self.queue.extend(items_failed)
 
             self.api.logout()
-            self._save_cache()
+            for show, item in items_processed:
+                if show and show['id'] in self.showlist:
+                    self._save_cache_item(show)
             self._save_queue()
             self._emit_signal('sync_complete', items_processed)
 
         self.meta['lastsend'] = time.time()
 
+    def _dispatch_queue(self):
+        """
+        Yields every item in the queue in order, along with a function
+        that returns the result of its API call.
+
+        Items are held in the queue while they're sent, and only removed
+        once their call returns or fails with an APIError, which the caller
+        queues again; anything else leaves them in the queue.
+        Items queued meanwhile are left for the next time.
+
+        If the API can handle more than one request at a time, the calls
+        are sent ahead through a pool of up to :attr:`api.queue_workers`
+        threads, but items are still yielded in queue order. Only items
+        of different shows are sent at the same time; the ones of a single
+        show are sent one after the other, in the order they were queued.
+        """
+        queue = self.queue
+        items = list(queue)
+        workers = min(self.api.queue_workers, len(items))
+
+        if workers > 1:
+            # Log in once now so the workers don't race to do it
+            try:
+                self.api.check_credentials()
+            except utils.APIError as e:
+                # Let every item fail by itself like the serial path does
+                self.msg.debug("Can't log in, sending queue serially: %s" % e)
+                workers = 1
+
+        for item in items:
+            queue.hold(item)
+
+        try:
+            if workers > 1:
+                pending = []
+                shows = collections.OrderedDict()
+                for item in items:
+                    future = concurrent.futures.Future()
+                    pending.append((item, future))
+                    shows.setdefault(item['id'], []).append((item, future))
+
+                workers = min(workers, len(shows))
+                self.msg.debug("Sending %d items with %d workers." % (len(items), workers))
+                stop = threading.Event()
+                with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                    try:
+                        for show_items in shows.values():
+                            executor.submit(self._send_items, show_items, stop)
+                        for item, future in pending:
+                            yield item, functools.partial(self._send_queued, queue, item, future.result)
+                    finally:
+                        # Don't send what's left if we're interrupted
+                        stop.set()
+            else:
+                for item in items:
+                    yield item, functools.partial(self._send_queued, queue, item,
+                                                  functools.partial(self._send_item, item))
+        finally:
+            queue.release()
+
+    def _send_queued(self, queue, item, send):
+        """Returns the result of **send**, removing **item** from the queue if it's done."""
+        try:
+            result = send()
+        except (utils.APIError, NotImplementedError):
+            queue.done(item)
+            raise
+
+        queue.done(item)
+        return result
+
+    def _send_items(self, items, stop):
+        """Sends the (item, future) pairs in order, setting each future to its result."""
+        for item, future in items:
+            if stop.is_set():
+                future.cancel()
+                continue
+
+            try:
+                future.set_result(self._send_item(item))
+            except Exception as e:
+                future.set_exception(e)
+
+    def _send_item(self, item):
+        """Calls the API to do the operation of a queued item and returns its result."""
+        operation = item.get('action')
+        if operation == 'add':
+            return self.api.add_show(item)
+        elif operation == 'update':
+            return self.api.update_show(item)
+        elif operation == 'delete':
+            return self.api.delete_show(item)
+        else:
+            self.msg.warn("Unknown operation in queue (%s), skipping..." % repr(operation))
+
     def info_get(self, show):
         try:
-            showid = show['id']
-            return self.infocache[showid]
+            return self._info_lookup(show['id'])
         except KeyError:
             return self.api.request_info([show])[0]
 
@@ -448,7 +636,7 @@ class Data:
             showid = show['id']
             self.infocache[showid] = show
 
-        self._save_info()
+        self._save_info(shows)
 
     def userconfig_update(self):
         self._save_userconfig()
@@ -478,6 +666,12 @@ class Data:
     def library_cache_save(self, library_cache):
         self.meta['library_cache'] = library_cache
 
+    def library_index_get(self):
+        return self.meta['library_index']
+
+    def library_index_save(self, library_index):
+        self.meta['library_index'] = library_index
+
     def get_show_attr(self, show, key):
         return show.get(key)
 
@@ -504,20 +698,33 @@ class Data:
             self.autosend_timer.start()
 
     def _load_cache(self):
-        self.msg.debug("Reading cache...")
-        self.showlist = utils.load_data(self.cache_file)
+        self.showlist = self.storage.load_list()
 
     def _save_cache(self):
-        self.msg.debug("Saving cache...")
-        utils.save_data(self.showlist, self.cache_file)
+        self.storage.save_list(self.showlist)
+
+    def _save_cache_item(self, show):
+        self.storage.save_list_item(self.showlist, show)
 
-    def _load_info(self):
-        self.msg.debug("Reading info DB...")
-        self.infocache = utils.load_data(self.info_file)
+    def _delete_cache_item(self, showid):
+        self.storage.delete_list_item(self.showlist, showid)
 
-    def _save_info(self):
-        self.msg.debug("Saving info DB...")
-        utils.save_data(self.infocache, self.info_file)
+    def _info_lookup(self, showid):
+        """Returns the info record of a show, reading it from storage
+        the first time it's needed. Raises KeyError if it's missing."""
+        try:
+            return self.infocache[showid]
+        except KeyError:
+            info = self.storage.get_info(showid)
+            self.infocache[showid] = info
+            return info
+
+    def _save_info(self, infos):
+        self.storage.save_info(infos)
+
+    def _clear_info(self):
+        self.infocache = dict()
+        self.storage.clear_info()
 
     def _load_userconfig(self):
         self.msg.debug("Reading userconfig...")
@@ -529,31 +736,59 @@ class Data:
         utils.save_config(self.userconfig, self.userconfig_file)
 
     def _load_queue(self):
-        self.msg.debug("Reading queue...")
-        self.queue = utils.load_data(self.queue_file)
+        self.queue = Queue(self.storage.load_queue())
 
     def _save_queue(self):
-        self.msg.debug("Saving queue...")
-        utils.save_data(self.queue, self.queue_file)
+        self.storage.save_queue(list(self.queue))
 
     def _load_meta(self):
-        self.msg.debug("Reading metadata...")
-        loadedmeta = utils.load_data(self.meta_file)
+        loadedmeta = self.storage.load_meta()
         self.meta.update(loadedmeta)
 
     def _save_meta(self):
-        self.msg.debug("Saving metadata...")
-        utils.save_data(self.meta, self.meta_file)
+        self.storage.save_meta(self.meta)
+
+    def download_data(self, incremental=False):
+        """
+        Downloads the remote list and overwrites the cache
 
-    def download_data(self):
-        """Downloads the remote list and overwrites the cache"""
-        self.showlist = self.api.fetch_list()
+        If **incremental** is set, only the entries that changed since the
+        last retrieval are requested and merged into the current list.
+        The full list is downloaded instead if the API doesn't support it,
+        or if the last full retrieval is too old.
+
+        """
+        changes = None
+        if incremental and time.time() - self.meta['lastfullget'] < self.full_retrieve_interval:
+            if not self.showlist:
+                self._load_cache()
+
+            try:
+                changes = self.api.fetch_list_since(self.meta['lastget'] - self.retrieve_margin)
+                self.msg.debug("Got %d changed entries." % len(changes))
+
+                # The details of airing shows (total, next episode, status)
+                # change without the user touching their entries
+                airing = [showid for (showid, show) in self.showlist.items()
+                          if show['status'] in self.refresh_statuses and showid not in changes]
+                if airing:
+                    changes.update(self.api.fetch_list_items(airing))
+                    self.msg.debug("Refreshed %d airing entries." % len(airing))
+            except NotImplementedError:
+                changes = None
+                self.msg.debug("API can't retrieve list changes; downloading full list.")
+
+        if changes is None:
+            self.showlist = self.api.fetch_list()
+            changes = self.showlist
+        else:
+            self.showlist.update(changes)
 
         if self.api.api_info['merge']:
             # The API needs information to be merged from the
             # info database
             missing = []
-            for show in self.showlist.values():
+            for show in changes.values():
                 # Here we search the information in the local
                 # info database. If it isn't available, add it
                 # to the missing list for them to be requested
@@ -561,7 +796,7 @@ class Data:
                 showid = show['id']
 
                 try:
-                    info = self.infocache[showid]
+                    info = self._info_lookup(showid)
                 except KeyError:
                     missing.append(show)
                     continue
@@ -576,7 +811,12 @@ class Data:
                     showid = info['id']
                     self.api.merge(self.showlist[showid], info)
 
-        self._save_cache()
+        if changes is self.showlist:
+            self._save_cache()
+            self.meta['lastfullget'] = time.time()
+        else:
+            for show in changes.values():
+                self._save_cache_item(show)
         self.api.logout()
 
         # Update last retrieved time
@@ -586,16 +826,16 @@ class Data:
         self._save_meta()
 
     def _cache_exists(self):
-        return os.path.isfile(self.cache_file)
+        return self.storage.list_exists()
 
     def _info_exists(self):
-        return os.path.isfile(self.info_file)
+        return self.storage.info_exists()
 
     def _queue_exists(self):
-        return os.path.isfile(self.queue_file)
+        return self.storage.queue_exists()
 
     def _meta_exists(self):
-        return os.path.isfile(self.meta_file)
+        return self.storage.meta_exists()
 
     def _lock(self):
         """Creates the database lock, returns an exception if it
@@ -14,6 +14,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import concurrent.futures
 import datetime
 import os
 import random
@@ -21,6 +22,7 @@ import re
 import shlex
 import shutil
 import sys
+import threading
 import time
 from decimal import Decimal
 from functools import lru_cache, partial
@@ -28,9 +30,59 @@ from pathlib import Path
 
 from trackma import data
 from trackma import messenger
+from trackma import parser
 from trackma import utils
 from trackma.extras import redirections
 from trackma.parser import get_parser_class
+from trackma.parser.cache import ParseCache
+
+
+def _match_library_file(anime_info, redirections, tracker_list, guess_show):
+    """
+    Looks for the show of a parsed file in the tracker list.
+
+    Returns the parsed title along with the library cache entry for the file,
+    which is None if the file couldn't be recognized or matched to any show.
+    The entry is a (show_id, episode) tuple, where episode may also be an
+    (ep_start, ep_end) range, or a list of them if a range of episodes
+    got redirected to several shows.
+    """
+    show_title = anime_info.getName()
+    (show_ep_start, show_ep_end) = anime_info.getEpisodeNumbers(True)
+    if not show_title:
+        return (None, None)
+
+    show = guess_show(show_title)
+    if not show:
+        return (show_title, None)
+
+    if show_ep_start == show_ep_end:
+        (show, show_ep) = utils.redirect_show(
+            (show, show_ep_start), redirections, tracker_list)
+        return (show_title, (show['id'], show_ep))
+
+    entries = [(part_show['id'], part_eps) for (part_show, part_eps) in utils.redirect_show_range(
+        (show, (show_ep_start, show_ep_end)), redirections, tracker_list)]
+    if len(entries) == 1:
+        return (show_title, entries[0])
+    return (show_title, entries)
+
+
+# State of the library scan worker processes, see _init_scan_worker
+_scan_context = None
+
+
+def _init_scan_worker(parser_class, redirections, tracker_list):
+    global _scan_context
+    guess_show = lru_cache(partial(utils.guess_show, tracker_list=tracker_list))
+    _scan_context = (parser_class, messenger.Messenger(None, 'Engine'),
+                     redirections, tracker_list, guess_show)
+
+
+def _scan_worker(filenames):
+    (parser_class, msg, redirections, tracker_list, guess_show) = _scan_context
+    return [(anime_info,) + _match_library_file(anime_info, redirections, tracker_list, guess_show)
+            for anime_info in parser.parse_batch(parser_class, msg, filenames)]
 
 
 class Engine:
@@ -52,7 +104,9 @@ class Engine:
     """
     data_handler = None
     tracker = None
+    library_watcher = None
     redirections = None
+    parse_cache = None
     config = {}
     msg = None
     loaded = False
@@ -61,6 +115,12 @@ class Engine:
 
     name = 'Engine'
 
+    # Number of files sent at once to each library scan process
+    scan_chunk_size = 64
+
+    # Signals after which the show passed to them is updated in the tracker lists
+    tracker_list_signals = ('show_added', 'show_deleted', 'episode_changed', 'status_changed')
+
     signals = {'show_added':        None,
                'show_deleted':      None,
                'episode_changed':   None,
@@ -85,6 +145,7 @@ class Engine:
             account = accounts.AccountManager().get_account(accountnum)
 
         # Initialize
+        self._tracker_list_lock = threading.Lock()
         self._load(account)
         self._init_data_handler()
 
@@ -118,6 +179,8 @@ class Engine:
             self.config['searchdir']) if self._searchdir_exists(path)]
 
     def _init_data_handler(self, mediatype=None):
+        self._invalidate_tracker_list()
+
         # Create data handler
         self.data_handler = data.Data(
             self.msg, self.config, self.account, mediatype)
@@ -140,10 +203,33 @@ class Engine:
         self._emit_signal('queue_changed', queue)
 
     def _tracker_detected(self, path, filename):
-        self.add_to_library(path, filename)
+        self._library_events.add(('detected', path, filename))
 
     def _tracker_removed(self, path, filename):
-        self.remove_from_library(path, filename)
+        self._library_events.add(('removed', path, filename))
+
+    def _apply_library_events(self, events):
+        # Only the last event of each file matters
+        changes = {}
+        for (signal, path, filename) in events:
+            changes.pop((path, filename), None)
+            changes[(path, filename)] = signal
+
+        self.msg.debug("Updating library with %d file events." % len(changes))
+        library = self.data_handler.library_get()
+        library_cache = self.data_handler.library_cache_get()
+        tracker_list = self._get_tracker_list()
+        guess_show = lru_cache(partial(utils.guess_show, tracker_list=tracker_list))
+
+        for ((path, filename), signal) in changes.items():
+            if signal == 'detected':
+                self._add_show_to_library(
+                    library, library_cache, False, path+"/"+filename, filename, tracker_list, guess_show)
+            else:
+                self._remove_show_from_library(library, library_cache, path+"/"+filename, filename)
+
+        self.data_handler.library_save(library)
+        self.data_handler.library_cache_save(library_cache)
 
     def _tracker_playing(self, showid, playing, episode):
         show = self.get_show_info(showid)
@@ -167,6 +253,9 @@ class Engine:
         self._emit_signal('tracker_state', status)
 
     def _emit_signal(self, signal, *args):
+        if signal in self.tracker_list_signals:
+            self._invalidate_tracker_show(args[0]['id'])
+
         try:
             # Call the signal function
             if self.signals[signal]:
@@ -187,21 +276,34 @@ class Engine:
                         module.__name__, signal, err))
 
     def _get_tracker_list(self, filter_num=None):
-        tracker_list = {}
+        # Tracker lists are cached along with the version they were made at,
+        # and only the shows that changed since then are updated in them,
+        # see _invalidate_tracker_show
+        key = tuple(filter_num) if isinstance(filter_num, list) else filter_num
+        with self._tracker_list_lock:
+            if key in self._tracker_lists:
+                (version, tracker_list) = self._tracker_lists[key]
+                if version < self._tracker_list_version:
+                    tracker_list = self._patch_tracker_list(filter_num, version, tracker_list)
+            else:
+                tracker_list = self._build_tracker_list(filter_num)
+
+            self._tracker_lists[key] = (self._tracker_list_version, tracker_list)
+            return tracker_list
+
+    def _tracker_list_statuses(self, filter_num):
+        # Statuses of the shows in a tracker list, None means all of them
         if isinstance(filter_num, type(None)):
-            source_list = self.get_list()
+            return None
         elif isinstance(filter_num, list):
-            status_list = [s for s in filter_num if s is not self.mediainfo['statuses_finish']]
-            status_list_display = [self.mediainfo['statuses_dict'][s] for s in status_list]
-            self.msg.debug(f"Scanning for {', '.join(status_list_display)}")
-            source_list = []
-            for status in status_list:
-                source_list.extend(self.filter_list(status))
+            return [s for s in filter_num if s is not self.mediainfo['statuses_finish']]
         else:
-            source_list = self.filter_list(filter_num)
+            return [filter_num]
 
-        for show in source_list:
-            tracker_list[show['id']] = {
+    def _tracker_item(self, show):
+        item = self._tracker_items.get(show['id'])
+        if item is None:
+            item = self._tracker_items[show['id']] = {
                 'id': show['id'],
                 'title': show['title'],
                 'my_progress': show['my_progress'],
@@ -209,9 +311,66 @@ class Engine:
                 'type': None,
                 'titles': self.data_handler.get_show_titles(show),
             }
+        return item
+
+    def _build_tracker_list(self, filter_num):
+        statuses = self._tracker_list_statuses(filter_num)
+        if statuses is None:
+            source_list = self.get_list()
+        else:
+            if isinstance(filter_num, list):
+                status_list_display = [self.mediainfo['statuses_dict'][s] for s in statuses]
+                self.msg.debug(f"Scanning for {', '.join(status_list_display)}")
+            source_list = []
+            for status in statuses:
+                source_list.extend(self.filter_list(status))
 
+        tracker_list = {show['id']: self._tracker_item(show) for show in source_list}
         altnames_map = self.data_handler.get_altnames_map()
-        return (tracker_list, altnames_map)
+        return (tracker_list, altnames_map, utils.TitleIndex(tracker_list))
+
+    def _patch_tracker_list(self, filter_num, version, tracker_list):
+        # The old list and its index are left as they are, since they may still be in use
+        (showlist, altnames_map, index) = tracker_list
+
+        changed = [showid for (showid, changed_version) in self._tracker_changes.items()
+                   if changed_version > version]
+        if changed:
+            statuses = self._tracker_list_statuses(filter_num)
+            source = self.data_handler.get()
+            showlist = dict(showlist)
+            for showid in changed:
+                show = source.get(showid)
+                if show and (statuses is None or show['my_status'] in statuses):
+                    showlist[showid] = self._tracker_item(show)
+                else:
+                    showlist.pop(showid, None)
+            index = index.copy()
+            index.update(showlist, changed)
+
+        if self._altnames_version > version:
+            altnames_map = self.data_handler.get_altnames_map()
+
+        return (showlist, altnames_map, index)
+
+    def _invalidate_tracker_list(self):
+        with self._tracker_list_lock:
+            self._tracker_lists = {}
+            self._tracker_items = {}
+            self._tracker_changes = {}
+            self._tracker_list_version = 0
+            self._altnames_version = 0
+
+    def _invalidate_tracker_show(self, showid):
+        with self._tracker_list_lock:
+            self._tracker_list_version += 1
+            self._tracker_changes[showid] = self._tracker_list_version
+            self._tracker_items.pop(showid, None)
+
+    def _invalidate_tracker_altnames(self):
+        with self._tracker_list_lock:
+            self._tracker_list_version += 1
+            self._altnames_version = self._tracker_list_version
 
     def _update_tracker(self):
         if self.tracker:
@@ -221,9 +380,14 @@ class Engine:
         # If the engine wasn't closed for whatever reason, do it
         if self.loaded:
             self.msg.info("Forcing exit...")
-            self.data_handler.unload(True)
             if self.tracker:
                 self.tracker.disable()
+            if self.library_watcher:
+                self.library_watcher.disable()
+                self.library_watcher = None
+            self._library_events.flush()
+            self.data_handler.unload(True)
+            self.parse_cache.close()
             self.loaded = False
 
     def connect_signal(self, signal, callback):
@@ -286,9 +450,10 @@ class Engine:
                 fname = utils.DATADIR + '/anime-relations/anime-relations.txt'
 
             self.msg.info("Parsing redirection file...")
+            utils.make_dir(utils.to_cache_path())
             try:
-                self.redirections = redirections.parse_anime_relations(
-                    fname, api)
+                self.redirections = redirections.load_anime_relations(
+                    fname, api, utils.to_cache_path('anime-relations-%s.pickle' % api))
             except Exception as e:
                 self.msg.warn("Error parsing anime-relations.txt!")
                 self.msg.debug("{}".format(e))
@@ -303,6 +468,14 @@ class Engine:
             self.msg.warn(self.name, "Falling back to aie...")
             self.parser_class = get_parser_class(self.msg, "aie")
 
+        # Parse results are kept on disk for every account
+        utils.make_dir(utils.to_cache_path())
+        self.parse_cache = ParseCache(self.msg, utils.to_cache_path('parser.db'))
+
+        # Files found or removed by the tracker are added to the library in batches
+        self._library_events = utils.EventBatcher(
+            self.config['library_event_delay'], self._apply_library_events)
+
         # Rescan library if necessary
         if self.config['library_autoscan']:
             try:
@@ -360,6 +533,17 @@ class Engine:
                     self.config['tracker_type']))
                 self.msg.exception(sys.exc_info())
 
+        # Watch the library for changes unless the tracker already does
+        if self.mediainfo.get('can_play') and self.config['library_watch'] and self.searchdirs \
+                and not (self.tracker and self.tracker.watches_library):
+            from trackma.tracker.library import LibraryWatcher
+            self.msg.debug("Initializing library watcher...")
+            self.library_watcher = LibraryWatcher(
+                self.msg, self.searchdirs, self.config['library_watch_interval'],
+                self.data_handler.library_index_get())
+            self.library_watcher.connect_signal('detected', self._tracker_detected)
+            self.library_watcher.connect_signal('removed', self._tracker_removed)
+
         self.loaded = True
         self.msg.debug("Engine started")
         return True
@@ -374,9 +558,14 @@ class Engine:
         """
         if self.loaded:
             self.msg.info("Unloading...")
-            self.data_handler.unload()
             if self.tracker:
                 self.tracker.disable()
+            if self.library_watcher:
+                self.library_watcher.disable()
+                self.library_watcher = None
+            self._library_events.flush()
+            self.data_handler.unload()
+            self.parse_cache.close()
 
             # If there are loaded hooks, unload them
             self.msg.info("Unloading user hooks...")
@@ -455,7 +644,7 @@ class Engine:
             # Guess show by filename
             self.msg.debug("Guessing by filename.")
 
-            anime_info = self.parser_class(self.msg, filename)
+            anime_info = parser.parse(self.parser_class, self.msg, filename, self.parse_cache)
             (show_title, ep) = anime_info.getName(), anime_info.getEpisode()
             self.msg.debug("Show guess: {}".format(show_title))
 
@@ -538,12 +727,12 @@ class Engine:
         # Add in data handler
         self.data_handler.queue_add(show)
 
-        # Update the tracker with the new information
-        self._update_tracker()
-
         # Emit signal
         self._emit_signal('show_added', show)
 
+        # Update the tracker with the new information
+        self._update_tracker()
+
     def set_episode(self, showid, newep):
         """
         Updates the progress of the specified **showid** to **newep**
@@ -769,12 +958,12 @@ class Engine:
         # Add in data handler
         self.data_handler.queue_delete(show)
 
-        # Update the tracker with the new information
-        self._update_tracker()
-
         # Emit signal
         self._emit_signal('show_deleted', show)
 
+        # Update the tracker with the new information
+        self._update_tracker()
+
     def library(self):
         return self.data_handler.library_get()
 
@@ -789,6 +978,7 @@ class Engine:
         t = time.time()
         library = {}
         library_cache = self.data_handler.library_cache_get()
+        library_index = self.data_handler.library_index_get()
 
         if not my_status:
             if self.config['scan_whole_list']:
@@ -805,35 +995,147 @@ class Engine:
         tracker_list = self._get_tracker_list(my_status)
         guess_show = lru_cache(partial(utils.guess_show, tracker_list=tracker_list))
 
-        paths = [path] if path else self.searchdirs
-        for searchdir in paths:
-            self.msg.debug("Directory: %s" % searchdir)
+        # Parse and match the files in other processes if requested
+        executor = None
+        processes = self.config['library_scan_processes'] or os.cpu_count()
+        if processes > 1:
+            self.msg.debug("Scanning with %d processes." % processes)
+            executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=processes, initializer=_init_scan_worker,
+                initargs=(self.parser_class, self.redirections, tracker_list))
 
-            # Do a full listing of the media directory
-            for fullpath, filename in utils.regex_find_videos(searchdir):
-                if self.config['library_full_path']:
-                    filename = self._get_relative_path_or_basename(searchdir, fullpath)
-                (library, library_cache) = self._add_show_to_library(
-                    library, library_cache, rescan, fullpath, filename, tracker_list, guess_show)
+        # Files found in the whole library, to prune the parse cache afterwards
+        found = None if path else set()
 
-            self.msg.debug(f"Time: {time.time() - t:.3}s")
-            self.data_handler.library_save(library)
-            self.data_handler.library_cache_save(library_cache)
+        try:
+            paths = [path] if path else self.searchdirs
+            for searchdir in paths:
+                self.msg.debug("Directory: %s" % searchdir)
+
+                # List the media directory, only reading again
+                # the subdirectories that changed since the last scan
+                files = self._find_library_files(searchdir, library_index, rescan, found)
+                if executor:
+                    self._add_files_to_library(
+                        executor, library, library_cache, rescan, files, tracker_list, guess_show)
+                else:
+                    files = list(files)
+                    parsed = self._parse_library_files(files, library_cache, rescan)
+                    for fullpath, filename in files:
+                        (library, library_cache) = self._add_show_to_library(
+                            library, library_cache, rescan, fullpath, filename, tracker_list, guess_show,
+                            parsed.get(filename))
+
+                self.msg.debug(f"Time: {time.time() - t:.3}s")
+                self.data_handler.library_save(library)
+                self.data_handler.library_cache_save(library_cache)
+                self.data_handler.library_index_save(library_index)
+        finally:
+            if executor:
+                executor.shutdown()
+
+        if found is not None:
+            self.parse_cache.prune(self.parser_class, found)
         return library
 
+    def _find_library_files(self, searchdir, library_index, rescan, found=None):
+        for fullpath, filename in utils.find_videos_indexed(searchdir, library_index, rescan):
+            if self.config['library_full_path']:
+                filename = self._get_relative_path_or_basename(searchdir, fullpath)
+            if found is not None:
+                found.add(filename)
+            yield (fullpath, filename)
+
+    def _add_files_to_library(self, executor, library, library_cache, rescan, files, tracker_list, guess_show):
+        """
+        Adds **files** to the library, sending the ones that need to be
+        parsed to the process pool in **executor** in chunks as they're found.
+
+        Results are merged back in the order the files were found,
+        so the library ends up exactly as a serial scan would leave it.
+        """
+        found = []
+        futures = []
+        submitted = {}
+        parsed = {}
+        chunk = []
+
+        for fullpath, filename in files:
+            found.append((fullpath, filename))
+
+            if (rescan or filename not in library_cache) and \
+                    filename not in submitted and filename not in parsed:
+                # Files parsed before (maybe for another account)
+                # only need to be matched, so we do it here
+                anime_info = self.parse_cache.get(self.parser_class, filename)
+                if anime_info:
+                    parsed[filename] = anime_info
+                    continue
+
+                submitted[filename] = (len(futures), len(chunk))
+                chunk.append(filename)
+                if len(chunk) == self.scan_chunk_size:
+                    futures.append(executor.submit(_scan_worker, chunk))
+                    chunk = []
+        if chunk:
+            futures.append(executor.submit(_scan_worker, chunk))
+
+        for fullpath, filename in found:
+            # A serial scan only matches a repeated filename
+            # again if we're rescanning
+            if filename in parsed:
+                anime_info = parsed[filename] if rescan else parsed.pop(filename)
+                (show_title, entry) = _match_library_file(
+                    anime_info, self.redirections, tracker_list, guess_show)
+                self._cache_library_file(library_cache, fullpath, filename, show_title, entry, tracker_list)
+            elif filename in submitted:
+                (future, position) = submitted[filename] if rescan else submitted.pop(filename)
+                (anime_info, show_title, entry) = futures[future].result()[position]
+                self.parse_cache.put(self.parser_class, filename, anime_info)
+                self._cache_library_file(library_cache, fullpath, filename, show_title, entry, tracker_list)
+
+            self._add_library_entry(library, library_cache[filename], fullpath)
+
+    def _parse_library_files(self, files, library_cache, rescan):
+        """
+        Returns the ParseResult of every file in **files** that needs
+        to be matched, parsing the ones that aren't in the parse cache
+        together through the parser's batch API.
+        """
+        parsed = {}
+        pending = []
+        for _, filename in files:
+            if (rescan or filename not in library_cache) and filename not in parsed:
+                parsed[filename] = self.parse_cache.get(self.parser_class, filename)
+                if parsed[filename] is None:
+                    pending.append(filename)
+
+        if pending:
+            self.msg.debug("Parsing %d files." % len(pending))
+            for filename, anime_info in zip(pending, parser.parse_batch(self.parser_class, self.msg, pending)):
+                self.parse_cache.put(self.parser_class, filename, anime_info)
+                parsed[filename] = anime_info
+        return parsed
+
     def remove_from_library(self, path, filename):
         library = self.data_handler.library_get()
         library_cache = self.data_handler.library_cache_get()
-        tracker_list = self._get_tracker_list()
         fullpath = path+"/"+filename
+        self._remove_show_from_library(library, library_cache, fullpath, filename)
+
+    def _remove_show_from_library(self, library, library_cache, fullpath, filename):
         # Only remove if the filename matches library entry
         if filename in library_cache and library_cache[filename]:
-            (show_id, show_ep) = library_cache[filename]
-            if show_id and show_ep and show_id \
-                    and library.get(show_id, {}).get(show_ep) == fullpath:
+            removed = False
+            for (show_id, show_ep_start, show_ep_end) in self._library_entry_episodes(library_cache[filename]):
+                for show_ep in range(show_ep_start, show_ep_end+1):
+                    if show_id and library.get(show_id, {}).get(show_ep) == fullpath:
+                        library[show_id].pop(show_ep)
+                        removed = True
+
+            if removed:
                 self.msg.debug("File removed from local library: %s" % fullpath)
                 library_cache.pop(filename, None)
-                library[show_id].pop(show_ep, None)
 
     def add_to_library(self, path, filename, rescan=False):
         # The inotify tracker tells us when files are created in
@@ -846,66 +1148,66 @@ class Engine:
         self._add_show_to_library(
             library, library_cache, rescan, fullpath, filename, tracker_list, guess_show)
 
-    def _add_show_to_library(self, library, library_cache, rescan, fullpath, filename, tracker_list, guess_show):
-        show_id = None
-        if not rescan and filename in library_cache:
-            # If the filename was already seen before
-            # use the cached information, if there's no information (None)
-            # then it means it doesn't correspond to any show in the list
-            # and can be safely skipped.
-            if library_cache[filename]:
-                (show_id, show_ep) = library_cache[filename]
-                if type(show_ep) is tuple:
-                    (show_ep_start, show_ep_end) = show_ep
-                else:
-                    show_ep_start = show_ep_end = show_ep
-            else:
-                return library, library_cache
-        else:
+    def _add_show_to_library(self, library, library_cache, rescan, fullpath, filename, tracker_list, guess_show,
+                             anime_info=None):
+        if rescan or filename not in library_cache:
             # If the filename has not been seen, extract
             # the information from the filename and do a fuzzy search
             # on the user's list. Cache the information.
-            # If it fails, cache it as None.
-            anime_info = self.parser_class(self.msg, filename)
-            show_title = anime_info.getName()
-            (show_ep_start, show_ep_end) = anime_info.getEpisodeNumbers(True)
-            if show_title:
-                show = guess_show(show_title)
-                if show:
-                    self.msg.debug("Adding to library: {}".format(fullpath))
-                    self.msg.debug("Show guess: {}".format(show_title))
-
-                    if show_ep_start == show_ep_end:
-                        # TODO : Support redirections for episode ranges
-                        (show, show_ep) = utils.redirect_show(
-                            (show, show_ep_start), self.redirections, tracker_list)
-                        show_ep_end = show_ep_start = show_ep
-
-                        self.msg.debug("Redirected to: {} - {}".format(
-                            show['title'], show_ep))
-                        library_cache[filename] = (show['id'], show_ep)
-                    else:
-                        library_cache[filename] = (
-                            show['id'], (show_ep_start, show_ep_end))
-
-                    show_id = show['id']
-                else:
-                    self.msg.debug("Unable to match '{}', skipping: {}"
-                                   .format(show_title, fullpath))
-                    library_cache[filename] = None
-            else:
-                self.msg.debug("Not recognized, skipping: {}".format(fullpath))
-                library_cache[filename] = None
-
-        # After we got our information, add it to our library
-        if show_id:
-            if show_id not in library:
-                library[show_id] = {}
-            for show_ep in range(show_ep_start, show_ep_end+1):
-                library[show_id][show_ep] = fullpath
+            if anime_info is None:
+                anime_info = parser.parse(self.parser_class, self.msg, filename, self.parse_cache)
+            (show_title, entry) = _match_library_file(
+                anime_info, self.redirections, tracker_list, guess_show)
+            self._cache_library_file(library_cache, fullpath, filename, show_title, entry, tracker_list)
 
+        self._add_library_entry(library, library_cache[filename], fullpath)
         return library, library_cache
 
+    def _cache_library_file(self, library_cache, fullpath, filename, show_title, entry, tracker_list):
+        # If matching failed, cache it as None.
+        if entry:
+            self.msg.debug("Adding to library: {}".format(fullpath))
+            self.msg.debug("Show guess: {}".format(show_title))
+            if type(entry) is list:
+                for (show_id, (show_ep_start, show_ep_end)) in entry:
+                    self.msg.debug("Redirected to: {} - {}-{}".format(
+                        tracker_list[0][show_id]['title'], show_ep_start, show_ep_end))
+            elif type(entry[1]) is not tuple:
+                (show_id, show_ep) = entry
+                self.msg.debug("Redirected to: {} - {}".format(
+                    tracker_list[0][show_id]['title'], show_ep))
+        elif show_title:
+            self.msg.debug("Unable to match '{}', skipping: {}"
+                           .format(show_title, fullpath))
+        else:
+            self.msg.debug("Not recognized, skipping: {}".format(fullpath))
+
+        library_cache[filename] = entry
+
+    def _add_library_entry(self, library, entry, fullpath):
+        # If the filename was already seen before
+        # use the cached information, if there's no information (None)
+        # then it means it doesn't correspond to any show in the list
+        # and can be safely skipped.
+        if not entry:
+            return
+
+        for (show_id, show_ep_start, show_ep_end) in self._library_entry_episodes(entry):
+            if show_id:
+                if show_id not in library:
+                    library[show_id] = {}
+                for show_ep in range(show_ep_start, show_ep_end+1):
+                    library[show_id][show_ep] = fullpath
+
+    @staticmethod
+    def _library_entry_episodes(entry):
+        # Yields (show_id, ep_start, ep_end) for every show in a library cache entry
+        for (show_id, show_ep) in (entry if type(entry) is list else [entry]):
+            if type(show_ep) is tuple:
+                yield (show_id,) + show_ep
+            else:
+                yield (show_id, show_ep, show_ep)
+
     def get_episode_path(self, show, episode=0):
         """
         This function returns the full path of the requested episode from the requested show.
@@ -1024,6 +1326,7 @@ class Engine:
                 self.data_handler.altname_set(showid, newname)
                 self.msg.info('Changed alternate name to %s.' % newname)
             # Update the tracker with the new altname
+            self._invalidate_tracker_altnames()
             self._update_tracker()
         else:
             return self.data_handler.altname_get(showid)
@@ -1046,6 +1349,7 @@ class Engine:
         """Asks the data handler to download the remote list."""
         self.data_handler.queue_clear()
         self.data_handler.download_data()
+        self._invalidate_tracker_list()
         self._update_tracker()
 
     def list_upload(self):
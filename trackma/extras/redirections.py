@@ -14,14 +14,99 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import bisect
+import pickle
+
+from trackma import utils
+
 SUPPORTED_APIS = ['mal', 'kitsu', 'anilist']
 SUPPORTED_MEDIATYPES = ['anime']
 
+# Increase whenever the format of the compiled rules changes
+CACHE_VERSION = 1
+
 
 def supports(api, mediatype):
     return api in SUPPORTED_APIS and mediatype in SUPPORTED_MEDIATYPES
 
 
+class RedirectionRules:
+    """
+    Redirection rules of a single source show, compiled for lookups.
+
+    Rules are (src_eps, dst_id, dst_eps) tuples, where an episode range
+    ending in -1 is open-ended. Iterating over this object gives them
+    in the same order as they were in the file.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+
+        # Rules sorted by their first source episode, along with
+        # the highest last source episode up to each of them.
+        self.order = sorted(range(len(self.rules)), key=lambda i: self.rules[i][0][0])
+        self.starts = [self.rules[i][0][0] for i in self.order]
+        self.max_ends = []
+        max_end = 0
+        for i in self.order:
+            max_end = max(max_end, self._end(self.rules[i][0]))
+            self.max_ends.append(max_end)
+
+    @staticmethod
+    def _end(eps):
+        return float('inf') if eps[1] == -1 else eps[1]
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def find(self, ep):
+        """Returns the rules whose source range includes **ep**, in file order."""
+        return self.overlapping(ep, ep)
+
+    def overlapping(self, ep_start, ep_end):
+        """
+        Returns the rules whose source range shares at least one episode
+        with the range from **ep_start** to **ep_end**, in file order.
+        """
+        # Only the rules starting at or before ep_end can overlap it
+        count = bisect.bisect_right(self.starts, ep_end)
+        if not count or self.max_ends[count - 1] < ep_start:
+            return []
+
+        found = [i for i in self.order[:count] if self._end(self.rules[i][0]) >= ep_start]
+        return [self.rules[i] for i in sorted(found)]
+
+
+def load_anime_relations(filename, api, cachefile):
+    """
+    Works like :func:`parse_anime_relations`, but keeps the parsed rules
+    in **cachefile** so the file is only parsed again when its
+    last_modified meta changes.
+    """
+    source = (CACHE_VERSION, filename, api)
+    try:
+        cached = utils.load_data(cachefile)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        cached = None
+
+    last = None
+    if cached and cached.get('source') == source:
+        last = cached['relations']['meta'].get('last_modified')
+
+    relations = parse_anime_relations(filename, api, last)
+    if relations is None:
+        return cached['relations']
+
+    utils.save_data({'source': source, 'relations': relations}, cachefile)
+    return relations
+
+
 def parse_anime_relations(filename, api, last=None):
     """
     Support for Taiga-style anime relations file.
@@ -29,6 +114,11 @@ def parse_anime_relations(filename, api, last=None):
     Database under the public domain.
 
     https://github.com/erengy/anime-relations
+
+    Returns a dictionary of source show IDs to :class:`RedirectionRules`,
+    plus the file metadata in the 'meta' key.
+    If the last_modified metadata is the same as **last**, it stops
+    reading the file and returns None instead.
     """
     (src_grp, dst_grp) = (SUPPORTED_APIS.index(api) + 1, SUPPORTED_APIS.index(api) + 6)
 
@@ -58,7 +148,7 @@ def parse_anime_relations(filename, api, last=None):
                 if line[:16] == "- last_modified:":
                     last_modified = line[17:]
 
-                    # TODO : Stop if the file hasn't changed
+                    # Stop if the file hasn't changed
                     if last and last == last_modified:
                         return None
 
@@ -111,4 +201,8 @@ def parse_anime_relations(filename, api, last=None):
                 else:
                     print("Not recognized. " + line)
 
+        for src_id, rules in relations.items():
+            if src_id != 'meta':
+                relations[src_id] = RedirectionRules(rules)
+
         return relations
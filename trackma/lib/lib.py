@@ -14,9 +14,431 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import concurrent.futures
+import email.utils
+import http.client
+import json
+import socket
+import ssl
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
+
 from trackma import utils
 
 
+class HTTPError(utils.APIError):
+    """
+    Raised by :class:`HTTPTransport` when the server answers with an error status.
+    The body of the response can be read with :func:`read`.
+    """
+
+    def __init__(self, code, reason, headers, body):
+        super().__init__("HTTP Error %d: %s" % (code, reason))
+        self.code = code
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+class HTTPConnectionError(utils.APIError):
+    """Raised by :class:`HTTPTransport` when the server couldn't be reached."""
+
+    def __init__(self, reason):
+        super().__init__("Connection error: %s" % reason)
+        self.reason = reason
+
+
+class HTTPTimeout(HTTPConnectionError):
+    """Raised by :class:`HTTPTransport` when the server took too long to answer."""
+
+
+class HTTPResponse:
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def text(self):
+        return self.body.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.text())
+
+
+class ConnectionPool:
+    """
+    Keeps the connections to each host open after a request,
+    so the next requests to the same host can reuse them.
+    """
+    # Idle connections kept for each host
+    max_idle = 8
+    # Seconds before an idle connection is closed, as servers drop them anyway
+    idle_timeout = 30
+
+    def __init__(self):
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.ssl_context = ssl.create_default_context()
+
+    def get(self, scheme, host, timeout):
+        """Returns a connection to **host** and whether it was used before."""
+        now = time.monotonic()
+        with self.lock:
+            idle = self.idle.get((scheme, host), [])
+            while idle:
+                (conn, last_used) = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    conn.timeout = timeout
+                    if conn.sock:
+                        conn.sock.settimeout(timeout)
+                    return (conn, True)
+                conn.close()
+
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, timeout=timeout, context=self.ssl_context)
+        else:
+            conn = http.client.HTTPConnection(host, timeout=timeout)
+        return (conn, False)
+
+    def put(self, scheme, host, conn):
+        """Gives back a connection after its response was read entirely."""
+        with self.lock:
+            idle = self.idle.setdefault((scheme, host), [])
+            if len(idle) < self.max_idle:
+                idle.append((conn, time.monotonic()))
+                return
+
+        conn.close()
+
+
+# Connections are shared by every API and account
+_pool = ConnectionPool()
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the requests sent to a host.
+
+    Up to **burst** requests can be sent at once, and after that no more than
+    **rate** each second; without a **rate** only the server's answers limit
+    them. The limiter adapts to those answers through :func:`update`:
+    a Retry-After header, or running out of X-RateLimit-Remaining, pauses
+    every request to the host, and when both X-RateLimit-Remaining and
+    X-RateLimit-Reset are given the remaining requests are spread
+    until the reset.
+    """
+    # Seconds to wait after a 429 or 503 answer without Retry-After,
+    # doubled with each consecutive one
+    base_backoff = 1
+    max_backoff = 60
+    # Longest a request waits for a pause to end; if the server
+    # asked for a longer one, requests fail until it's over
+    max_wait = 120
+
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate
+        self.burst = burst or (max(1, rate) if rate else 1)
+        self.current_rate = rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """
+        Waits until the next request can be sent.
+        Raises :class:`utils.APIError` if it would take longer than **max_wait**.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.updated - now > self.max_wait:
+                raise utils.APIError("Too many requests, try again in %d seconds." % (self.updated - now))
+
+            if now > self.updated:
+                if self.current_rate:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.current_rate)
+                else:
+                    self.tokens = self.burst
+                self.updated = now
+
+            # While paused, updated is the time the pause ends
+            self.tokens -= 1
+            delay = self.updated - now
+            if self.tokens < 0:
+                if self.current_rate:
+                    delay += -self.tokens / self.current_rate
+                else:
+                    # Nothing to spread them with, so they all go once the pause ends
+                    self.tokens = 0
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def update(self, status, headers):
+        """
+        Adapts the limiter to the answer of the server.
+        Returns the seconds the requests were paused for.
+        """
+        now = time.time()
+        retry_after = self._parse_retry_after(headers.get('Retry-After'), now)
+        remaining = self._parse_int(headers.get('X-RateLimit-Remaining'))
+        reset = self._parse_int(headers.get('X-RateLimit-Reset'))
+        if reset is not None and reset > 10**9:
+            # Given as a timestamp
+            reset = max(0, reset - now)
+
+        with self.lock:
+            if status in (429, 503):
+                self.failures += 1
+                if retry_after is None:
+                    retry_after = min(self.base_backoff * 2 ** (self.failures - 1), self.max_backoff)
+            else:
+                self.failures = 0
+
+            if retry_after is None and remaining == 0 and reset:
+                retry_after = reset
+
+            if remaining and reset:
+                self.current_rate = min(self.rate or remaining / reset, remaining / reset)
+            else:
+                self.current_rate = self.rate
+
+            if retry_after:
+                self._pause(retry_after)
+            return retry_after or 0
+
+    def _pause(self, seconds):
+        # Called with the lock held
+        resume = time.monotonic() + seconds
+        if resume > self.updated:
+            self.updated = resume
+            self.tokens = 1
+
+    @staticmethod
+    def _parse_int(value):
+        try:
+            return int(float(value))
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _parse_retry_after(value, now):
+        if not value:
+            return None
+        try:
+            return max(0, float(value))
+        except ValueError:
+            pass
+
+        try:
+            return max(0, email.utils.parsedate_to_datetime(value).timestamp() - now)
+        except (TypeError, ValueError):
+            return None
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(host, rate):
+    """Returns the :class:`RateLimiter` of **host**, shared by every request to it."""
+    with _limiters_lock:
+        if host not in _limiters:
+            _limiters[host] = RateLimiter(rate)
+        return _limiters[host]
+
+
+class HTTPTransport:
+    """
+    HTTP client shared by the API implementations.
+
+    Connections are kept alive and reused for every request to the same
+    host, responses are decompressed transparently and every request times
+    out after **timeout** seconds. **headers** are sent with every request.
+    Requests to each host go through its :class:`RateLimiter`, which sends no
+    more than **rate_limit** per second if it's set, and follows the rate
+    limits the server reports. Requests the server turns down with
+    429 Too Many Requests, or with 503 Service Unavailable when repeating
+    them is safe, are sent again after the wait it asks for.
+
+    Redirections are followed like urllib does. When a proxy is configured
+    for a host, requests to it go through urllib, which knows how to use it.
+    """
+    max_redirects = 5
+    max_retries = 3
+    # Longest wait before a retry; the request fails if asked to wait more
+    max_retry_wait = RateLimiter.max_wait
+
+    idempotent_methods = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+    def __init__(self, headers=None, timeout=30, rate_limit=None):
+        self.headers = {'Accept-Encoding': 'gzip, deflate'}
+        self.headers.update(headers or {})
+        self.timeout = timeout
+        self.rate_limit = rate_limit
+        self.proxies = urllib.request.getproxies()
+        self.proxied = {}
+        self.opener = None
+
+    def request(self, method, url, body=None, headers=None, timeout=None, idempotent=None):
+        """
+        Sends a request and returns its :class:`HTTPResponse`.
+
+        **idempotent** tells if the request can be repeated safely;
+        by default it depends on the method.
+
+        Raises :class:`HTTPError` if the server answers with an error,
+        or :class:`HTTPConnectionError` if it can't be reached.
+        """
+        request_headers = dict(self.headers)
+        request_headers.update(headers or {})
+        timeout = timeout or self.timeout
+        if idempotent is None:
+            idempotent = method in self.idempotent_methods
+
+        for attempt in range(self.max_retries + 1):
+            (response, wait) = self._follow(method, url, body, request_headers, timeout)
+
+            # A 429 means the request wasn't processed, so it's always safe to repeat
+            if response.status == 429 or (response.status == 503 and idempotent):
+                if attempt < self.max_retries and wait <= self.max_retry_wait:
+                    continue
+            break
+
+        if response.status >= 300:
+            raise HTTPError(response.status, response.reason, response.headers, response.body)
+
+        return response
+
+    def _follow(self, method, url, body, request_headers, timeout):
+        # Sends a request following its redirections
+        for _ in range(self.max_redirects + 1):
+            (response, wait) = self._send(method, url, body, request_headers, timeout)
+            location = response.headers.get('Location')
+            if response.status not in (301, 302, 303, 307, 308) or not location:
+                break
+
+            if method not in ('GET', 'HEAD'):
+                if response.status in (307, 308):
+                    break
+
+                # The request becomes a GET without a body
+                method = 'GET'
+                body = None
+                request_headers = {k: v for (k, v) in request_headers.items()
+                                   if k.lower() not in ('content-type', 'content-length')}
+            url = urllib.parse.urljoin(url, location)
+
+        return (response, wait)
+
+    def _send(self, method, url, body, headers, timeout):
+        """Returns the response and the seconds the host asked us to wait."""
+        parts = urllib.parse.urlsplit(url)
+        limiter = get_rate_limiter(parts.netloc, self.rate_limit)
+        limiter.wait()
+
+        if self._is_proxied(parts):
+            response = self._send_urllib(method, url, body, headers, timeout)
+        else:
+            response = self._send_http(parts, method, body, headers, timeout)
+
+        return (response, limiter.update(response.status, response.headers))
+
+    def _send_http(self, parts, method, body, headers, timeout):
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        while True:
+            (conn, reused) = _pool.get(parts.scheme, parts.netloc, timeout)
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (ConnectionError, http.client.BadStatusLine) as e:
+                conn.close()
+                if reused:
+                    # The server closed the idle connection; try a new one
+                    continue
+                raise HTTPConnectionError(e)
+            except socket.timeout:
+                conn.close()
+                raise HTTPTimeout("timed out")
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                raise HTTPConnectionError(e)
+
+            if response.will_close:
+                conn.close()
+            else:
+                _pool.put(parts.scheme, parts.netloc, conn)
+
+            return HTTPResponse(response.status, response.reason, response.headers,
+                                self._decode(response.headers, data))
+
+    def _is_proxied(self, parts):
+        if parts.scheme not in self.proxies:
+            return False
+
+        if parts.hostname not in self.proxied:
+            self.proxied[parts.hostname] = not urllib.request.proxy_bypass(parts.hostname)
+        return self.proxied[parts.hostname]
+
+    def _send_urllib(self, method, url, body, headers, timeout):
+        if not self.opener:
+            self.opener = urllib.request.build_opener()
+
+        request = urllib.request.Request(url, body, headers, method=method)
+        try:
+            response = self.opener.open(request, timeout=timeout)
+        except urllib.error.HTTPError as e:
+            response = e
+        except socket.timeout:
+            raise HTTPTimeout("timed out")
+        except urllib.error.URLError as e:
+            if isinstance(e.reason, socket.timeout):
+                raise HTTPTimeout("timed out")
+            raise HTTPConnectionError(e.reason)
+
+        try:
+            data = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            raise HTTPConnectionError(e)
+        finally:
+            response.close()
+
+        return HTTPResponse(response.status, response.reason, response.headers,
+                            self._decode(response.headers, data))
+
+    @staticmethod
+    def _decode(headers, data):
+        encoding = (headers.get('Content-Encoding') or '').lower()
+        try:
+            if encoding == 'gzip':
+                return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+            elif encoding == 'deflate':
+                try:
+                    return zlib.decompress(data)
+                except zlib.error:
+                    # Some servers send raw deflate data
+                    return zlib.decompress(data, -zlib.MAX_WBITS)
+        except zlib.error as e:
+            raise HTTPConnectionError("Invalid compressed response: %s" % e)
+
+        return data
+
+
 class lib:
     """
     Base interface for creating API implementations for Trackma.
@@ -59,6 +481,22 @@ class lib:
 
     default_mediatype = None
 
+    http_timeout = 30
+    """Seconds before a request to the remote server times out."""
+
+    rate_limit = None
+    """Maximum number of requests per second sent to the remote server, if it has one."""
+
+    page_workers = 1
+    """Number of pages of the remote list that can be downloaded at the same time."""
+
+    queue_workers = 1
+    """
+    Number of queued operations that can be sent to the remote server at the
+    same time when processing the queue. APIs that can't handle concurrent
+    requests (or have very strict rate limits) should leave it at 1.
+    """
+
     # Supported signals for the data handler
     signals = {
         'show_info_changed': None,
@@ -90,6 +528,26 @@ class lib:
         except KeyError:
             raise Exception("Call to undefined signal.")
 
+    def _fetch_concurrently(self, fetch, items, workers):
+        """
+        Calls **fetch** with every item in **items**, running up to **workers**
+        of them at the same time, and yields the results in the same order.
+        If a call fails with an APIError, the error is yielded instead.
+        """
+        def call(item):
+            try:
+                return fetch(item)
+            except utils.APIError as e:
+                return e
+
+        if workers < 2 or len(items) < 2:
+            for item in items:
+                yield call(item)
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+            yield from executor.map(call, items)
+
     def _get_userconfig(self, key):
         return self.userconfig.get(key)
 
@@ -115,6 +573,27 @@ class lib:
         """
         raise NotImplementedError
 
+    def fetch_list_since(self, timestamp):
+        """
+        Fetches only the entries of the remote list that changed after **timestamp**
+        (in seconds since the epoch), in the same format as :func:`fetch_list`.
+
+        This is used by the Data Handler to refresh the list without downloading it
+        entirely. APIs that can't filter their list by modification time should leave
+        it unimplemented, and the full list will be fetched instead.
+        """
+        raise NotImplementedError
+
+    def fetch_list_items(self, showids):
+        """
+        Fetches the current entries of the shows in **showids** from the remote list,
+        in the same format as :func:`fetch_list`. Shows no longer in the list are left out.
+
+        This is used along with :func:`fetch_list_since`, whose entries only change
+        when the user changes them, to keep the show details of airing shows up to date.
+        """
+        raise NotImplementedError
+
     def add_show(self, item):
         """
         Adds the **item** in the remote server list. The **item** is a show dictionary passed by the Data Handler.
@@ -16,13 +16,10 @@
 
 import datetime
 import json
-import socket
-import urllib.error
 import urllib.parse
-import urllib.request
 
 from trackma import utils
-from trackma.lib.lib import lib
+from trackma.lib.lib import lib, HTTPConnectionError, HTTPError, HTTPTimeout, HTTPTransport
 
 
 class libanilist(lib):
@@ -91,6 +88,12 @@ class libanilist(lib):
         'search_methods': [utils.SearchMethod.KW],
     }
     default_mediatype = 'anime'
+    queue_workers = 2
+    http_timeout = 10
+    # AniList allows 90 requests per minute
+    rate_limit = 1.5
+    # Most shows AniList returns in a single page
+    info_page_size = 50
 
     score_types = {
         'POINT_100': (100, 1),
@@ -159,10 +162,10 @@ class libanilist(lib):
         if self.scoreformat:
             self._apply_scoreformat(self.scoreformat)
 
-        self.opener = urllib.request.build_opener()
-        self.opener.addheaders = [('User-agent', self.user_agent)]
+        self.http = HTTPTransport({'User-Agent': self.user_agent},
+                                  timeout=self.http_timeout, rate_limit=self.rate_limit)
 
-    def _raw_request(self, method, url, get=None, post=None, jsonpost=None, auth=False):
+    def _raw_request(self, method, url, get=None, post=None, jsonpost=None, auth=False, idempotent=None):
         if get:
             url = "{}?{}".format(url, urllib.parse.urlencode(get))
         if post:
@@ -170,29 +173,27 @@ class libanilist(lib):
         if jsonpost:
             post = json.dumps(jsonpost, ensure_ascii=False).encode('utf-8')
 
-        request = urllib.request.Request(url, post)
-        request.get_method = lambda: method
-
-        request.add_header('Content-Type', 'application/json')
-        request.add_header('Accept', 'application/json')
+        headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+        }
 
         if auth:
-            request.add_header('Authorization', 'Bearer {}'.format(
+            headers['Authorization'] = 'Bearer {}'.format(
                 self.pin,
-            ))
+            )
 
         try:
-            response = self.opener.open(request, timeout=10)
-            return json.loads(response.read().decode('utf-8'))
-        except urllib.error.HTTPError as e:
+            return self.http.request(method, url, post, headers, idempotent=idempotent).json()
+        except HTTPError as e:
             if e.code == 400:
                 raise utils.APIError("Invalid HTTP request: %s" % e.read())
             else:
                 raise utils.APIError("HTTP error status: %s" % e.read())
-        except urllib.error.URLError as e:
-            raise utils.APIError("HTTP connection error: %s" % e.reason)
-        except socket.timeout:
+        except HTTPTimeout:
             raise utils.APIError("Connection timed out.")
+        except HTTPConnectionError as e:
+            raise utils.APIError("HTTP connection error: %s" % e.reason)
 
     def _request(self, query, variables=None):
         if variables:
@@ -200,7 +201,9 @@ class libanilist(lib):
         else:
             data = {'query': query}
 
-        return self._raw_request('POST', self.query_url, jsonpost=data, auth=True)
+        # Queries can be sent again safely, mutations can't
+        idempotent = not query.lstrip().startswith('mutation')
+        return self._raw_request('POST', self.query_url, jsonpost=data, auth=True, idempotent=idempotent)
 
     def check_credentials(self):
         if len(self.pin) == 40:  # Old pins were 40 digits, new ones seem to be 654 digits
@@ -244,28 +247,7 @@ class libanilist(lib):
     }
   }
 }
-
-fragment mediaListEntry on MediaList {
-  id
-  score
-  progress
-  startedAt { year month day }
-  updatedAt
-  completedAt { year month day }
-  media {
-    id
-    title { userPreferred romaji english native }
-    synonyms
-    coverImage { large medium }
-    format
-    status
-    chapters episodes
-    nextAiringEpisode { airingAt episode }
-    startDate { year month day }
-    endDate { year month day }
-    siteUrl
-  }
-}'''
+''' + self.list_entry_fragment
         variables = {'id': self.userid, 'listType': self.mediatype.upper()}
         data = self._request(query, variables)['data']['MediaListCollection']
 
@@ -290,37 +272,134 @@ fragment mediaListEntry on MediaList {
             if remotelist['isCustomList']:
                 continue  # Maybe do something with this later
             for item in remotelist['entries']:
-                show = utils.show()
-                media = item['media']
-                showid = media['id']
-                showdata = {
-                    'my_id': item['id'],
-                    'id': showid,
-                    'title': media['title']['userPreferred'],
-                    'aliases': self._get_aliases(media),
-                    'type': self._translate_type(media['format']),
-                    'status': self._translate_status(media['status']),
-                    'my_progress': self._c(item['progress']),
-                    'my_status': my_status,
-                    'my_score': self._c(item['score']),
-                    'total': self._c(media[self.total_str]),
-                    'image': media['coverImage']['large'],
-                    'image_thumb': media['coverImage']['medium'],
-                    'url': media['siteUrl'],
-                    'start_date': self._dict2date(media['startDate']),
-                    'end_date': self._dict2date(media['endDate']),
-                    'my_start_date': self._dict2date(item['startedAt']),
-                    'my_finish_date': self._dict2date(item['completedAt']),
-                    'my_last_update': self._int2datetime(item['updatedAt']),
-                }
-                if media['nextAiringEpisode']:
-                    showdata['next_ep_number'] = media['nextAiringEpisode']['episode']
-                    showdata['next_ep_time'] = self._int2date(
-                        media['nextAiringEpisode']['airingAt'])
-                show.update({k: v for k, v in showdata.items() if v})
-                showlist[showid] = show
+                show = self._parse_list_entry(item, my_status)
+                showlist[show['id']] = show
+        return showlist
+
+    def fetch_list_since(self, timestamp):
+        if not self.scoreformat:
+            # We need the score format that only comes with the full list
+            raise NotImplementedError
+
+        self.check_credentials()
+
+        query = '''query ($id: Int!, $listType: MediaType, $page: Int) {
+  Page (page: $page, perPage: 50) {
+    pageInfo { hasNextPage }
+    mediaList (userId: $id, type: $listType, sort: UPDATED_TIME_DESC) {
+      status
+      ... mediaListEntry
+    }
+  }
+}
+''' + self.list_entry_fragment
+
+        showlist = {}
+        page = 1
+
+        # Walk the list from the most recently updated entry backwards
+        # and stop as soon as we reach the ones we already have.
+        while True:
+            self.msg.info('Downloading list changes (page %d)...' % page)
+            variables = {'id': self.userid, 'listType': self.mediatype.upper(), 'page': page}
+            data = self._request(query, variables)['data']['Page']
+
+            for item in data['mediaList']:
+                if item['updatedAt'] and item['updatedAt'] < timestamp:
+                    return showlist
+                if item['status'] not in self.media_info()['statuses']:
+                    continue
+
+                show = self._parse_list_entry(item, item['status'])
+                showlist[show['id']] = show
+
+            if not data['pageInfo']['hasNextPage']:
+                return showlist
+            page += 1
+
+    def fetch_list_items(self, showids):
+        self.check_credentials()
+
+        query = '''query ($id: Int!, $listType: MediaType, $ids: [Int], $perPage: Int) {
+  Page (perPage: $perPage) {
+    mediaList (userId: $id, type: $listType, mediaId_in: $ids) {
+      status
+      ... mediaListEntry
+    }
+  }
+}
+''' + self.list_entry_fragment
+
+        showlist = {}
+        showids = list(showids)
+        for i in range(0, len(showids), self.info_page_size):
+            ids = showids[i:i+self.info_page_size]
+            variables = {'id': self.userid, 'listType': self.mediatype.upper(),
+                         'ids': ids, 'perPage': len(ids)}
+            data = self._request(query, variables)['data']['Page']
+
+            for item in data['mediaList']:
+                if item['status'] not in self.media_info()['statuses']:
+                    continue
+
+                show = self._parse_list_entry(item, item['status'])
+                showlist[show['id']] = show
+
         return showlist
 
+    list_entry_fragment = '''
+fragment mediaListEntry on MediaList {
+  id
+  score
+  progress
+  startedAt { year month day }
+  updatedAt
+  completedAt { year month day }
+  media {
+    id
+    title { userPreferred romaji english native }
+    synonyms
+    coverImage { large medium }
+    format
+    status
+    chapters episodes
+    nextAiringEpisode { airingAt episode }
+    startDate { year month day }
+    endDate { year month day }
+    siteUrl
+  }
+}'''
+
+    def _parse_list_entry(self, item, my_status):
+        show = utils.show()
+        media = item['media']
+        showdata = {
+            'my_id': item['id'],
+            'id': media['id'],
+            'title': media['title']['userPreferred'],
+            'aliases': self._get_aliases(media),
+            'type': self._translate_type(media['format']),
+            'status': self._translate_status(media['status']),
+            'my_progress': self._c(item['progress']),
+            'my_status': my_status,
+            'my_score': self._c(item['score']),
+            'total': self._c(media[self.total_str]),
+            'image': media['coverImage']['large'],
+            'image_thumb': media['coverImage']['medium'],
+            'url': media['siteUrl'],
+            'start_date': self._dict2date(media['startDate']),
+            'end_date': self._dict2date(media['endDate']),
+            'my_start_date': self._dict2date(item['startedAt']),
+            'my_finish_date': self._dict2date(item['completedAt']),
+            'my_last_update': self._int2datetime(item['updatedAt']),
+        }
+        if media['nextAiringEpisode']:
+            showdata['next_ep_number'] = media['nextAiringEpisode']['episode']
+            showdata['next_ep_time'] = self._int2date(
+                media['nextAiringEpisode']['airingAt'])
+        show.update({k: v for k, v in showdata.items() if v})
+        return show
+
     args_SaveMediaListEntry = {
         'id': 'Int',                         # The list entry id, required for updating
         'mediaId': 'Int',                    # The id of the media the entry is of
@@ -426,8 +505,10 @@ fragment mediaListEntry on MediaList {
         self.check_credentials()
         infolist = []
 
-        query = '''query ($id: Int!, $type: MediaType) {
-  Media(id: $id, type: $type) {
+        # Shows are requested in pages of up to info_page_size
+        query = '''query ($ids: [Int], $type: MediaType, $perPage: Int) {
+  Page(perPage: $perPage) {
+    media(id_in: $ids, type: $type) {
       id
       title { userPreferred romaji english native }
       coverImage { medium large }
@@ -445,13 +526,25 @@ fragment mediaListEntry on MediaList {
       studios(sort: NAME, isMain: true) { nodes { name } }
       seasonYear
       season
+    }
   }
 }'''
 
-        for show in itemlist:
-            variables = {'id': show['id'], 'listType': self.mediatype.upper()}
-            data = self._request(query, variables)['data']['Media']
-            infolist.append(self._parse_info(data))
+        for i in range(0, len(itemlist), self.info_page_size):
+            ids = [show['id'] for show in itemlist[i:i+self.info_page_size]]
+            variables = {'ids': ids, 'type': self.mediatype.upper(), 'perPage': len(ids)}
+            data = self._request(query, variables)['data']['Page']['media']
+
+            # The page doesn't follow the order of the IDs
+            found = {item['id']: item for item in data}
+            for showid in ids:
+                if showid in found:
+                    infolist.append(self._parse_info(found[showid]))
+                else:
+                    self.msg.warn("Couldn't get information of show %s." % showid)
+
+        if itemlist and not infolist:
+            raise utils.APIError("Couldn't get information of the requested shows.")
 
         self._emit_signal('show_info_changed', infolist)
         return infolist
@@ -23,16 +23,13 @@ Example API response: https://kitsu.app/api/edge/anime?filter[text]=build+divide
 
 import datetime
 from enum import Enum
-import gzip
 import json
-import socket
 import time
 import urllib.error
 import urllib.parse
-import urllib.request
 
 from trackma import utils
-from trackma.lib.lib import lib
+from trackma.lib.lib import lib, HTTPConnectionError, HTTPError, HTTPTimeout, HTTPTransport
 
 
 class PosterImageKey(str, Enum):
@@ -67,6 +64,9 @@ class libkitsu(lib):
     }
 
     default_mediatype = 'anime'
+    queue_workers = 4
+    page_workers = 4
+    library_page_limit = 250
     default_statuses = ['current', 'completed',
                         'on_hold', 'dropped', 'planned']
     default_statuses_dict = {
@@ -156,14 +156,11 @@ class libkitsu(lib):
         self.username = account['username']
         self.password = account['password']
 
-        # Build opener with the mashape API key
-        self.opener = urllib.request.build_opener()
-        self.opener.addheaders = [
-            ('User-Agent',      self.user_agent),
-            ('Accept',          'application/vnd.api+json'),
-            ('Accept-Encoding', 'gzip'),
-            ('Accept-Charset',  'utf-8'),
-        ]
+        self.http = HTTPTransport({
+            'User-Agent':      self.user_agent,
+            'Accept':          'application/vnd.api+json',
+            'Accept-Charset':  'utf-8',
+        }, timeout=self.http_timeout, rate_limit=self.rate_limit)
 
     def _request(self, method, url, get=None, post=None, body=None, auth=False):
         content_type = None
@@ -177,28 +174,20 @@ class libkitsu(lib):
             post = body.encode('utf-8')
             content_type = 'application/vnd.api+json'
 
-        request = urllib.request.Request(url, post)
-        request.get_method = lambda: method
+        headers = {}
 
         if content_type:
-            request.add_header('Content-Type', content_type)
+            headers['Content-Type'] = content_type
 
         if auth:
-            request.add_header('Authorization', '{0} {1}'.format(
+            headers['Authorization'] = '{0} {1}'.format(
                 self._get_userconfig('token_type').capitalize(),
                 self._get_userconfig('access_token'),
-            ))
+            )
 
         try:
-            response = self.opener.open(request)
-
-            # The response most probably will be gzipped so we
-            # have to take care of that first
-            if response.info().get('content-encoding') == 'gzip':
-                return gzip.GzipFile(fileobj=response).read().decode('utf-8')
-            else:
-                return response.read().decode('utf-8')
-        except urllib.error.HTTPError as e:
+            return self.http.request(method, url, post, headers).text()
+        except HTTPError as e:
             if e.code == 401:
                 raise utils.APIError("Incorrect credentials.")
             else:
@@ -207,10 +196,10 @@ class libkitsu(lib):
                     raise utils.APIError("API error: %s" % api_error)
                 else:
                     raise utils.APIError("Connection error: %s" % e)
-        except urllib.error.URLError as e:
-            raise utils.APIError("URL error: %s" % e)
-        except socket.timeout:
+        except HTTPTimeout:
             raise utils.APIError("Operation timed out.")
+        except HTTPConnectionError as e:
+            raise utils.APIError("URL error: %s" % e.reason)
 
     def _parse_errors(self, e):
         try:
@@ -326,7 +315,7 @@ class libkitsu(lib):
                     'userCount',
                     'favoritesCount'
                 ]),
-                "page[limit]": "250",
+                "page[limit]": str(self.library_page_limit),
             }
 
             if self.mediatype == 'anime':
@@ -337,19 +326,9 @@ class libkitsu(lib):
 
             url = "{}/library-entries?{}".format(
                 self.prefix, urllib.parse.urlencode(params))
-            i = 1
-
-            while url:
-                self.msg.info('Getting page {}...'.format(i))
-
-                data = self._request('GET', url)
-                data_json = json.loads(data)
-
-                # print(json.dumps(data_json, sort_keys=True, indent=2))
-                # return []
 
+            for data_json in self._fetch_list_pages(url):
                 entries = data_json['data']
-                links = data_json['links']
 
                 for entry in entries:
                     # TODO : Including the mediatype returns a 500 for some reason.
@@ -378,9 +357,6 @@ class libkitsu(lib):
 
                     self._emit_signal('show_info_changed', infolist)
 
-                url = links.get('next')
-                i += 1
-
             return showlist
         except urllib.error.HTTPError as e:
             raise utils.APIError(
@@ -389,6 +365,42 @@ class libkitsu(lib):
             raise utils.APIError(
                 "Error getting list (URLError): %s" % e.reason)
 
+    def _fetch_list_pages(self, url):
+        """
+        Yields the pages of the list starting at **url**, in order.
+
+        The first page tells how many entries there are, so the rest
+        of the pages are requested at the same time.
+        """
+        self.msg.info('Getting page 1...')
+        data_json = json.loads(self._request('GET', url))
+        yield data_json
+
+        count = data_json.get('meta', {}).get('count')
+        if count is None or self.page_workers < 2:
+            # Follow the links one page at a time
+            url = data_json['links'].get('next')
+            i = 2
+            while url:
+                self.msg.info('Getting page {}...'.format(i))
+                data_json = json.loads(self._request('GET', url))
+                yield data_json
+
+                url = data_json['links'].get('next')
+                i += 1
+            return
+
+        urls = ["{}&{}".format(url, urllib.parse.urlencode({'page[offset]': offset}))
+                for offset in range(self.library_page_limit, count, self.library_page_limit)]
+        if urls:
+            self.msg.info('Getting {} more pages...'.format(len(urls)))
+
+        for data in self._fetch_concurrently(lambda page_url: self._request('GET', page_url),
+                                             urls, self.page_workers):
+            if isinstance(data, utils.APIError):
+                raise data
+            yield json.loads(data)
+
     def merge(self, show, info):
         show['title'] = info['title']
         show['aliases'] = info['aliases']
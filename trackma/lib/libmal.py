@@ -15,16 +15,11 @@
 #
 
 import datetime
-import gzip
-import json
-import socket
 import time
-import urllib.error
 import urllib.parse
-import urllib.request
 
 from trackma import utils
-from trackma.lib.lib import lib
+from trackma.lib.lib import lib, HTTPConnectionError, HTTPError, HTTPTimeout, HTTPTransport
 
 
 class libmal(lib):
@@ -89,6 +84,13 @@ class libmal(lib):
         'search_methods': [utils.SearchMethod.KW],
     }
     default_mediatype = 'anime'
+    queue_workers = 4
+    page_workers = 4
+    rate_limit = 3
+
+    # Details of several shows are requested at the same time,
+    # since there's no way to request them at once
+    info_workers = 4
 
     type_translate = {
         'tv': utils.Type.TV,
@@ -131,6 +133,7 @@ class libmal(lib):
     user_agent = 'Trackma/{}'.format(utils.VERSION)
 
     library_page_limit = 1000
+    changes_page_limit = 100
     search_page_limit = 100
     season_page_limit = 500
 
@@ -155,13 +158,11 @@ class libmal(lib):
             self.watched_str = "num_episodes_watched"
             self.watched_send_str = "num_watched_episodes"  # Please fix this upstream...
 
-        self.opener = urllib.request.build_opener()
-        self.opener.addheaders = [
-            ('User-Agent',      self.user_agent),
-            ('Accept',          'application/json'),
-            ('Accept-Encoding', 'gzip'),
-            ('Accept-Charset',  'utf-8'),
-        ]
+        self.http = HTTPTransport({
+            'User-Agent':      self.user_agent,
+            'Accept':          'application/json',
+            'Accept-Charset':  'utf-8',
+        }, timeout=self.http_timeout, rate_limit=self.rate_limit)
 
     def _request(self, method, url, get=None, post=None, auth=False):
         content_type = None
@@ -174,33 +175,25 @@ class libmal(lib):
             self.msg.debug("POST data: " + str(post))
 
         self.msg.debug(method + " URL: " + url)
-        request = urllib.request.Request(url, post)
-        request.get_method = lambda: method
+        headers = {}
 
         if content_type:
-            request.add_header('Content-Type', content_type)
+            headers['Content-Type'] = content_type
 
         if auth:
-            request.add_header('Authorization', '{0} {1}'.format(
+            headers['Authorization'] = '{0} {1}'.format(
                 self._get_userconfig('token_type').capitalize(),
                 self._get_userconfig('access_token'),
-            ))
+            )
 
         try:
-            response = self.opener.open(request)
-
-            if response.info().get('content-encoding') == 'gzip':
-                response = gzip.GzipFile(fileobj=response).read().decode('utf-8')
-            else:
-                response = response.read().decode('utf-8')
-
-            return json.loads(response)
-        except urllib.error.HTTPError as e:
+            return self.http.request(method, url, post, headers).json()
+        except HTTPError as e:
             raise utils.APIError("Connection error: %s" % e)
-        except urllib.error.URLError as e:
-            raise utils.APIError("URL error: %s" % e)
-        except socket.timeout:
+        except HTTPTimeout:
             raise utils.APIError("Operation timed out.")
+        except HTTPConnectionError as e:
+            raise utils.APIError("URL error: %s" % e.reason)
 
     def _request_access_token(self, refresh=False):
         """
@@ -267,47 +260,129 @@ class libmal(lib):
         self.check_credentials()
         shows = {}
 
-        fields = 'id,alternative_titles,title,start_date,end_date,main_picture,status,' + self.total_str
-        listfields = 'score,status,start_date,finish_date,updated_at,' + self.watched_str
-        params = {
-            'fields': '%s,list_status{%s}' % (fields, listfields),
-            'limit': self.library_page_limit,
-            'nsfw': 'true'
-        }
+        for data in self._fetch_list_pages():
+            for item in data['data']:
+                show = self._parse_list_item(item)
+                shows[show['id']] = show
+
+        return shows
 
-        url = "{}/users/@me/{}list?{}".format(self.query_url, self.mediatype, urllib.parse.urlencode(params))
+    def _fetch_list_pages(self):
+        """
+        Yields the pages of the list in order.
+
+        MAL doesn't tell how long the list is, so after the first page the next
+        page_workers pages are requested at the same time, until the last one
+        is found. At most page_workers - 1 requests are made past the end.
+        """
+        limit = self.library_page_limit
+        self.msg.info('Downloading list (page 1)...')
+        data = self._request('GET', self._list_url(limit=limit), auth=True)
+        yield data
+
+        page = 1
+        while data['paging'].get('next'):
+            urls = [self._list_url(limit=limit, offset=(page + i) * limit) for i in range(self.page_workers)]
+            self.msg.info('Downloading list (pages %d-%d)...' % (page + 1, page + len(urls)))
+
+            for data in self._fetch_concurrently(lambda url: self._request('GET', url, auth=True),
+                                                 urls, self.page_workers):
+                if isinstance(data, utils.APIError):
+                    raise data
+                yield data
+
+                page += 1
+                if not data['paging'].get('next'):
+                    return
+
+    def fetch_list_since(self, timestamp):
+        self.check_credentials()
+        shows = {}
+
+        # Walk the list from the most recently updated entry backwards
+        # and stop as soon as we reach the ones we already have.
+        url = self._list_url(limit=self.changes_page_limit, sort='list_updated_at')
         i = 1
 
         while url:
-            self.msg.info('Downloading list (page %d)...' % i)
+            self.msg.info('Downloading list changes (page %d)...' % i)
             data = self._request('GET', url, auth=True)
             for item in data['data']:
-                showid = item['node']['id']
-                shows[showid] = utils.show()
-                shows[showid].update({
-                    'id': showid,
-                    'title': item['node']['title'],
-                    'url': "https://myanimelist.net/%s/%d" % (self.mediatype, showid),
-                    'aliases': self._get_aliases(item['node']),
-                    'image': item['node'].get('main_picture', {}).get('large'),
-                    'image_thumb': item['node'].get('main_picture', {}).get('medium'),
-                    'total': item['node'][self.total_str],
-                    'status': self._translate_status(item['node']['status']),
-                    'start_date': self._str2date(item['node'].get('start_date')),
-                    'end_date': self._str2date(item['node'].get('end_date')),
-                    'my_progress': item['list_status'][self.watched_str],
-                    'my_score': item['list_status']['score'],
-                    'my_status': item['list_status']['status'],
-                    'my_start_date': self._str2date(item['list_status'].get('start_date')),
-                    'my_finish_date': self._str2date(item['list_status'].get('finish_date')),
-                    'my_last_update': self._iso2datetime(item['list_status'].get('updated_at')),
-                })
+                show = self._parse_list_item(item)
+                if show['my_last_update'] and show['my_last_update'].timestamp() < timestamp:
+                    return shows
+
+                shows[show['id']] = show
 
             url = data['paging'].get('next')
             i += 1
 
         return shows
 
+    def fetch_list_items(self, showids):
+        self.check_credentials()
+        shows = {}
+
+        params = {'fields': '%s,my_list_status{%s}' % (self.list_fields, self.list_status_fields),
+                  'nsfw': 'true'}
+
+        def fetch(showid):
+            return self._request('GET', self.query_url + '/%s/%d' % (self.mediatype, showid), get=params, auth=True)
+
+        showids = list(showids)
+        for showid, data in zip(showids, self._fetch_concurrently(fetch, showids, self.info_workers)):
+            if isinstance(data, utils.APIError):
+                # Keep the cached entry; it'll be refreshed next time
+                self.msg.warn("Couldn't refresh show %s: %s" % (showid, data))
+                continue
+            if not data.get('my_list_status'):
+                # Not in the list anymore
+                continue
+
+            show = self._parse_list_item({'node': data, 'list_status': data['my_list_status']})
+            shows[show['id']] = show
+
+        return shows
+
+    @property
+    def list_fields(self):
+        return 'id,alternative_titles,title,start_date,end_date,main_picture,status,' + self.total_str
+
+    @property
+    def list_status_fields(self):
+        return 'score,status,start_date,finish_date,updated_at,' + self.watched_str
+
+    def _list_url(self, **params):
+        params.update({
+            'fields': '%s,list_status{%s}' % (self.list_fields, self.list_status_fields),
+            'nsfw': 'true'
+        })
+
+        return "{}/users/@me/{}list?{}".format(self.query_url, self.mediatype, urllib.parse.urlencode(params))
+
+    def _parse_list_item(self, item):
+        showid = item['node']['id']
+        show = utils.show()
+        show.update({
+            'id': showid,
+            'title': item['node']['title'],
+            'url': "https://myanimelist.net/%s/%d" % (self.mediatype, showid),
+            'aliases': self._get_aliases(item['node']),
+            'image': item['node'].get('main_picture', {}).get('large'),
+            'image_thumb': item['node'].get('main_picture', {}).get('medium'),
+            'total': item['node'][self.total_str],
+            'status': self._translate_status(item['node']['status']),
+            'start_date': self._str2date(item['node'].get('start_date')),
+            'end_date': self._str2date(item['node'].get('end_date')),
+            'my_progress': item['list_status'][self.watched_str],
+            'my_score': item['list_status']['score'],
+            'my_status': item['list_status']['status'],
+            'my_start_date': self._str2date(item['list_status'].get('start_date')),
+            'my_finish_date': self._str2date(item['list_status'].get('finish_date')),
+            'my_last_update': self._iso2datetime(item['list_status'].get('updated_at')),
+        })
+        return show
+
     def add_show(self, item):
         self.check_credentials()
         self.msg.info("Adding item %s..." % item['title'])
@@ -356,9 +431,20 @@ class libmal(lib):
 
         fields = 'alternative_titles,end_date,genres,id,main_picture,mean,media_type,' + self.total_str + ',popularity,rating,start_date,status,studios,synopsis,title'
         params = {'fields': fields, 'nsfw': 'true'}
-        for item in itemlist:
-            data = self._request('GET', self.query_url + '/%s/%d' % (self.mediatype, item['id']), get=params, auth=True)
-            infolist.append(self._parse_info(data))
+
+        def fetch(item):
+            return self._request('GET', self.query_url + '/%s/%d' % (self.mediatype, item['id']), get=params, auth=True)
+
+        error = None
+        for item, data in zip(itemlist, self._fetch_concurrently(fetch, itemlist, self.info_workers)):
+            if isinstance(data, utils.APIError):
+                self.msg.warn("Couldn't get information of show %s: %s" % (item['id'], data))
+                error = error or data
+            else:
+                infolist.append(self._parse_info(data))
+
+        if error and not infolist:
+            raise error
 
         self._emit_signal('show_info_changed', infolist)
         return infolist
@@ -15,14 +15,11 @@
 #
 
 import json
-import socket
 import time
-import urllib.error
 import urllib.parse
-import urllib.request
 
 from trackma import utils
-from trackma.lib.lib import lib
+from trackma.lib.lib import lib, HTTPConnectionError, HTTPTimeout, HTTPTransport
 
 
 class libshikimori(lib):
@@ -86,6 +83,8 @@ class libshikimori(lib):
         'score_step': 1,
     }
     default_mediatype = 'anime'
+    # Shikimori allows 90 requests per minute
+    rate_limit = 1.5
 
     # Supported signals for the data handler
     signals = {'show_info_changed': None, }
@@ -136,10 +135,8 @@ class libshikimori(lib):
             self.total_str = "episodes"
             self.watched_str = "episodes"
 
-        # handler=urllib.request.HTTPHandler(debuglevel=1)
-        # self.opener = urllib.request.build_opener(handler)
-        self.opener = urllib.request.build_opener()
-        self.opener.addheaders = [('User-agent', 'Trackma')]
+        self.http = HTTPTransport({'User-Agent': 'Trackma'},
+                                  timeout=self.http_timeout, rate_limit=self.rate_limit)
 
     def _request(self, method, url, get=None, post=None, jsondata=None, auth=False):
         content_type = None
@@ -153,27 +150,24 @@ class libshikimori(lib):
             post = json.dumps(jsondata).encode('utf-8')
             content_type = 'application/json'
 
-        request = urllib.request.Request(url, post)
         self.msg.debug("URL: %s" % url)
-        request.get_method = lambda: method
+        headers = {}
 
         if content_type:
-            request.add_header('Content-Type', content_type)
+            headers['Content-Type'] = content_type
 
         if auth:
-            request.add_header('Authorization', '{0} {1}'.format(
+            headers['Authorization'] = '{0} {1}'.format(
                 self._get_userconfig('token_type').capitalize(),
                 self._get_userconfig('access_token'),
-            ))
+            )
 
         try:
-            response = self.opener.open(request)
-
-            return json.loads(response.read().decode('utf-8'))
-        except urllib.error.URLError as e:
-            raise utils.APIError("URL error: %s" % e)
-        except socket.timeout:
+            return self.http.request(method, url, post, headers).json()
+        except HTTPTimeout:
             raise utils.APIError("Operation timed out.")
+        except HTTPConnectionError as e:
+            raise utils.APIError("URL error: %s" % e)
 
     def _request_access_token(self, refresh=False):
         """
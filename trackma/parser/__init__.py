@@ -1,3 +1,41 @@
+import threading
+from collections import OrderedDict, namedtuple
+
+# Maximum number of parsed filenames kept by parse()
+PARSE_CACHE_SIZE = 4096
+
+_parse_cache = OrderedDict()
+_parse_cache_lock = threading.Lock()
+
+
+class ParseResult(namedtuple('ParseResult', 'title episode_start episode_end season version')):
+    """
+    Compact record of what a parser got from a filename.
+
+    It can be used in place of the parser object itself,
+    as it provides the same getters.
+    """
+    __slots__ = ()
+
+    def getName(self):
+        return self.title
+
+    def getEpisodeNumbers(self, force_numbers=False):
+        ep_start = self.episode_start
+        ep_end = self.episode_end
+        if force_numbers:
+            if ep_start is None:
+                ep_start = 1
+            if ep_end is None:
+                ep_end = ep_start
+            ep_start = int(ep_start)
+            ep_end = int(ep_end)
+        return ep_start, ep_end
+
+    def getEpisode(self):
+        return self.getEpisodeNumbers(True)[1]
+
+
 def get_parser_class(msg, parser_name):
     # Choose the parser we want to use
     if parser_name == 'aie':
@@ -10,4 +48,44 @@ def get_parser_class(msg, parser_name):
         return AnitopyWrapper
     else:
         msg.debug('Unknown parser "{}", falling back to default'.format(parser_name))
-        return get_parser_class('aie')
+        return get_parser_class(msg, 'aie')
+
+
+def parse(parser_class, msg, filename, cache=None):
+    """
+    Returns the :class:`ParseResult` of **filename** using parser_class.
+
+    The last PARSE_CACHE_SIZE results are kept and shared by every caller
+    in the process, so the same file isn't parsed again when both the
+    library scan and the trackers come across it.
+    If a :class:`cache.ParseCache` is given, results are also looked up
+    and stored there.
+    """
+    key = (parser_class, filename)
+    with _parse_cache_lock:
+        try:
+            _parse_cache.move_to_end(key)
+            return _parse_cache[key]
+        except KeyError:
+            pass
+
+    result = cache.get(parser_class, filename) if cache else None
+    if result is None:
+        result = parser_class(msg, filename).getResult()
+        if cache:
+            cache.put(parser_class, filename, result)
+
+    with _parse_cache_lock:
+        _parse_cache[key] = result
+        if len(_parse_cache) > PARSE_CACHE_SIZE:
+            _parse_cache.popitem(last=False)
+
+    return result
+
+
+def parse_batch(parser_class, msg, filenames):
+    """
+    Parses every filename in **filenames** using parser_class,
+    yielding a :class:`ParseResult` for each of them in order.
+    """
+    return parser_class.parse_batch(msg, filenames)
@@ -17,6 +17,8 @@
 import re
 from decimal import Decimal
 
+from trackma.parser import ParseResult
+
 NO_SUBBER = '###NO#SUBBER#HERE###'
 
 BRACKET_PAIRS = [
@@ -26,6 +28,75 @@ BRACKET_PAIRS = [
     (r'\{', r'\}'),
 ]
 
+# Patterns are compiled once here, in the order they're used
+EXTENSION_RE = re.compile(r"\.(\w{3})$")
+SEPARATOR_RES = [
+    (char, re.compile(r'([^{0}]){0}(?=[^{0}]|$)'.format(re.escape(char))))
+    for char in "_.-"
+]
+H264_PROFILES = [
+    (['H264', 'Hi10P'], ['Hi10P', 'Hi10', '10bit', '10 bit', '10-bit', 'YUV420P10']),
+    (['H264', '8bit'], ['8bit', '8-bit']),
+    (['H264', 'Hi444PP'], ['Hi444PP', 'YUV444P10']),
+]
+SPECIAL_TAG_RES = [
+    (k, re.compile(r'[\(\[][^\)\]]*?\b(' + tag_re + r')\b', flags=re.IGNORECASE))
+    for k, tag_re in (
+        ('video', r'H\.?264|x264|AVC|XviD|DivX|H\.?265|HEVC|AV1'),
+        ('audio', r'AC3|AAC|MP3|FLAC|E-?AC-?3|Opus|DTS(?:-HD)?|TrueHD|L?PCM'),
+        ('source', r'TV|DVD|Blu-?Ray|BD|BDMV|www|WEB(?:-DL)?'),
+    )
+]
+RESOLUTION_RE = re.compile(r'\b(\d{3,4}(?:p|i|x\d{3,4}))\b')
+RESOLUTION_HDSD_RE = re.compile(r'(?:[\[\(]|\d{1,3})\s*([HS]D)(TV)?\b')
+RESOLUTION_HDSD_END_RE = re.compile(r'\b([HS]D)(TV)?$')
+HASH_RE = re.compile(r'[\(\[]([A-Fa-f0-9]{8})[\)\]]')
+REMUX_RE = re.compile(r'[\(\[][^\)\]]*?(Remux)\b', flags=re.IGNORECASE)
+NO_SUBBER_PAREN_RE = re.compile(r'\([^\)]*?' + NO_SUBBER + r'.*?\)')
+NO_SUBBER_SQUARE_RE = re.compile(r'\[[^\]]*?' + NO_SUBBER + r'.*?\]')
+EMPTY_BRACKETS_RE = re.compile(r'(?!^)\[\W*?\]|\(\W*?\)')
+SUBBER_RES = [
+    re.compile(r'{0}([^\. ].*?){1}'.format(opening, closing))
+    for opening, closing in BRACKET_PAIRS
+]
+VERSION_RE = re.compile(r'(?:[^a-zA-Z])v([0-7])\b', flags=re.IGNORECASE)
+VOLUME_RE = re.compile(
+    r'\b(?:vol(?:ume)?\.? ?)(\d{1,3})(?: ?- ?(?:vol(?:ume)?\.? ?)?(\d{1,3}))?\b',
+    flags=re.IGNORECASE)
+PV_RE = re.compile(r' PV ?(\d)?(?:[^a-zA-Z0-9]|$)')
+CONCURRENT_EPISODES_RE = re.compile(
+    r'\b(?:S(?:\.|eason)?(\d+)\s*)?'
+    r'(?:E\.?|Ep(?:i|isode)?s?[ .]?)?(\d{1,4})[\+\&](\d{1,4})\b',
+    flags=re.IGNORECASE,
+)
+# Only allow spaces around the hyphen when we are likely to have a pack
+MULTIPLE_EPISODES_RES = {
+    has_extension: re.compile(
+        r'\b(?:S(?:\.|eason)?(\d+)\s*)?'
+        r'(?:E\.?|Ep(?:i|isode)?[ .]?)?'
+        r'((?:\d{1,3}|1[0-8]\d{2})(?:\.\d{1})?)'
+        + (r'-' if has_extension else r' ?- ?')
+        + r'(\d{1,4}(?:\.\d{1})?)\b',
+        flags=re.IGNORECASE)
+    for has_extension in (True, False)
+}
+EPISODE_SPECIFIER_RE = re.compile(
+    r'\b(?:S(?:\.|eason)?(\d+)\s*)?(?:E\.?|Ep(?:i|isode)?[ .]?)(\d+(?:\.\d)?)(?:\b|v)',
+    flags=re.IGNORECASE
+)
+LONELY_NUMBER_RE = re.compile(r'.*[^\.\[\(]\b((?:\d{1,3}|1[0-8]\d{2})(?:\.\d)?)(?:[\[({]|\s*$|\s+\W)')
+LONELY_NUMBER_BRACKETS_RE = re.compile(r'.*[\[\(]((?:\d{1,3}|1[0-8]\d{2})(?:\.\d)?)(?:[\])}]|\s*$|\s+\W)')
+BRACKETED_RES = [
+    re.compile(r'{0}((?!\d{{4}}{1}).*?){1}'.format(opening, closing))
+    for opening, closing in BRACKET_PAIRS
+]
+DOUBLE_SPACE_RE = re.compile(r'  .*')
+UNCLOSED_BRACKET_RES = [
+    re.compile(r'{}r[^{}].*$'.format(opening, closing))
+    for opening, closing in BRACKET_PAIRS
+]
+TRAILING_DASHES_RE = re.compile(r'( - *)+$')
+
 
 class AnimeInfoExtractor:
     """
@@ -35,9 +106,29 @@ class AnimeInfoExtractor:
     @note: Thanks for Tyris for providing easy way to extract data
     @note: Does more than what's needed, but that behaviour is well tested
     """
+    parser_name = 'aie'
+    # Increase whenever a change in the parser gives different results
+    parser_version = 1
 
     def __init__(self, msg, filename):
         self.msg = msg.with_classname('Parser')
+        self._load(filename)
+
+    @classmethod
+    def parse_batch(cls, msg, filenames):
+        """
+        Parses every filename in **filenames**, yielding a ParseResult for each.
+        The same parser object is reused for all of them.
+        """
+        aie = None
+        for filename in filenames:
+            if aie:
+                aie._load(filename)
+            else:
+                aie = cls(msg, filename)
+            yield aie.getResult()
+
+    def _load(self, filename):
         self.originalFilename = filename
         self.resolution = ''
         self.hash = ''
@@ -59,6 +150,10 @@ class AnimeInfoExtractor:
     def getName(self):
         return self.name
 
+    def getResult(self):
+        (ep_start, ep_end) = self.getEpisodeNumbers()
+        return ParseResult(self.name, ep_start, ep_end, self.season, self.version)
+
     def getEpisodeNumbers(self, force_numbers=False):
         ep_start = self.episodeStart
         ep_end = self.episodeEnd
@@ -78,28 +173,22 @@ class AnimeInfoExtractor:
         return int(ep)
 
     def __extractExtension(self, filename):
-        m = re.search(r"\.(\w{3})$", filename)
+        m = EXTENSION_RE.search(filename)
         if m:
             self.extension = m.group(1)
             filename = filename[:-4]
         return filename
 
     def __cleanUpSpaces(self, filename):
-        characters = "_.-"
-        for char in characters:
+        for char, separator_re in SEPARATOR_RES:
             if ' ' in filename:
                 break
-            filename = re.sub(r'([^{0}]){0}(?=[^{0}]|$)'.format(re.escape(char)), r'\1 ', filename)
+            filename = separator_re.sub(r'\1 ', filename)
         return filename
 
     def __extractSpecialTags(self, filename):
-        tags = {'video': r'H\.?264|x264|AVC|XviD|DivX|H\.?265|HEVC|AV1',
-                'audio': r'AC3|AAC|MP3|FLAC|E-?AC-?3|Opus|DTS(?:-HD)?|TrueHD|L?PCM',
-                'source': r'TV|DVD|Blu-?Ray|BD|BDMV|www|WEB(?:-DL)?'}
-        for k, tag_re in tags.items():
-            m = re.search(r'[\(\[][^\)\]]*?\b(' + tag_re + r')\b',
-                          filename,
-                          flags=re.IGNORECASE)
+        for k, tag_re in SPECIAL_TAG_RES:
+            m = tag_re.search(filename)
             if m:
                 if k == 'video':
                     self.videoType.append(m.group(1))
@@ -113,15 +202,10 @@ class AnimeInfoExtractor:
 
     def __extractVideoProfile(self, filename):
         # Check for 8bit/10bit/Hi444PP
-        h264_profiles = [
-            (['H264', 'Hi10P'], ['Hi10P', 'Hi10', '10bit', '10 bit', '10-bit', 'YUV420P10']),
-            (['H264', '8bit'], ['8bit', '8-bit']),
-            (['H264', 'Hi444PP'], ['Hi444PP', 'YUV444P10']),
-        ]
-        for to_add, tags in h264_profiles:
+        for to_add, tags in H264_PROFILES:
             for tag in tags:
                 if tag in filename:
-                    self.videoType = to_add
+                    self.videoType = list(to_add)
                     # Don't replace Hi10 because it's a subber name
                     if tag != 'Hi10':
                         filename = filename.replace(tag, '')
@@ -130,19 +214,19 @@ class AnimeInfoExtractor:
 
     def __extractResolution(self, filename):
         # Match 3 or 4 chars followed by p, i, or x and 3 or 4 more chars, surrounded by any non-alphanumeric chars
-        m = re.search(r'\b(\d{3,4}(?:p|i|x\d{3,4}))\b', filename)
+        m = RESOLUTION_RE.search(filename)
         if m:
             self.resolution = m.group(1)
             return filename[:m.start(1)] + filename[m.end(1):]
         # HD/SD in brackets or after an episode number
-        m = re.search(r'(?:[\[\(]|\d{1,3})\s*([HS]D)(TV)?\b', filename)
+        m = RESOLUTION_HDSD_RE.search(filename)
         if m:
             self.resolution = m.group(1)
             if m.group(2):
                 self.releaseSource.append(m.group(2))
             return filename[:m.start(1)] + filename[m.end():]
         # HD/SD at the end
-        m = re.search(r'\b([HS]D)(TV)?$', filename)
+        m = RESOLUTION_HDSD_END_RE.search(filename)
         if m:
             self.resolution = m.group(1)
             if m.group(2):
@@ -153,28 +237,28 @@ class AnimeInfoExtractor:
 
     def __extractHash(self, filename):
         # Match anything in square or round brackets that is 8 hex digits
-        m = re.search(r'[\(\[]([A-Fa-f0-9]{8})[\)\]]', filename)
+        m = HASH_RE.search(filename)
         if m:
             self.hash = m.group(1)
             filename = filename[:m.start()] + filename[m.end():]
         return filename
 
     def __checkIfRemux(self, filename):
-        m = re.search(r'[\(\[][^\)\]]*?(Remux)\b', filename, flags=re.IGNORECASE)
+        m = REMUX_RE.search(filename)
         return True if m else False
 
     def __cleanUpBrackets(self, filename):
         # Can get rid of the brackets that won't contain subber
-        filename = re.sub(r'\([^\)]*?' + NO_SUBBER + r'.*?\)', '', filename)
-        filename = re.sub(r'\[[^\]]*?' + NO_SUBBER + r'.*?\]', '', filename)
+        filename = NO_SUBBER_PAREN_RE.sub('', filename)
+        filename = NO_SUBBER_SQUARE_RE.sub('', filename)
         # Strip any empty sets of brackets, unless they are at the beginning
-        filename = re.sub(r'(?!^)\[\W*?\]|\(\W*?\)', '', filename)
+        filename = EMPTY_BRACKETS_RE.sub('', filename)
         return filename
 
     def __extractSubber(self, filename, remux):
         # Extract the subber from square brackets (or round failing that)
-        for opening, closing in BRACKET_PAIRS:
-            m = re.search(r'{0}([^\. ].*?){1}'.format(opening, closing), filename)
+        for subber_re in SUBBER_RES:
+            m = subber_re.search(filename)
             if m:
                 self.subberTag = m.group(1)
                 filename = filename[:m.start()] + filename[m.end():]
@@ -182,8 +266,7 @@ class AnimeInfoExtractor:
         # Add the remux string if this was a remux and it's not found in the subber tag
         if remux and 'remux' not in self.subberTag.lower():
             # refind remux and remove it
-            m = re.search(
-                r'[\(\[][^\)\]]*?(Remux)\b', filename, flags=re.IGNORECASE)
+            m = REMUX_RE.search(filename)
             if m:
                 filename = filename[:m.start(1)] + filename[m.end(1):]
             if self.subberTag:
@@ -194,8 +277,7 @@ class AnimeInfoExtractor:
 
     def __extractVersion(self, filename):
         # Extract the version number (limit at v7 since V8 is possible in a title...)
-        m = re.search(r'(?:[^a-zA-Z])v([0-7])\b',
-                      filename, flags=re.IGNORECASE)
+        m = VERSION_RE.search(filename)
         if m:
             self.version = int(m.group(1))
             filename = filename[:m.start(1) - 1] + filename[m.end(1):]
@@ -204,10 +286,7 @@ class AnimeInfoExtractor:
     def __extractVolumeIfPack(self, filename, title_len):
         # Check if this is a volume pack - only relevant for no extension
         if not self.extension:
-            m = re.search(
-                r'\b(?:vol(?:ume)?\.? ?)(\d{1,3})(?: ?- ?(?:vol(?:ume)?\.? ?)?(\d{1,3}))?\b',
-                filename,
-                flags=re.IGNORECASE)
+            m = VOLUME_RE.search(filename)
             if m:
                 self.volumeStart = int(m.group(1))
                 if m.group(2):
@@ -218,7 +297,7 @@ class AnimeInfoExtractor:
 
     def __extractPv(self, filename):
         # Check if this is a PV release (not relevant if it's a pack)
-        m = re.search(r' PV ?(\d)?(?:[^a-zA-Z0-9]|$)', filename)
+        m = PV_RE.search(filename)
         if not self.volumeStart and m:
             self.pv = 0
             if m.group(1):
@@ -228,12 +307,7 @@ class AnimeInfoExtractor:
 
     def __extractEpisodeNumbers(self, filename):
         # First check for concurrent episodes (with a + or &)
-        m = re.search(
-            r'\b(?:S(?:\.|eason)?(\d+)\s*)?'
-            r'(?:E\.?|Ep(?:i|isode)?s?[ .]?)?(\d{1,4})[\+\&](\d{1,4})\b',
-            filename,
-            flags=re.IGNORECASE,
-        )
+        m = CONCURRENT_EPISODES_RE.search(filename)
         if m:
             start = int(m.group(2))
             end = int(m.group(3))
@@ -245,15 +319,7 @@ class AnimeInfoExtractor:
                 return filename[:m.start()]
 
         # Check for multiple episodes (with a -)
-        ep_search_string = (
-            r'\b(?:S(?:\.|eason)?(\d+)\s*)?'
-            r'(?:E\.?|Ep(?:i|isode)?[ .]?)?'
-            r'((?:\d{1,3}|1[0-8]\d{2})(?:\.\d{1})?)'
-            # Only allow spaces around the hyphen when we are likely to have a pack
-            + (r'-' if self.extension else r' ?- ?')
-            + r'(\d{1,4}(?:\.\d{1})?)\b'
-        )
-        m = re.search(ep_search_string, filename, flags=re.IGNORECASE)
+        m = MULTIPLE_EPISODES_RES[bool(self.extension)].search(filename)
         if m:
             if m.group(1):
                 self.season = int(m.group(1))
@@ -262,11 +328,7 @@ class AnimeInfoExtractor:
             return filename[:m.start()]
 
         # Check if there is an episode specifier
-        m = re.search(
-            r'\b(?:S(?:\.|eason)?(\d+)\s*)?(?:E\.?|Ep(?:i|isode)?[ .]?)(\d+(?:\.\d)?)(?:\b|v)',
-            filename,
-            flags=re.IGNORECASE
-        )
+        m = EPISODE_SPECIFIER_RE.search(filename)
         if m:
             if m.group(1):
                 self.season = int(m.group(1))
@@ -275,14 +337,13 @@ class AnimeInfoExtractor:
 
         # Check any remaining lonely numbers as episode (towards the end has priority)
         # First try outside brackets
-        m = re.search(r'.*[^\.\[\(]\b((?:\d{1,3}|1[0-8]\d{2})(?:\.\d)?)(?:[\[({]|\s*$|\s+\W)',
-                      filename)
+        m = LONELY_NUMBER_RE.search(filename)
         if m:
             self.episodeStart = Decimal(m.group(1))
             return filename[:m.start(1)]
 
         # then allow brackets
-        m = re.search(r'.*[\[\(]((?:\d{1,3}|1[0-8]\d{2})(?:\.\d)?)(?:[\])}]|\s*$|\s+\W)', filename)
+        m = LONELY_NUMBER_BRACKETS_RE.search(filename)
         if m:
             self.episodeStart = Decimal(m.group(1))
             return filename[:m.start(1)]
@@ -292,15 +353,15 @@ class AnimeInfoExtractor:
         # Unfortunately it's very hard to know if there should be brackets in the title.
         # We really should strip brackets, though, so sorry to anything with brackets in the title.
         # We don't strip years or the whole title, however.
-        for opening, closing in BRACKET_PAIRS:
-            m = re.search(r'{0}((?!\d{{4}}{1}).*?){1}'.format(opening, closing), filename)
+        for bracketed_re in BRACKETED_RES:
+            m = bracketed_re.search(filename)
             if m and m.end() - m.start() < len(filename):
                 filename = filename[:m.start()] + filename[m.end():]
-        filename = re.sub(r'  .*', '', filename)
+        filename = DOUBLE_SPACE_RE.sub('', filename)
         # Strip any unclosed brackets and anything after them
-        for opening, closing in BRACKET_PAIRS:
-            filename = re.sub(r'{}r[^{}].*$'.format(opening, closing), '', filename)
-        self.name = re.sub(r'( - *)+$', '', filename.strip(' '))
+        for unclosed_re in UNCLOSED_BRACKET_RES:
+            filename = unclosed_re.sub('', filename)
+        self.name = TRAILING_DASHES_RE.sub('', filename.strip(' '))
         # If we have a subber but no title!? then it must have been a title...
         if self.name == '' and self.subberTag != '':
             self.name = self.subberTag
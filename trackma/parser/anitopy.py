@@ -19,6 +19,8 @@ import os
 import anitopy
 from decimal import Decimal
 
+from trackma.parser import ParseResult
+
 
 class AnitopyWrapper():
     """
@@ -26,10 +28,34 @@ class AnitopyWrapper():
     Exists mainly for compatibility reasons, but also to work around
     some edge cases that Anitopy cannot solve.
     """
+    parser_name = 'anitopy'
+    # Increase whenever a change in the wrapper gives different results
+    parser_version = '1-%s' % getattr(anitopy, '__version__', '')
 
     def __init__(self, msg, file_name):
         self.msg = msg.with_classname('Parser')
+        self._load(file_name)
+
+    @classmethod
+    def parse_batch(cls, msg, file_names):
+        """
+        Parses every file name in **file_names**, yielding a ParseResult for each.
+        The same wrapper object is reused for all of them.
+        """
+        wrapper = None
+        for file_name in file_names:
+            if wrapper:
+                wrapper._load(file_name)
+            else:
+                wrapper = cls(msg, file_name)
+            yield wrapper.getResult()
+
+    def _load(self, file_name):
         self.original_file_name = file_name
+        self.episode_number = None
+        self.anime_title = None
+        self.season = None
+        self.version = 1
 
         file_name = self.__preProcessFileName(file_name)
         file_name = self.__trimFileName(file_name)
@@ -48,11 +74,16 @@ class AnitopyWrapper():
 
         self.episode_number = self.__extractEpisodeNumber(data)
         self.anime_title = self.__extractAnimeTitle(data)
+        (self.season, self.version) = self.__extractSeasonAndVersion(data)
 
     def getName(self):
         # Returns the anime title
         return self.anime_title
 
+    def getResult(self):
+        (ep_start, ep_end) = self.getEpisodeNumbers()
+        return ParseResult(self.anime_title, ep_start, ep_end, self.season, self.version)
+
     def getEpisode(self):
         # Returns the first/only episode number
         if self.episode_number is None:
@@ -209,6 +240,23 @@ class AnitopyWrapper():
 
         return anime_title
 
+    @staticmethod
+    def __extractSeasonAndVersion(data):
+        # Only the first season is kept for multi-season releases
+        season = data.get('anime_season')
+        if isinstance(season, list):
+            season = season[0]
+        version = data.get('release_version')
+        if isinstance(version, list):
+            version = version[0]
+
+        try:
+            season = int(season) if season else None
+            version = int(version) if version else 1
+        except ValueError:
+            (season, version) = (None, 1)
+        return (season, version)
+
     @staticmethod
     def __extractEpisodeNumber(data):
         # Deal with episode related stuff that Anitopy left out
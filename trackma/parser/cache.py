@@ -0,0 +1,153 @@
+# This file is part of Trackma.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import pickle
+import sqlite3
+import threading
+
+from trackma.parser import ParseResult
+
+
+class ParseCache:
+    """
+    On-disk cache of parse results, shared by every account and mediatype.
+
+    Results are stored by parser name, parser version and filename.
+    When a parser's version changes, the results of its older
+    versions are discarded the first time it's used.
+
+    The cache is only an optimization, so database errors are
+    reported to **msg** and otherwise ignored.
+    """
+    # Number of new results kept in memory before writing them
+    flush_size = 500
+
+    def __init__(self, msg, filename):
+        self.msg = msg.with_classname('ParseCache')
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.purged = set()
+        self.db = None
+
+        try:
+            self.db = sqlite3.connect(filename, check_same_thread=False, timeout=10)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS results ('
+                            'parser TEXT, version TEXT, filename TEXT, data BLOB, '
+                            'PRIMARY KEY (parser, version, filename))')
+            self.db.commit()
+        except sqlite3.Error as e:
+            self.msg.warn("Can't open parse cache: %s" % e)
+            self.db = None
+
+    @staticmethod
+    def _key(parser_class):
+        return (parser_class.parser_name, str(parser_class.parser_version))
+
+    def _purge(self, parser_class):
+        # Called with the lock held
+        (name, version) = self._key(parser_class)
+        self.db.execute('DELETE FROM results WHERE parser = ? AND version != ?', (name, version))
+        self.db.commit()
+        self.purged.add(parser_class)
+
+    def get(self, parser_class, filename):
+        """Returns the cached ParseResult of **filename**, or None if there isn't one."""
+        key = self._key(parser_class)
+        with self.lock:
+            if (key, filename) in self.pending:
+                return self.pending[(key, filename)]
+            if not self.db:
+                return None
+
+            try:
+                if parser_class not in self.purged:
+                    self._purge(parser_class)
+
+                row = self.db.execute('SELECT data FROM results WHERE parser = ? AND version = ? AND filename = ?',
+                                      key + (filename,)).fetchone()
+            except sqlite3.Error as e:
+                self.msg.debug("Can't read parse cache: %s" % e)
+                return None
+
+        if row:
+            return ParseResult(*pickle.loads(row[0]))
+
+    def put(self, parser_class, filename, result):
+        """Stores the ParseResult of **filename**; it's written to disk in batches."""
+        with self.lock:
+            if not self.db:
+                return
+
+            self.pending[(self._key(parser_class), filename)] = result
+            if len(self.pending) < self.flush_size:
+                return
+
+        self.flush()
+
+    def flush(self):
+        """Writes the pending results to disk."""
+        with self.lock:
+            if not self.db or not self.pending:
+                return
+
+            rows = [key + (filename, pickle.dumps(tuple(result), protocol=2))
+                    for (key, filename), result in self.pending.items()]
+            self.pending = {}
+
+            try:
+                self.db.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)', rows)
+                self.db.commit()
+            except sqlite3.Error as e:
+                self.msg.debug("Can't write parse cache: %s" % e)
+
+    def prune(self, parser_class, filenames):
+        """
+        Discards the results of **parser_class** for every file not in **filenames**.
+
+        This is done after a full library scan, so the cache doesn't keep
+        the files removed from the library. As the cache is shared, files
+        only found in the library of another account are parsed again
+        the next time that one is scanned.
+        """
+        self.flush()
+        with self.lock:
+            if not self.db:
+                return
+
+            try:
+                self.db.execute('CREATE TEMP TABLE IF NOT EXISTS found (filename TEXT PRIMARY KEY)')
+                self.db.execute('DELETE FROM found')
+                self.db.executemany('INSERT OR IGNORE INTO found VALUES (?)',
+                                    ((filename,) for filename in filenames))
+                cursor = self.db.execute('DELETE FROM results WHERE parser = ? AND '
+                                         'filename NOT IN (SELECT filename FROM found)',
+                                         (parser_class.parser_name,))
+                self.db.execute('DELETE FROM found')
+                self.db.commit()
+            except sqlite3.Error as e:
+                self.msg.debug("Can't prune parse cache: %s" % e)
+                return
+
+        if cursor.rowcount:
+            self.msg.debug("Pruned %d parse results." % cursor.rowcount)
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.db:
+                self.db.close()
+                self.db = None
@@ -0,0 +1,507 @@
+# This file is part of Trackma.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import dbm
+import os
+import pickle
+import shelve
+import sqlite3
+import sys
+import threading
+
+from trackma import messenger
+from trackma import utils
+
+
+class Storage:
+    """
+    Base interface for the storage backends used by the Data Handler.
+
+    A backend keeps four stores for a given account and mediatype:
+    the list cache, the info cache, the update queue and the metadata.
+    Functions that change a single item receive the whole container
+    as well, so backends that can't do partial writes can fall back
+    to saving everything.
+
+    messenger: Messenger object to send useful messages to
+    userfolder: Name of the account data folder
+    mediatype: Media type the stores belong to
+    """
+    name = 'Storage'
+
+    def __init__(self, messenger, userfolder, mediatype):
+        self.msg = messenger.with_classname(self.name)
+        self.userfolder = userfolder
+        self.mediatype = mediatype
+
+    def set_message_handler(self, message_handler):
+        self.msg = message_handler.with_classname(self.name)
+
+    def list_exists(self):
+        raise NotImplementedError
+
+    def load_list(self):
+        """Returns the list cache as a dictionary of show dictionaries."""
+        raise NotImplementedError
+
+    def save_list(self, showlist):
+        """Saves the whole list cache."""
+        raise NotImplementedError
+
+    def save_list_item(self, showlist, show):
+        """Saves a single changed **show** of the list cache."""
+        self.save_list(showlist)
+
+    def delete_list_item(self, showlist, showid):
+        """Removes a single show from the list cache."""
+        self.save_list(showlist)
+
+    def compact(self, showlist):
+        """Called when the Data Handler is unloaded to consolidate changes."""
+        pass
+
+    def info_exists(self):
+        raise NotImplementedError
+
+    def get_info(self, showid):
+        """Returns the info record of a single show, raises KeyError if missing."""
+        raise NotImplementedError
+
+    def iter_info(self):
+        """Yields every record of the info cache."""
+        raise NotImplementedError
+
+    def save_info(self, infos):
+        """Saves the changed **infos** records of the info cache."""
+        raise NotImplementedError
+
+    def clear_info(self):
+        """Discards the whole info cache."""
+        raise NotImplementedError
+
+    def queue_exists(self):
+        raise NotImplementedError
+
+    def load_queue(self):
+        """Returns the list of queued items."""
+        raise NotImplementedError
+
+    def save_queue(self, queue):
+        raise NotImplementedError
+
+    def meta_exists(self):
+        raise NotImplementedError
+
+    def load_meta(self):
+        """Returns the metadata dictionary."""
+        raise NotImplementedError
+
+    def save_meta(self, meta):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PickleStorage(Storage):
+    """
+    Keeps every store in its own pickle file.
+
+    Changes to single shows of the list cache are appended to a journal
+    next to the list file, which gets compacted into the full snapshot
+    every :attr:`journal_limit` changes and when the storage is compacted.
+
+    The info cache is kept in a shelf keyed by show ID instead, which
+    is only opened once a record is requested.
+
+    The queue and the metadata are written with a delay, but always
+    before the list cache, so a show is never saved as changed while
+    the queue item that sends the change is still pending.
+    """
+    name = 'Storage (pickle)'
+
+    # Number of journaled changes after which the list cache
+    # gets compacted into a full snapshot
+    journal_limit = 200
+
+    def __init__(self, messenger, userfolder, mediatype):
+        super().__init__(messenger, userfolder, mediatype)
+
+        self.queue_file = utils.to_data_path(userfolder, '%s.queue' % mediatype)
+        self.info_file = utils.to_data_path(userfolder, '%s.info' % mediatype)
+        self.infodb_file = utils.to_data_path(userfolder, '%s.infodb' % mediatype)
+        self.cache_file = utils.to_data_path(userfolder, '%s.list' % mediatype)
+        self.journal_file = utils.to_data_path(userfolder, '%s.journal' % mediatype)
+        self.meta_file = utils.to_data_path(userfolder, '%s.meta' % mediatype)
+
+        self.journal_size = 0
+        self.writer = utils.DataWriter()
+        self.infodb = None
+        self.infodb_lock = threading.Lock()
+
+    def list_exists(self):
+        return os.path.isfile(self.cache_file)
+
+    def load_list(self):
+        self.msg.debug("Reading cache...")
+        showlist = utils.load_data(self.cache_file)
+
+        # Replay the changes done since the last snapshot
+        if os.path.isfile(self.journal_file):
+            self.msg.debug("Replaying journal...")
+            for (showid, show) in utils.load_data_records(self.journal_file):
+                if show is None:
+                    showlist.pop(showid, None)
+                else:
+                    showlist[showid] = show
+
+            # Start over with a clean journal, as anything appended after
+            # a truncated record wouldn't be read back
+            self.save_list(showlist)
+
+        return showlist
+
+    def save_list(self, showlist):
+        self.msg.debug("Saving cache...")
+        self.writer.flush()
+        utils.save_data(showlist, self.cache_file)
+
+        # The snapshot now contains every journaled change
+        if os.path.isfile(self.journal_file):
+            os.unlink(self.journal_file)
+        self.journal_size = 0
+
+    def save_list_item(self, showlist, show):
+        self._journal_append(showlist, show['id'], show)
+
+    def delete_list_item(self, showlist, showid):
+        self._journal_append(showlist, showid, None)
+
+    def compact(self, showlist):
+        if self.journal_size:
+            self.save_list(showlist)
+
+    def _journal_append(self, showlist, showid, show):
+        if self.journal_size >= self.journal_limit:
+            # Compact the journal periodically so it doesn't grow forever
+            self.save_list(showlist)
+            return
+
+        self.writer.flush()
+        utils.append_data((showid, show), self.journal_file)
+        self.journal_size += 1
+
+    def info_exists(self):
+        return (self.infodb is not None
+                or os.path.isfile(self.info_file)
+                or dbm.whichdb(self.infodb_file) is not None)
+
+    def _info_key(self, showid):
+        # Shelf keys must be strings; repr keeps int and str IDs apart
+        return repr(showid)
+
+    def _open_info(self):
+        if self.infodb is None:
+            self.msg.debug("Opening info DB...")
+            self.infodb = shelve.open(self.infodb_file, protocol=2)
+
+            # Convert the old single-file info cache
+            if os.path.isfile(self.info_file):
+                self.msg.debug("Converting info DB...")
+                for showid, info in utils.load_data(self.info_file).items():
+                    self.infodb[self._info_key(showid)] = info
+                self.infodb.sync()
+                os.unlink(self.info_file)
+
+        return self.infodb
+
+    def get_info(self, showid):
+        with self.infodb_lock:
+            return self._open_info()[self._info_key(showid)]
+
+    def iter_info(self):
+        with self.infodb_lock:
+            infodb = self._open_info()
+            infos = [infodb[key] for key in infodb.keys()]
+        return iter(infos)
+
+    def save_info(self, infos):
+        self.msg.debug("Saving info DB...")
+        with self.infodb_lock:
+            infodb = self._open_info()
+            for info in infos:
+                infodb[self._info_key(info['id'])] = info
+            infodb.sync()
+
+    def clear_info(self):
+        self.msg.debug("Clearing info DB...")
+        with self.infodb_lock:
+            if self.infodb is not None:
+                self.infodb.close()
+            if os.path.isfile(self.info_file):
+                os.unlink(self.info_file)
+            self.infodb = shelve.open(self.infodb_file, flag='n', protocol=2)
+
+    def queue_exists(self):
+        return os.path.isfile(self.queue_file)
+
+    def load_queue(self):
+        self.msg.debug("Reading queue...")
+        return utils.load_data(self.queue_file)
+
+    def save_queue(self, queue):
+        self.msg.debug("Saving queue...")
+        self.writer.save_data(queue, self.queue_file)
+
+    def meta_exists(self):
+        return os.path.isfile(self.meta_file)
+
+    def load_meta(self):
+        self.msg.debug("Reading metadata...")
+        return utils.load_data(self.meta_file)
+
+    def save_meta(self, meta):
+        self.msg.debug("Saving metadata...")
+        self.writer.save_data(meta, self.meta_file)
+
+    def close(self):
+        self.writer.close()
+
+        with self.infodb_lock:
+            if self.infodb is not None:
+                self.infodb.close()
+                self.infodb = None
+
+
+class SQLiteStorage(Storage):
+    """
+    Keeps every store in a single SQLite database, one row per show,
+    info record, queue item and metadata key, so changes only touch
+    the rows involved. Shows are kept in the order of the list.
+    """
+    name = 'Storage (SQLite)'
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS shows (id PRIMARY KEY, data BLOB NOT NULL);
+        CREATE TABLE IF NOT EXISTS info (id PRIMARY KEY, data BLOB NOT NULL);
+        CREATE TABLE IF NOT EXISTS queue (position INTEGER PRIMARY KEY, id, action TEXT, data BLOB NOT NULL);
+        CREATE INDEX IF NOT EXISTS queue_item ON queue (id, action);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, data BLOB NOT NULL);
+        CREATE TABLE IF NOT EXISTS stores (name TEXT PRIMARY KEY);
+    '''
+
+    def __init__(self, messenger, userfolder, mediatype):
+        super().__init__(messenger, userfolder, mediatype)
+
+        self.db_file = utils.to_data_path(userfolder, '%s.db' % mediatype)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(self.schema)
+
+        # Last written value of every metadata key, to skip unchanged rows
+        self.meta_rows = {}
+
+    def _dumps(self, data):
+        return pickle.dumps(data, protocol=2)
+
+    def _loads(self, data):
+        return pickle.loads(data, encoding='bytes')
+
+    def _store_exists(self, name):
+        with self.lock:
+            cur = self.conn.execute('SELECT 1 FROM stores WHERE name = ?', (name,))
+            return cur.fetchone() is not None
+
+    def _mark_store(self, name):
+        self.conn.execute('INSERT OR IGNORE INTO stores (name) VALUES (?)', (name,))
+
+    def list_exists(self):
+        return self._store_exists('list')
+
+    def load_list(self):
+        self.msg.debug("Reading cache...")
+        with self.lock:
+            rows = self.conn.execute('SELECT id, data FROM shows ORDER BY rowid').fetchall()
+        return {showid: self._loads(data) for (showid, data) in rows}
+
+    def save_list(self, showlist):
+        self.msg.debug("Saving cache...")
+        rows = [(showid, self._dumps(show)) for showid, show in showlist.items()]
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM shows')
+            self.conn.executemany('INSERT INTO shows (id, data) VALUES (?, ?)', rows)
+            self._mark_store('list')
+
+    def save_list_item(self, showlist, show):
+        # Rows are read back in rowid order, so changed shows are updated
+        # in place to keep their position in the list, like in a dict
+        data = self._dumps(show)
+        with self.lock, self.conn:
+            cur = self.conn.execute('UPDATE shows SET data = ? WHERE id = ?', (data, show['id']))
+            if not cur.rowcount:
+                self.conn.execute('INSERT INTO shows (id, data) VALUES (?, ?)', (show['id'], data))
+
+    def delete_list_item(self, showlist, showid):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM shows WHERE id = ?', (showid,))
+
+    def info_exists(self):
+        return self._store_exists('info')
+
+    def get_info(self, showid):
+        with self.lock:
+            row = self.conn.execute('SELECT data FROM info WHERE id = ?', (showid,)).fetchone()
+        if row is None:
+            raise KeyError(showid)
+        return self._loads(row[0])
+
+    def iter_info(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT data FROM info').fetchall()
+        return (self._loads(data) for (data,) in rows)
+
+    def save_info(self, infos):
+        self.msg.debug("Saving info DB...")
+        rows = [(info['id'], self._dumps(info)) for info in infos]
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO info (id, data) VALUES (?, ?)', rows)
+            self._mark_store('info')
+
+    def clear_info(self):
+        self.msg.debug("Clearing info DB...")
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM info')
+            self.conn.execute("DELETE FROM stores WHERE name = 'info'")
+
+    def queue_exists(self):
+        return self._store_exists('queue')
+
+    def load_queue(self):
+        self.msg.debug("Reading queue...")
+        with self.lock:
+            rows = self.conn.execute('SELECT data FROM queue ORDER BY position').fetchall()
+        return [self._loads(data) for (data,) in rows]
+
+    def save_queue(self, queue):
+        self.msg.debug("Saving queue...")
+        rows = [(position, item['id'], item.get('action'), self._dumps(item))
+                for position, item in enumerate(queue)]
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM queue')
+            self.conn.executemany(
+                'INSERT INTO queue (position, id, action, data) VALUES (?, ?, ?, ?)', rows)
+            self._mark_store('queue')
+
+    def meta_exists(self):
+        return self._store_exists('meta')
+
+    def load_meta(self):
+        self.msg.debug("Reading metadata...")
+        with self.lock:
+            rows = self.conn.execute('SELECT key, data FROM meta').fetchall()
+        self.meta_rows = dict(rows)
+        return {key: self._loads(data) for (key, data) in rows}
+
+    def save_meta(self, meta):
+        self.msg.debug("Saving metadata...")
+        rows = []
+        for key, value in meta.items():
+            data = self._dumps(value)
+            if self.meta_rows.get(key) != data:
+                rows.append((key, data))
+                self.meta_rows[key] = data
+
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO meta (key, data) VALUES (?, ?)', rows)
+            self._mark_store('meta')
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+available_storages = {
+    'pickle': PickleStorage,
+    'sqlite': SQLiteStorage,
+}
+
+
+def get_storage_class(msg, storage_name):
+    # Choose the storage backend we want to use
+    try:
+        return available_storages[storage_name]
+    except KeyError:
+        msg.debug('Unknown storage backend "{}", falling back to default'.format(storage_name))
+        return PickleStorage
+
+
+def migrate(msg, userfolder, mediatype, source, dest):
+    """
+    Copies every store of an account and mediatype from the **source**
+    storage backend to the **dest** one.
+
+    The Data Handler of that account must not be running.
+    """
+    src = available_storages[source](msg, userfolder, mediatype)
+    dst = available_storages[dest](msg, userfolder, mediatype)
+
+    try:
+        if src.list_exists():
+            msg.info("Migrating list cache...")
+            dst.save_list(src.load_list())
+        if src.info_exists():
+            msg.info("Migrating info cache...")
+            dst.save_info(list(src.iter_info()))
+        if src.queue_exists():
+            msg.info("Migrating queue...")
+            dst.save_queue(src.load_queue())
+        if src.meta_exists():
+            msg.info("Migrating metadata...")
+            dst.save_meta(src.load_meta())
+    finally:
+        src.close()
+        dst.close()
+
+
+def main():
+    if len(sys.argv) != 5 or sys.argv[3] not in available_storages \
+            or sys.argv[4] not in available_storages:
+        print("Usage: python -m trackma.storage <username.api> <mediatype> <source> <dest>")
+        print("Available backends: %s" % ', '.join(available_storages))
+        sys.exit(1)
+
+    (userfolder, mediatype, source, dest) = sys.argv[1:]
+
+    if not utils.dir_exists(utils.to_data_path(userfolder)):
+        print("Account data folder %s doesn't exist." % userfolder)
+        sys.exit(1)
+    if os.path.isfile(utils.to_data_path(userfolder, 'lock')):
+        print("Database is locked by another process, close Trackma first.")
+        sys.exit(1)
+
+    def message_handler(classname, msgtype, msg):
+        if msgtype != messenger.TYPE_DEBUG:
+            print("%s: %s" % (classname, msg))
+
+    migrate(messenger.Messenger(message_handler, 'Migrate'),
+            userfolder, mediatype, source, dest)
+    print("Done. Set \"data_backend\" to \"%s\" in config.json to use it." % dest)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,53 +15,35 @@
 #
 
 import os
-import re
 import time
 
 from trackma import utils
+from trackma.tracker import procfs
 from trackma.tracker import tracker
 
 
 class inotifyBase(tracker.TrackerBase):
     open_file = (None, None, None)
+    watches_library = True
 
     def __init__(self, messenger, tracker_list, config, watch_dirs, redirections=None):
-        super().__init__(messenger, tracker_list, config, watch_dirs, redirections)
+        # Set up before the parent starts the tracker thread
+        self.players = procfs.PlayerProcesses(config['tracker_process'])
 
-        self.re_players = re.compile(config['tracker_process'].encode('utf-8'))
+        super().__init__(messenger, tracker_list, config, watch_dirs, redirections)
 
     def _proc_poll(self):
         """
-        This function scans proc to see if there's any player
+        This function checks if there's any player
         already open. If it is, and it has a media file open,
         return its first instance as a filename.
         """
 
         time.sleep(0.01)
 
-        for p in os.listdir("/proc/"):
-            if not p.isdigit():
-                continue
-
-            # Get process name
-            try:
-                with open('/proc/%s/cmdline' % p, 'rb') as f:
-                    cmdline = f.read()
-                    pname = cmdline.partition(b'\x00')[0]
-            except FileNotFoundError:
-                continue
-            # It's not one of our players
-            if not self.re_players.search(pname):
-                continue
-
-            d = "/proc/%s/fd/" % p
-            try:
-                for fd in os.listdir(d):
-                    f = os.readlink(d+fd)
-                    if utils.is_media(f):
-                        return os.path.split(f)
-            except OSError:
-                pass
+        found = self.players.find(utils.is_media)
+        if found:
+            return os.path.split(found[2])
 
         return None
 
@@ -75,27 +57,11 @@ class inotifyBase(tracker.TrackerBase):
         """
 
         time.sleep(0.01)
-        for p in os.listdir("/proc/"):
-            if not p.isdigit():
-                continue
-            d = "/proc/%s/fd/" % p
-            try:
-                for fd in os.listdir(d):
-                    f = os.readlink(d+fd)
-                    if f == filename:
-                        # Get process name
-                        with open('/proc/%s/cmdline' % p, 'rb') as f:
-                            cmdline = f.read()
-                            pname = cmdline.partition(b'\x00')[0]
-                        self.msg.debug('Playing process: {} {} ({})'.format(p, pname, cmdline))
-
-                        # Check if it's our process
-                        if self.re_players.search(pname):
-                            return p, fd
-                        else:
-                            self.msg.debug("Not read by player ({})".format(pname))
-            except OSError:
-                pass
+        found = self.players.find(lambda path: path == filename)
+        if found:
+            (pid, fd, _) = found
+            self.msg.debug('Playing process: {} {}'.format(pid, self.players.name(pid)))
+            return pid, fd
 
         self.msg.debug("Couldn't find playing process.")
         return None, None
@@ -0,0 +1,215 @@
+# This file is part of Trackma.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import threading
+import time
+
+from trackma import utils
+from trackma.messenger import Messenger
+
+
+class LibraryWatcher:
+    """
+    Watches the library directories for media files being added or removed,
+    independently of the tracker used for playback.
+
+    It uses pyinotify or inotify when available, and otherwise, or if the
+    directories can't be watched, it polls them every **interval** seconds,
+    only listing again the ones that were modified.
+
+    **index** is the directory index of the last library scan; the files
+    already in the library are found through it instead of listing
+    every directory again.
+
+    Changes are sent through the 'detected' and 'removed' signals
+    with the path and name of the file, like the inotify trackers do.
+    """
+    msg: Messenger
+    active = True
+
+    name = 'Library watcher'
+
+    def __init__(self, messenger, watch_dirs, interval, index=None):
+        self.msg = messenger.with_classname(self.name)
+        self.watch_dirs = list(watch_dirs)
+        self.interval = interval
+        # Our own copy, as the engine keeps updating its index
+        self.index = dict(index or {})
+        self.scanned = False
+        self.signals = {
+            'detected': None,
+            'removed': None,
+        }
+
+        # Media files known to be in the library, as (path, name)
+        self.files = set()
+
+        watcher_t = threading.Thread(target=self.observe)
+        watcher_t.daemon = True
+
+        self.msg.debug('Enabling library watcher...')
+        watcher_t.start()
+
+    def disable(self):
+        self.msg.info('Unloading...')
+        self.active = False
+
+    def connect_signal(self, signal, callback):
+        if signal not in self.signals:
+            raise utils.EngineFatal("Invalid signal.")
+        self.signals[signal] = callback
+
+    def _emit_signal(self, signal, *args):
+        if self.signals[signal]:
+            self.signals[signal](*args)
+
+    def observe(self):
+        try:
+            for watch in (self._watch_pyinotify, self._watch_inotify):
+                try:
+                    watch()
+                    return
+                except ImportError:
+                    pass
+                except OSError as e:
+                    # Most likely the limit of inotify watches was reached
+                    self.msg.warn("Can't watch the library for changes ({}); polling instead.".format(e))
+                    break
+
+            self._watch_polling()
+        finally:
+            self.msg.info('Library watcher has stopped.')
+
+    def _find_files(self, path):
+        for root, dirs, names in os.walk(path, followlinks=True):
+            for name in names:
+                if utils.is_media(name):
+                    yield (root, name)
+
+    def _list_files(self):
+        files = set()
+        for path in self.watch_dirs:
+            for (fullpath, _) in utils.find_videos_indexed(path, self.index):
+                files.add(os.path.split(fullpath))
+        return files
+
+    def _scan(self):
+        # Called once the watches are set, so no file is missed
+        self.files.update(self._list_files())
+        self.scanned = True
+
+    def _process_event(self, path, name, is_dir, added):
+        if is_dir:
+            fullpath = os.path.join(path, name)
+            if added:
+                # Files inside a new directory may be there before it's watched
+                for (file_path, file_name) in self._find_files(fullpath):
+                    self._file_added(file_path, file_name)
+            else:
+                prefix = fullpath + os.sep
+                for (file_path, file_name) in [f for f in self.files
+                                               if f[0] == fullpath or f[0].startswith(prefix)]:
+                    self._file_removed(file_path, file_name)
+        elif added:
+            self._file_added(path, name)
+        else:
+            self._file_removed(path, name)
+
+    def _file_added(self, path, name):
+        if utils.is_media(name) and (path, name) not in self.files:
+            self.files.add((path, name))
+            self._emit_signal('detected', path, name)
+
+    def _file_removed(self, path, name):
+        if (path, name) in self.files:
+            self.files.remove((path, name))
+            self._emit_signal('removed', path, name)
+
+    def _watch_pyinotify(self):
+        import pyinotify
+
+        self.msg.info('Using pyinotify.')
+        watcher = self
+        added = pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO  # pylint: disable=no-member
+        removed = pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM  # pylint: disable=no-member
+
+        class EventHandler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                watcher._process_event(event.path, event.name,
+                                       event.mask & pyinotify.IN_ISDIR,  # pylint: disable=no-member
+                                       event.mask & added)
+
+        wm = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(wm, EventHandler())
+        try:
+            for path in self.watch_dirs:
+                self.msg.debug('Watching directory {}'.format(path))
+                try:
+                    wm.add_watch(path, added | removed, rec=True, auto_add=True, quiet=False)
+                except pyinotify.WatchManagerError as e:
+                    raise OSError(str(e))
+            self._scan()
+
+            while self.active:
+                # Wake up each second to notice when we're disabled
+                if notifier.check_events(1000) and self.active:
+                    notifier.read_events()
+                    notifier.process_events()
+        finally:
+            notifier.stop()
+
+    def _watch_inotify(self):
+        import inotify.adapters
+        import inotify.calls
+        import inotify.constants
+
+        self.msg.info('Using inotify.')
+        self.msg.debug('Watching the following paths: ' + ','.join(self.watch_dirs))
+        mask = (inotify.constants.IN_CREATE
+                | inotify.constants.IN_MOVE
+                | inotify.constants.IN_DELETE)
+
+        try:
+            i = inotify.adapters.InotifyTrees(self.watch_dirs, mask=mask)
+            self._scan()
+
+            for event in i.event_gen():
+                if not self.active:
+                    return
+
+                if event is not None:
+                    (header, types, path, filename) = event
+                    self._process_event(path, filename, 'IN_ISDIR' in types,
+                                        'IN_CREATE' in types or 'IN_MOVED_TO' in types)
+        except inotify.calls.InotifyError as e:
+            raise OSError(str(e))
+
+    def _watch_polling(self):
+        self.msg.info('Polling every {} seconds.'.format(self.interval))
+        if not self.scanned:
+            self._scan()
+
+        while self.active:
+            # After falling back from inotify, this also catches
+            # the changes made while it was failing
+            files = self._list_files()
+            for (path, name) in sorted(self.files - files):
+                self._file_removed(path, name)
+            for (path, name) in sorted(files - self.files):
+                self._file_added(path, name)
+
+            time.sleep(self.interval)
@@ -19,13 +19,43 @@ import subprocess
 import time
 
 from trackma import utils
+from trackma.tracker import procfs
 from trackma.tracker import tracker
 
 
 class PollingTracker(tracker.TrackerBase):
     name = 'Tracker (polling)'
+    players = None
+
+    def __init__(self, messenger, tracker_list, config, watch_dirs, redirections=None):
+        # Read the players' open files from procfs where there's one,
+        # otherwise ask lsof
+        if os.path.isdir('/proc/self/fd'):
+            self.players = procfs.PlayerProcesses(config['tracker_process'])
+
+        super().__init__(messenger, tracker_list, config, watch_dirs, redirections)
 
     def get_playing_file(self, watch_dirs, players):
+        if self.players:
+            return self._get_playing_file_procfs(watch_dirs)
+        else:
+            return self._get_playing_file_lsof(watch_dirs, players)
+
+    def _get_playing_file_procfs(self, watch_dirs):
+        # Open files are matched by path, so the directories are never walked
+        prefixes = set()
+        for path in watch_dirs:
+            prefixes.add(os.path.join(path, ''))
+            prefixes.add(os.path.join(os.path.realpath(path), ''))
+        prefixes = tuple(prefixes)
+
+        found = self.players.find(lambda path: path.startswith(prefixes) and utils.is_media(path))
+        if found:
+            return os.path.basename(found[2])
+
+        return None
+
+    def _get_playing_file_lsof(self, watch_dirs, players):
         cmd = [
             'lsof',
             '-a',  # cause selection options to be AND-combined
@@ -49,7 +79,10 @@ class PollingTracker(tracker.TrackerBase):
         return None
 
     def observe(self, config, watch_dirs):
-        self.msg.info("pyinotify not available; using polling (slow).")
+        if self.players:
+            self.msg.info("pyinotify not available; using polling.")
+        else:
+            self.msg.info("pyinotify not available; using polling with lsof (slow).")
         while self.active:
             # This runs the tracker and update the playing show if necessary
             filename = self.get_playing_file(
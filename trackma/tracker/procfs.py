@@ -0,0 +1,111 @@
+# This file is part of Trackma.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import re
+import time
+
+
+class PlayerProcesses:
+    """
+    Registry of the running processes whose name matches **pattern**,
+    read from procfs.
+
+    The command line of a process is only read the first time its PID
+    is seen, so keeping the registry up to date costs a listing of /proc,
+    and only the open files of the players are ever looked at.
+
+    A process could run a player after it was first seen, so when
+    a file isn't found, every command line is read again, at most
+    once every **full_refresh_interval** seconds.
+    """
+    full_refresh_interval = 10
+
+    def __init__(self, pattern, proc='/proc'):
+        self.re_players = re.compile(pattern.encode('utf-8'))
+        self.proc = proc
+        self.names = {}
+        self.last_full_refresh = None
+
+    def refresh(self, full=False):
+        """Adds the new processes to the registry and forgets the ones that exited."""
+        if full:
+            self.names = {}
+            self.last_full_refresh = time.monotonic()
+
+        names = {}
+        for pid in os.listdir(self.proc):
+            if not pid.isdigit():
+                continue
+
+            if pid in self.names:
+                names[pid] = self.names[pid]
+            else:
+                names[pid] = self._player_name(pid)
+        self.names = names
+
+    def _player_name(self, pid):
+        # Returns the process name if it's one of our players
+        try:
+            with open(os.path.join(self.proc, pid, 'cmdline'), 'rb') as f:
+                pname = f.read().partition(b'\x00')[0]
+        except OSError:
+            return None
+
+        if self.re_players.search(pname):
+            return pname
+
+    def players(self):
+        """Returns the PIDs of the known players."""
+        return [pid for pid, name in self.names.items() if name]
+
+    def name(self, pid):
+        return self.names.get(pid)
+
+    def open_files(self, pid):
+        """Yields the (fd, path) of every file opened by **pid**."""
+        d = os.path.join(self.proc, pid, 'fd')
+        try:
+            fds = os.listdir(d)
+        except OSError:
+            return
+
+        for fd in fds:
+            try:
+                yield (fd, os.readlink(os.path.join(d, fd)))
+            except OSError:
+                pass
+
+    def find(self, match):
+        """
+        Returns the (pid, fd, path) of the first file opened
+        by a player where **match(path)** is true, or None.
+        """
+        self.refresh()
+        found = self._find(match)
+
+        if not found and (self.last_full_refresh is None or
+                          time.monotonic() - self.last_full_refresh > self.full_refresh_interval):
+            self.refresh(full=True)
+            found = self._find(match)
+
+        return found
+
+    def _find(self, match):
+        for pid in self.players():
+            for (fd, path) in self.open_files(pid):
+                if match(path):
+                    return (pid, fd, path)
@@ -18,6 +18,7 @@ import os
 import threading
 import time
 
+from trackma import parser
 from trackma import utils
 from trackma.parser import get_parser_class
 from trackma.messenger import Messenger
@@ -37,6 +38,9 @@ class TrackerBase(object):
 
     name = 'Tracker'
 
+    # Whether the tracker sends the detected and removed signals
+    watches_library = False
+
     signals = {
         'state': None,
         'detected': None,
@@ -258,7 +262,7 @@ class TrackerBase(object):
                         break
 
             # Invoke the parser to extract show title and episode.
-            aie = self.parser_class(self.msg, filename)
+            aie = parser.parse(self.parser_class, self.msg, filename)
             (show_title, show_ep) = (aie.getName(), aie.getEpisode())
             if not show_title:
                 # Format not recognized
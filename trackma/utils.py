@@ -14,9 +14,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import atexit
+import collections
 import copy
 import datetime
 import difflib
+import heapq
+import itertools
 import json
 import locale
 import os
@@ -223,9 +227,31 @@ def save_config(config_dict, filename):
     if not os.path.isdir(path):
         os.mkdir(path)
 
-    with open(filename, 'wb') as configfile:
-        configfile.write(json.dumps(config_dict, sort_keys=True,
-                                    indent=4, separators=(',', ': ')).encode('utf-8'))
+    write_file(json.dumps(config_dict, sort_keys=True,
+                          indent=4, separators=(',', ': ')).encode('utf-8'), filename)
+
+
+def write_file(contents, filename):
+    """
+    Writes **contents** (bytes) to a file atomically.
+
+    The contents are written to a temporary file in the same directory,
+    synced to disk and then renamed over the target, so a crash never
+    leaves a truncated file behind.
+    """
+    tmpname = '%s.%d.%d.tmp' % (filename, os.getpid(), threading.get_ident())
+    try:
+        with open(tmpname, 'wb') as tmpfile:
+            tmpfile.write(contents)
+            tmpfile.flush()
+            os.fsync(tmpfile.fileno())
+        if os.path.exists(filename):
+            shutil.copymode(filename, tmpname)
+        os.replace(tmpname, filename)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+        raise
 
 
 def load_data(filename):
@@ -234,8 +260,131 @@ def load_data(filename):
 
 
 def save_data(data, filename):
-    with open(filename, 'wb') as datafile:
+    write_file(pickle.dumps(data, protocol=2), filename)
+
+
+class DataWriter:
+    """
+    Coalesces writes of data files.
+
+    Data passed to :func:`save_data` is serialized right away, but written
+    to disk by a timer **delay** seconds after the first pending save.
+    Only the latest data of each file is written, so a burst of saves
+    costs a single write and fsync per file.
+
+    Pending writes are done on :func:`flush`, :func:`close` and when
+    the program exits.
+    """
+
+    def __init__(self, delay=1.0):
+        self.delay = delay
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.timer = None
+
+        atexit.register(self.flush)
+
+    def save_data(self, data, filename):
+        contents = pickle.dumps(data, protocol=2)
+
+        with self.lock:
+            self.pending[filename] = contents
+
+            if not self.timer:
+                self.timer = threading.Timer(self.delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+
+            pending, self.pending = self.pending, {}
+            for filename, contents in pending.items():
+                write_file(contents, filename)
+
+    def close(self):
+        """Writes pending data; the writer isn't flushed at exit anymore."""
+        self.flush()
+        atexit.unregister(self.flush)
+
+
+class EventBatcher:
+    """
+    Gathers events and passes them to **callback** in batches.
+
+    A batch is sent once **delay** seconds pass without new events,
+    or at most **max_delay** seconds after its first event, so a steady
+    stream of events doesn't hold them back forever.
+    A delay of 0 sends every event right away.
+    """
+
+    def __init__(self, delay, callback, max_delay=None):
+        self.delay = delay
+        self.max_delay = delay * 10 if max_delay is None else max_delay
+        self.callback = callback
+        self.events = []
+        self.first = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.timer = None
+
+    def add(self, event):
+        if not self.delay:
+            with self.flush_lock:
+                self.callback([event])
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            if not self.events:
+                self.first = now
+            self.events.append(event)
+
+            if self.timer:
+                self.timer.cancel()
+            wait = min(self.delay, self.first + self.max_delay - now)
+            self.timer = threading.Timer(max(wait, 0), self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        """Sends the pending events now."""
+        with self.flush_lock:
+            with self.lock:
+                if self.timer:
+                    self.timer.cancel()
+                    self.timer = None
+
+                events, self.events = self.events, []
+
+            if events:
+                self.callback(events)
+
+
+def append_data(data, filename):
+    """Appends a single record at the end of a data file and syncs it to disk."""
+    with open(filename, 'ab') as datafile:
         pickle.dump(data, datafile, protocol=2)
+        datafile.flush()
+        os.fsync(datafile.fileno())
+
+
+def load_data_records(filename):
+    """
+    Yields every record appended to a data file with :func:`append_data`.
+
+    A truncated record at the end of the file (e.g. because of a crash
+    in the middle of a write) is silently discarded.
+    """
+    with open(filename, 'rb') as datafile:
+        while True:
+            try:
+                yield pickle.load(datafile, encoding='bytes')
+            except (EOFError, pickle.UnpicklingError):
+                return
 
 
 def log_error(msg):
@@ -276,6 +425,70 @@ def regex_find_videos(subdirectory=''):
                 yield (os.path.join(root, filename), filename)
 
 
+# Directories modified this recently (in nanoseconds) might still change
+# within the same mtime, so they're listed again in the next scan.
+RACY_MTIME = 2 * 10**9
+
+
+def find_videos_indexed(subdirectory, index, refresh=False):
+    """
+    Works like :func:`regex_find_videos`, but only lists the directories
+    that were modified since the last time they were recorded in **index**.
+
+    **index** is a dictionary of every directory path to its modification
+    time, file names and subdirectories, and it gets updated in place.
+    Entries of directories that no longer exist are removed from it.
+    If **refresh** is set every directory is listed again.
+    """
+    path = os.path.expanduser(subdirectory) if subdirectory else os.getcwd()
+    visited = set()
+
+    yield from _walk_indexed(path, index, visited, refresh, time.time_ns())
+
+    prefix = os.path.join(path, '')
+    for dirpath in [d for d in index if d not in visited and (d == path or d.startswith(prefix))]:
+        del index[dirpath]
+
+
+def _walk_indexed(path, index, visited, refresh, now):
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return
+
+    entry = index.get(path)
+    if not refresh and entry and entry[0] == mtime:
+        (_, names, dirs) = entry
+    else:
+        names = []
+        dirs = []
+        try:
+            with os.scandir(path) as it:
+                for direntry in it:
+                    try:
+                        is_dir = direntry.is_dir()
+                    except OSError:
+                        is_dir = False
+
+                    if is_dir:
+                        dirs.append(direntry.name)
+                    else:
+                        names.append(direntry.name)
+        except OSError:
+            return
+
+        if now - mtime < RACY_MTIME:
+            mtime = None
+        index[path] = (mtime, names, dirs)
+
+    visited.add(path)
+    for filename in names:
+        if is_media(filename):
+            yield (os.path.join(path, filename), filename)
+    for dirname in dirs:
+        yield from _walk_indexed(os.path.join(path, dirname), index, visited, refresh, now)
+
+
 def regex_rename_files(pattern, source_dir, dest_dir):
     in_path = os.path.expanduser(os.path.join('~', '.trackma', source_dir))
     out_path = os.path.expanduser(os.path.join('~', '.trackma', dest_dir))
@@ -383,9 +596,201 @@ def estimate_aired_episodes(show):
     return 0
 
 
+class TitleIndex:
+    """
+    Index of the titles and aliases of a tracker list for fuzzy searches.
+
+    Every title is split in trigrams, so a search first compares the query
+    against the few titles sharing the most trigrams with it. The best
+    ratio found among them then rules out most of the other titles through
+    upper bounds of their ratio, which are much cheaper to get, so the
+    result is the same as comparing the query against every title.
+
+    Shows can be added, changed or removed later with :func:`update`,
+    which only indexes the titles of those shows again. Use :func:`copy`
+    first to keep the current index as it is for whoever still uses it.
+    """
+    threshold = 0.7
+    candidates = 20
+
+    def __init__(self, showlist):
+        self.showlist = showlist
+        self.lock = threading.Lock()
+        self._reset()
+
+        for item in showlist.values():
+            self._add_show(item)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.shared = set()
+
+    def copy(self):
+        """
+        Returns a copy of the index that can be updated
+        without changing this one.
+        """
+        new = TitleIndex.__new__(TitleIndex)
+        new.lock = threading.Lock()
+        with self.lock:
+            new.showlist = self.showlist
+            new.titles = list(self.titles)
+            new.positions = dict(self.positions)
+            new.order = dict(self.order)
+            new.removed = self.removed
+
+            # The trigram and length lists are only copied
+            # by whichever index changes them
+            new.trigrams = collections.defaultdict(list, self.trigrams)
+            new.lengths = collections.defaultdict(list, self.lengths)
+            self.shared = set(self.trigrams) | set(self.lengths)
+            new.shared = set(self.shared)
+        return new
+
+    def _reset(self):
+        self.titles = []
+        self.trigrams = collections.defaultdict(list)
+        self.lengths = collections.defaultdict(list)
+        self.positions = {}
+        self.order = {}
+        self.removed = 0
+        self.shared = set()
+
+    @staticmethod
+    def _trigrams(title):
+        normalized = '  %s ' % re.sub(r'[\W_]+', ' ', title).strip()
+        return {normalized[i:i+3] for i in range(len(normalized) - 2)}
+
+    def _add_show(self, item):
+        # Shows keep their place in the list order when they're indexed again
+        self.order.setdefault(item['id'], len(self.order))
+        self.positions[item['id']] = [self._add_title(item['id'], title)
+                                      for title in item['titles']]
+
+    def _remove_show(self, showid):
+        # Removed titles are left as None until the index is compacted
+        for position in self.positions.pop(showid, ()):
+            self.titles[position] = None
+            self.removed += 1
+
+    def _add_title(self, showid, title):
+        title = title.lower()
+        trigrams = self._trigrams(title)
+
+        position = len(self.titles)
+        chars = tuple(collections.Counter(title).items())
+        self.titles.append((showid, title, len(trigrams), chars))
+        for trigram in trigrams:
+            self._append(self.trigrams, trigram, position)
+        self._append(self.lengths, len(title), position)
+        return position
+
+    def _append(self, table, key, position):
+        # Lists shared with a copy are copied first; trigrams
+        # and lengths can't be mistaken in self.shared
+        if key in self.shared:
+            table[key] = list(table[key])
+            self.shared.discard(key)
+        table[key].append(position)
+
+    def _rank(self, position):
+        return (self.order[self.titles[position][0]], position)
+
+    def _candidates(self, title):
+        trigrams = self._trigrams(title)
+        shared = collections.Counter()
+        for trigram in trigrams:
+            shared.update(self.trigrams.get(trigram, ()))
+
+        # Rank by the Dice coefficient of both trigram sets,
+        # preferring the shows first in the list
+        scores = ((2 * count / (len(trigrams) + self.titles[position][2]), self._rank(position))
+                  for position, count in shared.items() if self.titles[position])
+        best = heapq.nlargest(self.candidates, scores,
+                              key=lambda score: (score[0], -score[1][0], -score[1][1]))
+        return sorted(rank for _, rank in best)
+
+    def update(self, showlist, showids):
+        """
+        Makes the index follow **showlist**, where only the shows
+        in **showids** were added, changed or removed.
+        """
+        with self.lock:
+            self.showlist = showlist
+            for showid in showids:
+                self._remove_show(showid)
+                if showid in showlist:
+                    self._add_show(showlist[showid])
+
+            if self.removed > len(self.titles) // 2:
+                order = sorted(showlist.values(), key=lambda item: self.order.get(item['id'], len(self.order)))
+                self._reset()
+                for item in order:
+                    self._add_show(item)
+
+    def search(self, title):
+        """
+        Returns the show with the title most similar to **title**,
+        or None if none of them is similar enough.
+        """
+        title = title.lower()
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq1(title)
+        query_chars = collections.Counter(title)
+
+        # Like a full scan, return the title with the highest ratio
+        # and the first one in the list order among equals
+        (best_ratio, best_rank, best_showid) = (self.threshold, None, None)
+
+        with self.lock:
+            candidates = [position for (_, position) in self._candidates(title)]
+            tried = set(candidates)
+
+            # After the candidates, the other titles by how close
+            # their length is to the one of the query
+            others = sorted(self.lengths.items(), key=lambda item: abs(item[0] - len(title)))
+
+            for (title_length, positions) in itertools.chain([(None, candidates)], others):
+                # Upper bounds of the ratio: the length of the shortest
+                # title and the characters both titles have in common
+                # (the same as SequenceMatcher's real_quick_ratio and quick_ratio)
+                if title_length is not None and \
+                        2.0 * min(len(title), title_length) / (len(title) + title_length) < best_ratio:
+                    continue
+
+                for position in positions:
+                    if not self.titles[position] or (title_length is not None and position in tried):
+                        continue
+                    (showid, candidate, _, chars) = self.titles[position]
+                    length = len(title) + len(candidate)
+
+                    bound = 2.0 * sum(min(count, query_chars.get(char, 0)) for (char, count) in chars) / length
+                    if bound < best_ratio or not self._beats(bound, self._rank(position), best_ratio, best_rank):
+                        continue
+
+                    matcher.set_seq2(candidate)
+                    ratio = matcher.ratio()
+                    if self._beats(ratio, self._rank(position), best_ratio, best_rank):
+                        (best_ratio, best_rank, best_showid) = (ratio, self._rank(position), showid)
+
+            if best_showid is not None:
+                return self.showlist[best_showid]
+
+    @staticmethod
+    def _beats(ratio, rank, best_ratio, best_rank):
+        # The threshold itself (no rank) has to be exceeded
+        return ratio > best_ratio or (ratio == best_ratio and best_rank is not None and rank < best_rank)
+
+
 def guess_show(show_title, tracker_list):
     """ Take a title and search for it fuzzily in the tracker list """
-    (showlist, altnames_map) = tracker_list
+    (showlist, altnames_map) = tracker_list[:2]
 
     # Return the show immediately if we find an altname for it
     if altnames_map and show_title.lower() in altnames_map:
@@ -394,25 +799,13 @@ def guess_show(show_title, tracker_list):
         if showid in showlist:
             return showlist[showid]
 
-    # Use difflib to see if the show title is similar to
-    # one we have in the list
-    highest_ratio = (None, 0)
-    matcher = difflib.SequenceMatcher()
-    matcher.set_seq1(show_title.lower())
-
-    # Compare to every show in our list to see which one
-    # has the most similar name
-    for item in showlist.values():
-        # Make sure to search through all the aliases
-        for title in item['titles']:
-            matcher.set_seq2(title.lower())
-            ratio = matcher.ratio()
-            if ratio > highest_ratio[1]:
-                highest_ratio = (item, ratio)
+    # Use the title index of the tracker list if it comes with one
+    if len(tracker_list) > 2 and tracker_list[2]:
+        index = tracker_list[2]
+    else:
+        index = TitleIndex(showlist)
 
-    playing_show = highest_ratio[0]
-    if highest_ratio[1] > 0.7:
-        return playing_show
+    return index.search(show_title)
 
 
 def redirect_show(show_tuple, redirections, tracker_list):
@@ -427,19 +820,68 @@ def redirect_show(show_tuple, redirections, tracker_list):
 
     showlist = tracker_list[0]
     if show['id'] in redirections:
-        for redirection in redirections[show['id']]:
+        for redirection in redirections[show['id']].find(ep):
             (src_eps, dst_id, dst_eps) = redirection
 
-            if (src_eps[1] == -1 and ep >= src_eps[0]) or (ep in range(src_eps[0], src_eps[1] + 1)):
-                new_show_id = dst_id
-                new_ep = ep + (dst_eps[0] - src_eps[0])
+            new_show_id = dst_id
+            new_ep = ep + (dst_eps[0] - src_eps[0])
 
-                if new_show_id in showlist:
-                    return (showlist[new_show_id], new_ep)
+            if new_show_id in showlist:
+                return (showlist[new_show_id], new_ep)
 
     return show_tuple
 
 
+def redirect_show_range(show_tuple, redirections, tracker_list):
+    """
+    Like :func:`redirect_show`, but for an (ep_start, ep_end) range of episodes.
+
+    As a range may span several shows, a list of (show, (ep_start, ep_end))
+    tuples is returned, one for each consecutive part of the range.
+    """
+    (show, (ep_start, ep_end)) = show_tuple
+    parts = []
+
+    if show.get('total') and ep_start <= show['total']:
+        # redirect only for invalid eps
+        parts.append((show, (ep_start, min(ep_end, show['total']))))
+        ep_start = show['total'] + 1
+
+    if ep_start > ep_end:
+        return parts
+
+    rules = []
+    if redirections and show['id'] in redirections:
+        rules = redirections[show['id']].overlapping(ep_start, ep_end)
+
+    # Split the range wherever a rule starts or ends; the rules
+    # that apply are the same for every episode of each piece.
+    bounds = {ep_start, ep_end + 1}
+    for (src_eps, dst_id, dst_eps) in rules:
+        bounds.add(max(src_eps[0], ep_start))
+        if src_eps[1] != -1 and src_eps[1] < ep_end:
+            bounds.add(src_eps[1] + 1)
+    bounds = sorted(bounds)
+
+    showlist = tracker_list[0]
+    for (start, end) in zip(bounds, bounds[1:]):
+        (new_show, offset) = (show, 0)
+        for (src_eps, dst_id, dst_eps) in rules:
+            if src_eps[0] <= start and (src_eps[1] == -1 or start <= src_eps[1]) \
+                    and dst_id in showlist:
+                (new_show, offset) = (showlist[dst_id], dst_eps[0] - src_eps[0])
+                break
+
+        (new_start, new_end) = (start + offset, end - 1 + offset)
+        if parts and parts[-1][0] is new_show and parts[-1][1][1] + 1 == new_start:
+            # Continues the last part
+            parts[-1] = (new_show, (parts[-1][1][0], new_end))
+        else:
+            parts.append((new_show, (new_start, new_end)))
+
+    return parts
+
+
 def open_folder(path):
     if sys.platform == 'darwin':
         spawn_process(["open", path])
@@ -586,6 +1028,10 @@ config_defaults = {
     'autosend_at_exit': True,
     'library_autoscan': True,
     'library_full_path': False,
+    'library_scan_processes': 1,
+    'library_event_delay': 2,
+    'library_watch': True,
+    'library_watch_interval': 60,
     'scan_whole_list': False,
     'debug_disable_lock': True,
     'auto_status_change': True,
@@ -612,6 +1058,7 @@ config_defaults = {
     'redirections_time': 1,
     'use_hooks': True,
     'title_parser': 'aie',
+    'data_backend': 'pickle',
 }
 
 userconfig_defaults = {